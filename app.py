@@ -1,37 +1,87 @@
 from fastapi import FastAPI, HTTPException, Query, Request, File, UploadFile, Form, APIRouter, Body, Path
-from fastapi import Depends
+from fastapi import Depends, Header
+from fastapi.exception_handlers import http_exception_handler as default_http_exception_handler
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 import requests
 import json
-from email_utils import generate_verification_code, send_verification_email
+from email_utils import send_verification_email
 from db_control.connect_MySQL import SessionLocal
-from db_control import crud, mymodels_MySQL
+from db_control import crud, mymodels_MySQL, rollups
 # from db_control.crud import insertTransaction
 from dotenv import load_dotenv
+import logging
 import os
 from sqlalchemy.orm import Session
-from datetime import datetime,timedelta,date
-from azure.storage.blob import BlobServiceClient
-from azure.storage.blob import ContentSettings
+from datetime import datetime,timedelta,date,time
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException as StarletteHTTPException
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 from dotenv import load_dotenv
-import uuid
 from typing import List, Optional
+import blob_storage
+import event_service
+import idempotency
+import rate_limit
+import auth_tokens
+import pubsub
+import code_store
+import identity
+import resilience
+import email_utils
+import logging_config
+
+logger = logging_config.get_logger(__name__)
 
 
 
 load_dotenv()
 
-print("DEBUG SENDGRID_API_KEY (partial):", os.getenv("SENDGRID_API_KEY")[:10])
-print("DEBUG FROM_EMAIL:", os.getenv("FROM_EMAIL"))
+logger.debug("FROM_EMAIL: %s", os.getenv("FROM_EMAIL"))
 
 SENDGRID_API_KEY = os.getenv("SENDGRID_API_KEY")
 FROM_EMAIL = os.getenv("FROM_EMAIL")
 
-app = FastAPI()
+# レスポンスは orjson で直列化する（一覧系はさらに ORJSONResponse を直接返して jsonable_encoder を通さない）
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# /auth 系のレート制限（DBセッション取得より前に判定する。CORS より内側に置く）
+app.add_middleware(rate_limit.RateLimitMiddleware)
+
+@app.get("/metrics/rate-limit")
+def get_rate_limit_metrics():
+    return rate_limit.get_active_metrics()
+
+@app.get("/metrics/pubsub")
+def get_pubsub_metrics():
+    return pubsub.get_metrics()
+
+@app.get("/metrics/logging")
+def get_logging_metrics():
+    return logging_config.get_metrics()
+
+@app.get("/metrics/resilience")
+def get_resilience_metrics():
+    return resilience.get_metrics()
+
+# DB・Blob・SendGrid が使えない間は待たせずに 503 を返す（クライアントは Retry-After 秒後に再試行する）
+@app.exception_handler(resilience.DependencyUnavailableError)
+def dependency_unavailable_handler(request: Request, exc: resilience.DependencyUnavailableError):
+    return ORJSONResponse(
+        status_code=503,
+        content={"detail": str(exc), "dependency": exc.name},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+# エンドポイントの except Exception が依存先の停止を HTTPException に変換していても、503 + Retry-After で返す
+@app.exception_handler(StarletteHTTPException)
+async def http_exception_handler(request: Request, exc: StarletteHTTPException):
+    unavailable = resilience.unavailable_cause(exc)
+    if unavailable is not None:
+        return dependency_unavailable_handler(request, unavailable)
+    return await default_http_exception_handler(request, exc)
 
 # ログイン用の認証（user_id 不要）
 class LoginCodeVerifyRequest(BaseModel):
@@ -40,6 +90,8 @@ class LoginCodeVerifyRequest(BaseModel):
 
 # ログイン───── ④ DBセッション関数（定型）─────
 def get_db():
+    # DB の障害中はセッションを作らずに 503 にする
+    crud.mysql.check()
     db = SessionLocal()
     try:
         yield db
@@ -50,40 +102,35 @@ class LoginSendCodeRequest(BaseModel):
     email: str
 
 @app.post("/auth/send-login-code")
-def send_login_code(data: LoginSendCodeRequest, db: Session = Depends(get_db)):
-    # 登録済みユーザーをDBから検索
-    user = db.query(mymodels_MySQL.User).filter_by(email=data.email).first()
+def send_login_code(data: LoginSendCodeRequest):
+    # 登録済みユーザーを正規化したメールアドレスで検索（索引1回 + キャッシュ。Users には書かない）
+    user_id = identity.resolve_user_id(data.email)
 
-    if not user:
-        print(f"🚫 未登録のメールアドレスが指定されました: {data.email}")
+    if user_id is None:
+        logger.info("未登録のメールアドレスが指定されました: %s", data.email)
         raise HTTPException(status_code=404, detail="このメールアドレスは登録されていません")
 
-    # 認証コードを生成
-    code = generate_verification_code()
-    expiry = datetime.now() + timedelta(minutes=5)
-
-    # DBに保存
-    user.verification_code = code
-    user.code_expiry = expiry
-    db.commit()
+    # 認証コードを発行（コードと user_id は code_store に保存し、5分で失効する）
+    code = code_store.issue_code("login", data.email, user_id)
 
     # メール送信
     send_verification_email(data.email, code)
-    print(f"✅ 認証コードを {data.email} に送信しました（code: {code}）")
+    logger.info("認証コードを %s に送信しました", data.email)
     return {"message": "ログイン用の認証コードを送信しました"}
 
-@app.post("/auth/login-verify-code")
-def login_verify_code(data: LoginCodeVerifyRequest, db: Session = Depends(get_db)):
-    user = db.query(mymodels_MySQL.User).filter_by(email=data.email).first()
+def _verify_code_or_401(purpose: str, email: str, code: str) -> Optional[int]:
+    try:
+        return code_store.verify_code(purpose, email, code)
+    except code_store.CodeVerificationError as e:
+        raise HTTPException(status_code=401, detail=str(e))
 
-    if not user:
-        raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
-    if user.verification_code != data.code:
-        raise HTTPException(status_code=401, detail="認証コードが一致しません")
-    if user.code_expiry < datetime.now():
-        raise HTTPException(status_code=401, detail="認証コードの有効期限が切れています")
+@app.post("/auth/login-verify-code")
+def login_verify_code(data: LoginCodeVerifyRequest):
+    # 発行時に保存した user_id を返すので、検証は code_store の主キー検索1回だけ
+    user_id = _verify_code_or_401("login", data.email, data.code)
 
-    return {"message": "ログイン成功", "user_id": user.user_id}
+    # 以降のリクエストは Authorization: Bearer <token> で本人確認する（DB を引かない）
+    return {"message": "ログイン成功", "user_id": user_id, **auth_tokens.token_response(user_id)}
 
 
 def send_verification_email(to_email: str, code: str) -> bool:
@@ -94,12 +141,13 @@ def send_verification_email(to_email: str, code: str) -> bool:
         plain_text_content=f'以下の認証コードを入力してください：\n\n{code}'
     )
     try:
-        sg = SendGridAPIClient(SENDGRID_API_KEY)
-        response = sg.send(message)
-        print(response.status_code)
+        response = email_utils.send_message(message, SENDGRID_API_KEY)
+        logger.debug("SendGrid: %s", response.status_code)
         return response.status_code == 202
+    except resilience.DependencyUnavailableError:
+        raise
     except Exception as e:
-        print(f"SendGrid送信失敗: {e}")
+        logger.error("SendGrid送信失敗: %s", e)
         return False
 
 # テスト用APIエンドポイント
@@ -112,19 +160,15 @@ def send_test_email(to: str = Query(..., description="テスト送信先メー
     else:
         return {"message": "メール送信失敗…"}
 
-# MySQLのテーブル作成
-from db_control.create_tables_MySQL import init_db
+# スキーマの作成・変更は python -m db_control.migrate upgrade で行う（gunicorn では gunicorn.conf.py が起動前に実行）。
+# 起動時は適用済みのリビジョンを1回読み、古ければ起動を止める
+from db_control import migrate
 
-# # アプリケーション初期化時にテーブルを作成
-init_db()
+migrate.require_current_schema()
 
 # app = FastAPI()
     
-# Azure Blob Storageの接続設定
-ACCOUNT_NAME = os.getenv('AZURE_STORAGE_ACCOUNT_NAME')
-ACCOUNT_KEY = os.getenv('AZURE_STORAGE_ACCOUNT_KEY')
-CONTAINER_NAME = os.getenv("AZURE_STORAGE_CONTAINER_NAME")
-CONNECTION_STRING = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+# Azure Blob Storageの接続設定は blob_storage.py を参照
 
 # CORSミドルウェアの設定
 app.add_middleware(
@@ -153,23 +197,25 @@ def send_verification_code(data: SendCodeRequest, db: Session = Depends(get_db))
         
         if not user:
             raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
-        
-        # ✅ 認証コードを生成して保存
-        code = generate_verification_code()
-        expiry = datetime.now() + timedelta(minutes=5)
-
-        user.verification_code = code
-        user.code_expiry = expiry
 
         # ✅ このタイミングでメールアドレスを更新（Step1ではemail=None）
-        user.email=data.email
+        if identity.normalize_email(user.email) != identity.normalize_email(data.email):
+            identity.set_user_email(db, data.user_id, data.email)
+            db.commit()
 
-        db.commit()
+        # ✅ 認証コードを発行（Users には保存しない）
+        code = code_store.issue_code("signup", data.email, data.user_id)
 
         send_verification_email(data.email, code)
 
         return {"message": "認証コードを送信しました（テストコード: " + code + ")"}
     
+    except HTTPException:
+        db.rollback()
+        raise
+    except identity.EmailAlreadyRegisteredError as e:
+        db.rollback()
+        raise HTTPException(status_code=409, detail=str(e))
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"送信失敗: {str(e)}")
@@ -181,6 +227,8 @@ class CodeVerifyRequest(BaseModel):
 
 # DBセッション取得
 def get_db():
+    # DB の障害中はセッションを作らずに 503 にする
+    crud.mysql.check()
     db = SessionLocal()
     try:
         yield db
@@ -194,24 +242,12 @@ class CodeVerifyRequest(BaseModel):
     code: str
 
 @app.post("/auth/verify-code")
-def verify_code(data: CodeVerifyRequest, db: Session = Depends(get_db)):
-    print("💬 受け取ったリクエストボディ:", data)
-    user = db.query(mymodels_MySQL.User).filter_by(email=data.email).first()
+def verify_code(data: CodeVerifyRequest):
+    logger.debug("認証コードの検証: %s", data.email)
+    # メールアドレスは send-code で登録済みなので、ここでは Users に書かない
+    user_id = _verify_code_or_401("signup", data.email, data.code)
 
-    if not user:
-        raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
-
-    if user.verification_code != data.code:
-        raise HTTPException(status_code=401, detail="認証コードが一致しません")
-
-    if user.code_expiry < datetime.now():
-        raise HTTPException(status_code=401, detail="認証コードの有効期限が切れています")
-    
-    # ✅ 認証成功 → メールアドレスを更新
-    user.email = data.email
-    db.commit()
-
-    return {"message": "認証成功", "user_id": user.user_id}
+    return {"message": "認証成功", "user_id": user_id, **auth_tokens.token_response(user_id)}
     # ログイン成功とみなす（JWTやセッションは今後追加）
     # return {"message": "ログイン成功", "user_id": user.user_id}
 
@@ -233,7 +269,7 @@ def register_step1(data: RegisterStep1Request, db: Session = Depends(get_db)):
         user_id = crud.insert_user_step1(db, data)
         return {"message": "Step1 登録完了", "user_id": user_id}
     except Exception as e:
-        print("Step1登録エラー:", e)
+        logger.exception("Step1登録エラー: %s", e)
         raise HTTPException(status_code=500, detail="Step1登録に失敗しました")
 
     
@@ -241,18 +277,28 @@ def register_step1(data: RegisterStep1Request, db: Session = Depends(get_db)):
 class RegisterStep2Request(BaseModel):
     user_id: int
     tags: List[int]
+    replace: bool = False  # True なら送ったタグだけに置き換える
 
 from fastapi import Body
 
 @app.post("/register/step2")
-def register_step2(data: RegisterStep2Request):
-    try:
-        for tag_id in data.tags:
-            crud.insertUserTag(user_id=data.user_id, tag_id=tag_id)
-        return {"message": "Step2（興味タグ）登録完了"}
-    except Exception as e:
-        print(f"Step2 登録エラー: {e}")
-        raise HTTPException(status_code=500, detail="Step2 登録に失敗しました")
+def register_step2(data: RegisterStep2Request, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    tag_ids = []
+    def handle(session):
+        try:
+            # 検証・登録を1トランザクションでまとめて行う（再送されても重複しない）
+            tag_ids[:] = crud.assign_user_tags(data.user_id, data.tags, replace=data.replace, session=session)
+            return {"message": "Step2（興味タグ）登録完了"}
+        except crud.InvalidTagError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            logger.exception("Step2 登録エラー: %s", e)
+            raise HTTPException(status_code=500, detail="Step2 登録に失敗しました")
+    def after_commit(result):
+        # 次のスナップショット再構築を待たずにコンテンツベース推薦で使う
+        feature_store.note_user_tags(data.user_id, tag_ids, replace=data.replace)
+    return idempotency.run_idempotent("register/step2", data.user_id, idempotency_key, data, handle,
+                                      after_commit=after_commit)
 
 # 新規登録Step4 Pydanticモデル
 class RegisterStep4Request(BaseModel):
@@ -285,69 +331,12 @@ def register_step4(data: RegisterStep4Request, db: Session = Depends(get_db)):
 @app.get("/event")
 def db_read(store_id: int = Query(...)):
     event_list = crud.selectEvent(store_id)
-    print("Received event_list:")
     if not event_list:
         return {"message": "開催予定のイベントはありません"}
     return event_list
 
-# ファイルをAzure Blob Storageに保存する関数
-def save_file_to_blob(file: UploadFile) -> str:
-    try:
-        # BlobServiceClientの初期化
-        blob_service_client = BlobServiceClient.from_connection_string(CONNECTION_STRING)
-        
-        # コンテナが存在するか確認し、存在しない場合は作成
-        container_client = blob_service_client.get_container_client(CONTAINER_NAME)
-        try:
-            container_client.get_container_properties()
-            print(f"コンテナ '{CONTAINER_NAME}' は既に存在します。")
-        except Exception as e:
-            if 'ContainerNotFound' in str(e):
-                print(f"コンテナ '{CONTAINER_NAME}' が見つかりません。作成します。")
-                container_client.create_container()
-                print(f"コンテナ '{CONTAINER_NAME}' を作成しました。")
-            else:
-                raise e
-        
-        # ユニークなファイル名を生成
-        unique_filename = f"{uuid.uuid4()}_{file.filename}"
-
-        # ファイルタイプに応じたContent-Typeを設定
-        content_type = None
-        filename_lower = file.filename.lower()
-        if filename_lower.endswith('.jpg') or filename_lower.endswith('.jpeg'):
-            content_type = 'image/jpeg'
-        elif filename_lower.endswith('.png'):
-            content_type = 'image/png'
-        elif filename_lower.endswith('.pdf'):
-            content_type = 'application/pdf'
-        elif filename_lower.endswith('.gif'):
-            content_type = 'image/gif'
-        
-        # BlobClientの取得
-        blob_client = blob_service_client.get_blob_client(container=CONTAINER_NAME, blob=unique_filename)
-        
-        # ファイルポインタを先頭に戻す
-        file.file.seek(0)
-        
-        # ファイルの内容を読み込む
-        file_content = file.file.read()
-        
-        # Content-Typeを指定してBlobにアップロード
-        blob_client.upload_blob(
-            file_content, 
-            overwrite=True,
-            content_settings=ContentSettings(content_type=content_type)
-        )
-        
-        # アップロードされたファイルのURLを生成
-        blob_url = f"https://{ACCOUNT_NAME}.blob.core.windows.net/{CONTAINER_NAME}/{unique_filename}"
-        
-        print(f"ファイル '{file.filename}' をアップロードしました。URL: {blob_url}")
-        return blob_url
-    except Exception as e:
-        print(f"Error uploading to Azure Blob Storage: {e}")
-        raise e
+# ファイルをAzure Blob Storageに保存する関数（blob_storage.py に移動）
+save_file_to_blob = blob_storage.upload_file
 
 @app.post("/event-register")
 async def add_event(
@@ -365,61 +354,118 @@ async def add_event(
     flyer: Optional[UploadFile] = None,
     eventImage: Optional[UploadFile] = None
 ):
-    form = await request.form()
-    print("Received values:", form)
-
-    for key, value in form.items():
-        if isinstance(value, UploadFile):
-            print(f"File in form: {key}, filename: {value.filename}, size: {value.size}")
-    print("flyer param check:", flyer)
-    print("eventImage param check:", eventImage)
+    if logger.isEnabledFor(logging.DEBUG):
+        form = await request.form()
+        for key, value in form.items():
+            if isinstance(value, UploadFile):
+                logger.debug("File in form: %s, filename: %s, size: %s", key, value.filename, value.size)
+
+    fields = {
+        "event_name": eventName,
+        "area": area,
+        "start_date": startDate,
+        "end_date": endDate,
+        "start_at": startTime,
+        "end_at": endTime,
+        "description": description,
+        "information": information,
+        "store_id": store_id
+    }
+    logger.debug("event_data: %s, tags: %s", fields, tags)
 
     try:
-        flyer_url = save_file_to_blob(flyer) if flyer else None
-        event_image_url = save_file_to_blob(eventImage) if eventImage else None
-
-        event_data = [{
-            "event_name": eventName,
-            "area": area,
-            "start_date": startDate,
-            "end_date": endDate,
-            "start_at": startTime,
-            "end_at": endTime,
-            "description": description,
-            "information": information,
-            "flyer_url": flyer_url,
-            "event_image_url": event_image_url,
-            "store_id": store_id
-        }]
-        print("event_data:", event_data)
-        print("tags:", tags)
-
-        event_id = crud.insertEvent(event_data)
-        if tags:
-            crud.insertEventTag(event_id, tags)
+        # 検証 → ファイル保存 → イベントとタグを1トランザクションで登録（失敗時は Blob を削除）
+        result = await run_in_threadpool(event_service.register_event, fields, tags, flyer, eventImage)
 
         return JSONResponse(
             status_code=200,
             content={
                 "message": "イベント登録成功！", 
-                "event_id": event_id, 
-                "flyer_url": flyer_url,
-                "event_image_url": event_image_url
+                **result
             }
         )
 
+    except (event_service.EventValidationError, crud.InvalidTagError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=getattr(e, "errors", None) or str(e))
     except Exception as e:
-        print(f"エラー: {e}")
+        logger.exception("イベント登録エラー: %s", e)
         raise HTTPException(status_code=500, detail=f"投稿に失敗しました: {str(e)}")
 
 
+# イベント一括登録（JSON）
+class EventCreateRequest(BaseModel):
+    event_name: str
+    area: Optional[str] = None
+    start_date: date
+    end_date: date
+    start_at: time
+    end_at: time
+    description: str
+    information: Optional[str] = None
+    store_id: int
+    tags: List[str] = []  # tag_id またはタグ名
+    flyer_url: Optional[str] = None
+    event_image_url: Optional[str] = None
+
+class EventBatchRequest(BaseModel):
+    events: List[EventCreateRequest]
+
+@app.post("/events/batch")
+def add_events_batch(data: EventBatchRequest):
+    try:
+        event_ids = event_service.create_events([event.model_dump() for event in data.events])
+        return {"message": f"{len(event_ids)} 件のイベントを登録しました", "event_ids": event_ids}
+    except event_service.EventValidationError as e:
+        raise HTTPException(status_code=400, detail=e.errors)
+    except Exception as e:
+        logger.exception("一括登録エラー: %s", e)
+        raise HTTPException(status_code=500, detail=f"一括登録に失敗しました: {str(e)}")
+
+# イベント一括登録（CSV: 列名は Events の列名 + tags（"|" 区切り））
+@app.post("/events/batch/csv")
+def add_events_batch_csv(file: UploadFile = File(...)):
+    try:
+        event_ids = event_service.create_events(event_service.parse_events_csv(file.file.read()))
+        return {"message": f"{len(event_ids)} 件のイベントを登録しました", "event_ids": event_ids}
+    except event_service.EventValidationError as e:
+        raise HTTPException(status_code=400, detail=e.errors)
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="CSV は UTF-8 で保存してください")
+    except Exception as e:
+        logger.exception("一括登録エラー: %s", e)
+        raise HTTPException(status_code=500, detail=f"一括登録に失敗しました: {str(e)}")
+
+
 @app.get("/users/{user_id}")
-def get_customer(user_id: str):
+def get_customer(user_id: int, claims: Optional[dict] = Depends(auth_tokens.user_claims)):
     user_info = crud.getuserById(user_id)
     if not user_info:
         raise HTTPException(status_code=404, detail="顧客が見つかりません")
     return user_info
 
+# 家族（世帯）単位のポイント残高とお気に入り（どちらも家族全員分を1クエリで集計する）
+@app.get("/users/{user_id}/family/points")
+def get_family_points(user_id: int, claims: Optional[dict] = Depends(auth_tokens.user_claims)):
+    try:
+        family = crud.get_family_point_balances(user_id)
+    except Exception as e:
+        logger.exception("家族のポイント取得エラー: %s", e)
+        raise HTTPException(status_code=500, detail="ポイントの取得に失敗しました")
+    if family is None:
+        raise HTTPException(status_code=404, detail="家族が登録されていません")
+    return family
+
+@app.get("/users/{user_id}/family/favorites")
+def get_family_favorites(user_id: int,
+                         summary: bool = Query(True, description="説明文を先頭だけに切り詰める"),
+                         claims: Optional[dict] = Depends(auth_tokens.user_claims)):
+    try:
+        favorites = crud.get_family_favorite_events(user_id, summary)
+        return ORJSONResponse({"favorites": favorites})
+    except Exception as e:
+        logger.exception("家族のお気に入り取得エラー: %s", e)
+        raise HTTPException(status_code=500, detail="取得に失敗しました")
+
 class PointTransactionRequest(BaseModel):
     user_id: int
     store_id: int
@@ -427,33 +473,127 @@ class PointTransactionRequest(BaseModel):
     type: str
 
 @app.post("/points/transaction")
-def record_transaction(data: PointTransactionRequest):
-    print(data)
+def record_transaction(data: PointTransactionRequest, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    logger.debug("ポイント取引: user_id=%s, store_id=%s, type=%s, point=%s",
+                 data.user_id, data.store_id, data.type, data.point)
+    def handle(session):
+        try:
+            balance = crud.insertUserAndStoreTransaction(data, session=session)
+            if data.type == "earn":
+                return {"message": f"ユーザー：{data.user_id}に{data.point}ポイントを付与しました。", "balance": balance}
+            elif data.type == "use":
+                return {"message": f"ユーザー：{data.user_id}から{data.point}ポイントを減算しました。", "balance": balance}
+        except crud.InsufficientPointsError as e:
+            raise HTTPException(status_code=409, detail={"message": str(e), "balance": e.balance})
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            logger.exception("ポイント取引エラー: %s", e)
+            raise HTTPException(status_code=500, detail=str(e))
+    def after_commit(result):
+        # コミット後に残高を配信する（再送の再生時は呼ばれないので二重に配信しない）
+        pubsub.publish_balance(data.user_id, data.store_id, result["balance"],
+                               data.point if data.type == "earn" else -data.point, data.type)
+    # POS の再送でポイントが二重に付与・減算されないようにする（キーは店舗の端末ごと）
+    return idempotency.run_idempotent("points/transaction", data.store_id, idempotency_key, data, handle,
+                                      after_commit=after_commit)
+
+
+# 残高・取引・新着イベントのプッシュ配信（Server-Sent Events）
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def _sse_response(channels: List[str], initial=None) -> StreamingResponse:
+    if pubsub.hub.is_full():
+        raise HTTPException(status_code=503, detail="接続数が上限に達しています。しばらくしてから再接続してください",
+                            headers={"Retry-After": "5"})
+    return StreamingResponse(pubsub.event_stream(channels, initial),
+                             media_type="text/event-stream", headers=SSE_HEADERS)
+
+@app.get("/stream/users/{user_id}")
+async def stream_user_balance(user_id: int, claims: Optional[dict] = Depends(auth_tokens.user_claims)):
+    """接続直後に現在の残高を1回送り、以降は取引のたびに balance イベントを送る"""
+    if claims is None and not await run_in_threadpool(crud.user_exists, user_id):
+        raise HTTPException(status_code=404, detail="顧客が見つかりません")
+
+    async def initial():
+        balance = await run_in_threadpool(crud.getTotalPointsByUserId, user_id)
+        return [pubsub.format_sse("balance", {"user_id": user_id, "balance": int(balance)})]
+
+    return _sse_response([pubsub.user_channel(user_id)], initial)
+
+@app.get("/stream/stores/{store_id}")
+async def stream_store(store_id: int):
+    """レジ表示用: 店舗での取引（transaction）と新しいイベント（event_created）
+
+    認証なしで購読できるので、取引にはユーザーIDと残高を含めない（pubsub.publish_balance）。
+    """
+    return _sse_response([pubsub.store_channel(store_id)])
+
+@app.get("/stream/events")
+async def stream_events():
+    """全店舗の新しいイベント（event_created）"""
+    return _sse_response([pubsub.EVENTS_CHANNEL])
+
+# 店舗ダッシュボード用のポイント集計（集計テーブルから返す）
+@app.get("/stores/{store_id}/analytics")
+def get_store_analytics(
+    store_id: int,
+    granularity: str = Query("day", pattern="^(day|week)$"),
+    date_from: Optional[date] = Query(None, description="開始日（既定: 30日前）"),
+    date_to: Optional[date] = Query(None, description="終了日（既定: 今日）"),
+):
+    # 集計の日は ROLLUP_UTC_OFFSET_HOURS（既定は日本時間）で区切っているので、今日も同じ基準にする
+    date_to = date_to or rollups.today()
+    date_from = date_from or date_to - timedelta(days=30)
+    if date_from > date_to:
+        raise HTTPException(status_code=400, detail="開始日が終了日より後になっています")
     try:
-        crud.insertUserAndStoreTransaction(data)
-        if data.type == "earn":
-            return {"message": f"ユーザー：{data.user_id}に{data.point}ポイントを付与しました。"}
-        elif data.type == "use":
-            return {"message": f"ユーザー：{data.user_id}から{data.point}ポイントを減算しました。"}
+        buckets = crud.get_store_analytics(store_id, granularity, date_from, date_to)
+        return {
+            "store_id": store_id,
+            "granularity": granularity,
+            "date_from": date_from.strftime("%Y-%m-%d"),
+            "date_to": date_to.strftime("%Y-%m-%d"),
+            "totals": {
+                "points_granted": sum(b["points_granted"] for b in buckets),
+                "points_collected": sum(b["points_collected"] for b in buckets),
+                "transactions": sum(b["transactions"] for b in buckets),
+            },
+            "buckets": buckets,
+        }
     except Exception as e:
-        print(f"エラー: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.exception("店舗集計エラー: %s", e)
+        raise HTTPException(status_code=500, detail="集計の取得に失敗しました")
 
 
 @app.get("/tags")
 def get_tags():
-    return crud.get_all_tags()
+    tags, age = resilience.read_cache.get(("tags",), crud.get_all_tags)
+    return ORJSONResponse(tags, headers=resilience.cache_headers(age))
 
 # recommendation.py からルーターをインポート
 from recommendation import router as recommendation_router
+import feature_store
+import popularity
+import geo
+import event_search
 
 # アプリにルーターを登録
 app.include_router(recommendation_router)
 
+# 人気度の閲覧数書き込み・人気フィード更新（ワーカーごとに起動）
+@app.on_event("startup")
+def start_popularity_scheduler():
+    popularity.start_scheduler()
+
+@app.on_event("shutdown")
+def flush_popularity_views():
+    popularity.flush_views()
+
 # ルートのパス設定を出力（デバッグ用）
-print("Available routes:")
-for route in app.routes:
-    print(f"{route.path} [{', '.join(route.methods)}]")
+if logger.isEnabledFor(logging.DEBUG):
+    for route in app.routes:
+        logger.debug("route: %s [%s]", route.path, ", ".join(getattr(route, "methods", None) or []))
 
 
 class FavoriteEvent(BaseModel):
@@ -465,57 +605,169 @@ class FavoriteEvent(BaseModel):
     date: str
 
 @app.post("/favorites/{user_id}/{event_id}")
-def add_favorite(user_id: int, event_id: int):
-    try:
-        crud.insert_favorite_event(user_id, event_id)
-        return {"message": "お気に入りに追加しました"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+def add_favorite(user_id: int, event_id: int, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+                 claims: Optional[dict] = Depends(auth_tokens.user_claims)):
+    def handle(session):
+        try:
+            crud.insert_favorite_event(user_id, event_id, session=session)
+            return {"message": "お気に入りに追加しました"}
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    # レコメンド用スナップショットのお気に入り行列を更新させる
+    return idempotency.run_idempotent("favorites/add", user_id, idempotency_key,
+                                      {"user_id": user_id, "event_id": event_id}, handle,
+                                      after_commit=lambda result: feature_store.invalidate())
 
 
 @app.delete("/favorites/{user_id:int}/{event_id:int}")
-def remove_favorite(user_id: int, event_id: int):
+def remove_favorite(user_id: int, event_id: int, claims: Optional[dict] = Depends(auth_tokens.user_claims)):
     try:
         crud.delete_favorite_event(user_id, event_id)
+        feature_store.invalidate()
         return {"message": "お気に入りを解除しました"}
     except Exception as e:
-        print("お気に入り解除エラー:", e)
+        logger.exception("お気に入り解除エラー: %s", e)
         raise HTTPException(status_code=500, detail="解除に失敗しました")
 
 @app.get("/favorites/{user_id}")
-def get_favorite_events(user_id: int):
+def get_favorite_events(user_id: int, claims: Optional[dict] = Depends(auth_tokens.user_claims)):
     try:
         favorites = crud.get_favorite_events(user_id)
-        return {"favorites": favorites}
+        return ORJSONResponse({"favorites": favorites})
     except Exception as e:
-        print("お気に入り取得エラー:", e)
+        logger.exception("お気に入り取得エラー: %s", e)
         raise HTTPException(status_code=500, detail="取得に失敗しました")
 
 # イベント検索
 @app.get("/events/search")
-def search_events(keyword: str = '', date: str = '', tags: str = ''):
+def search_events(keyword: str = '', date: str = '', tags: str = '',
+                  summary: bool = Query(False, description="説明文を先頭だけに切り詰める（一覧表示用）"),
+                  tag_mode: str = Query("or", pattern="^(and|or)$", description="複数タグを すべて含む(and) / いずれかを含む(or)"),
+                  area: str = '',
+                  offset: int = Query(0, ge=0),
+                  limit: Optional[int] = Query(None, ge=1, le=500)):
+    try:
+        on_date = datetime.strptime(date, "%Y-%m-%d").date() if date else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="date は YYYY-MM-DD で指定してください")
     try:
-        result = crud.search_events(keyword, date, tags)
-        return {"events": result}
+        # 絞り込みとファセット件数はメモリ上のビットセット索引で計算し、表示する分だけ DB から読む
+        tag_list = [t.strip() for t in tags.split(',') if t.strip()]
+        event_ids, facets = event_search.search(keyword.strip(), on_date, tag_list, tag_mode, area or None)
+        page = event_ids[offset:offset + limit] if limit else event_ids[offset:]
+        result = crud.get_events_by_ids(page, summary)
+        return ORJSONResponse({"events": result, "total": len(event_ids), "facets": facets})
     except Exception as e:
-        print("イベント検索エラー:", e)
+        logger.exception("イベント検索エラー: %s", e)
         raise HTTPException(status_code=500, detail="検索に失敗しました")
 
 @app.get("/events/upcoming")
-def get_upcoming_events():
+def get_upcoming_events(summary: bool = Query(False, description="説明文を先頭だけに切り詰める（一覧表示用）")):
+    try:
+        # 読み取りキャッシュ経由（DB の障害中は最後に取れた一覧を返す）
+        events, age = resilience.read_cache.get(("events/upcoming", summary),
+                                                lambda: crud.get_upcoming_events(summary))
+        return ORJSONResponse({"events": events}, headers=resilience.cache_headers(age))
+    except Exception as e:
+        logger.exception("イベント一覧取得エラー: %s", e)
+        raise HTTPException(status_code=500, detail="イベント取得に失敗しました")
+
+# カレンダー表示用の期間指定（1回に取れる日数の上限）
+MAX_CALENDAR_DAYS = 93
+
+@app.get("/events/calendar")
+def get_calendar_events(
+    date_from: date = Query(..., alias="from", description="開始日 YYYY-MM-DD"),
+    date_to: date = Query(..., alias="to", description="終了日 YYYY-MM-DD"),
+    summary: bool = Query(True, description="説明文を先頭だけに切り詰める"),
+):
+    """開催期間が [from, to] と重なるイベント（複数日のイベントは期間内のどの日にかかっていても含む）"""
+    if date_from > date_to:
+        raise HTTPException(status_code=400, detail="開始日が終了日より後になっています")
+    if (date_to - date_from).days >= MAX_CALENDAR_DAYS:
+        raise HTTPException(status_code=400, detail=f"期間は {MAX_CALENDAR_DAYS} 日以内で指定してください")
     try:
-        events = crud.get_upcoming_events()
-        return {"events": events}
+        events, age = resilience.read_cache.get(("events/calendar", date_from, date_to, summary),
+                                                lambda: crud.get_events_in_range(date_from, date_to, summary))
+        return ORJSONResponse({
+            "from": date_from.isoformat(),
+            "to": date_to.isoformat(),
+            "events": events,
+        }, headers=resilience.cache_headers(age))
     except Exception as e:
-        print(f"エラー: {e}")
+        logger.exception("カレンダー取得エラー: %s", e)
+        raise HTTPException(status_code=500, detail="イベント取得に失敗しました")
+
+@app.get("/events/now")
+def get_events_now(
+    at: Optional[datetime] = Query(None, description="この時刻に開催中のイベント（既定: 現在時刻）"),
+    summary: bool = Query(True, description="説明文を先頭だけに切り詰める"),
+):
+    at = at or datetime.now()
+    try:
+        events = crud.get_events_active_at(at.replace(tzinfo=None), summary)
+        return ORJSONResponse({"at": at.strftime("%Y-%m-%dT%H:%M:%S"), "events": events})
+    except Exception as e:
+        logger.exception("開催中イベント取得エラー: %s", e)
+        raise HTTPException(status_code=500, detail="イベント取得に失敗しました")
+
+# 近くのイベント（開催中・開催予定）。位置は lat/lon、郵便番号、ユーザーの登録住所のいずれかで指定する
+@app.get("/events/nearby")
+def get_nearby_events(
+    lat: Optional[float] = Query(None, ge=-90, le=90),
+    lon: Optional[float] = Query(None, ge=-180, le=180),
+    postal_code: Optional[str] = Query(None, description="郵便番号（例: 812-0011）"),
+    user_id: Optional[int] = Query(None, description="登録住所の郵便番号を使う"),
+    radius_km: float = Query(5.0, gt=0, le=50),
+    limit: int = Query(20, ge=1, le=100),
+    summary: bool = Query(True, description="説明文を先頭だけに切り詰める"),
+    authorization: Optional[str] = Header(None),
+):
+    from_user_address = False
+    if lat is not None and lon is not None:
+        origin = (lat, lon)
+    elif postal_code:
+        origin = geo.get_postal_location(postal_code)
+    elif user_id is not None:
+        # 登録住所を使うので、他の per-user のエンドポイントと同じく本人のトークンを確かめる
+        auth_tokens.user_claims(user_id, authorization)
+        origin = geo.get_user_location(user_id)
+        from_user_address = True
+    else:
+        raise HTTPException(status_code=400, detail="lat/lon、postal_code、user_id のいずれかを指定してください")
+    if origin is None:
+        raise HTTPException(status_code=404, detail="位置を特定できませんでした")
+
+    try:
+        nearby = geo.find_nearby_events(origin[0], origin[1], radius_km, limit)
+        distances = dict(nearby)
+        events = crud.get_events_by_ids([event_id for event_id, _ in nearby], summary)
+        for event in events:
+            event["distance_km"] = round(distances[event["id"]], 2)
+        return ORJSONResponse({
+            # 登録住所の位置は返さない（呼び出し元が指定した位置だけを返す）
+            "origin": None if from_user_address else {"lat": origin[0], "lon": origin[1]},
+            "radius_km": radius_km,
+            "events": events,
+        })
+    except Exception as e:
+        logger.exception("近くのイベント検索エラー: %s", e)
         raise HTTPException(status_code=500, detail="イベント取得に失敗しました")
 
 @app.get("/event/{event_id}")
 def get_event(event_id: int = Path(..., description="イベントID")):
-    try:
+    def load():
         event = crud.get_event_detail_by_id(event_id)
         if not event:
+            # 見つからない結果はキャッシュしない（登録直後のイベントもすぐ引ける）
             raise HTTPException(status_code=404, detail="イベントが見つかりません")
         return event
+
+    try:
+        event, age = resilience.read_cache.get(("event", event_id), load)
+        popularity.record_view(event_id)
+        return ORJSONResponse(event, headers=resilience.cache_headers(age))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"取得に失敗しました: {str(e)}")
@@ -0,0 +1,132 @@
+# auth_tokens.py
+"""
+署名付きセッショントークン（JWT / HS256）
+
+ログイン・メール認証が成功したときに発行し、以降のリクエストでは
+Authorization: Bearer <token> の署名と有効期限だけをローカルで検証する（DB を引かない）。
+
+鍵の設定（カンマ区切りの kid:secret。先頭の鍵で署名し、すべての鍵で検証する）:
+    AUTH_TOKEN_KEYS=2025b:新しい秘密鍵,2025a:古い秘密鍵
+鍵を入れ替えるときは新しい鍵を先頭に追加し、古い鍵は AUTH_TOKEN_TTL が過ぎてから外す。
+
+AUTH_TOKEN_REQUIRED=1 にするとトークンのないリクエストを 401 にする。
+既定ではトークンのない古いクライアントも通し、その場合だけ従来どおり DB でユーザーの存在を確認する。
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import Header, HTTPException
+
+from logging_config import get_logger
+
+logger = get_logger(__name__)
+
+AUTH_TOKEN_TTL = int(os.getenv("AUTH_TOKEN_TTL", str(7 * 24 * 60 * 60)))
+AUTH_TOKEN_REQUIRED = os.getenv("AUTH_TOKEN_REQUIRED", "0") == "1"
+# サーバー間の時計のずれの許容（秒）
+CLOCK_SKEW = 30
+
+
+class InvalidTokenError(ValueError):
+    """署名・形式・有効期限のいずれかが不正なトークン"""
+
+
+def load_keys(value: Optional[str]) -> List[Tuple[str, bytes]]:
+    keys = []
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+        kid, sep, secret = item.strip().partition(":")
+        if not sep or not kid or not secret:
+            raise ValueError("AUTH_TOKEN_KEYS は kid:secret をカンマ区切りで指定してください")
+        keys.append((kid, secret.encode("utf-8")))
+    return keys
+
+_keys = load_keys(os.getenv("AUTH_TOKEN_KEYS"))
+if not _keys:
+    # 鍵がないときはプロセス起動ごとの一時鍵（preload_app なのでワーカー間では共有される）
+    logger.warning("AUTH_TOKEN_KEYS が未設定のため一時鍵を使います（再起動で発行済みトークンは無効になります）")
+    _keys = [("ephemeral", secrets.token_bytes(32))]
+_keys_by_id: Dict[str, bytes] = dict(_keys)
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def _sign(key: bytes, signing_input: str) -> bytes:
+    return hmac.new(key, signing_input.encode("ascii"), hashlib.sha256).digest()
+
+
+def issue_token(user_id: int, ttl: int = AUTH_TOKEN_TTL) -> str:
+    kid, key = _keys[0]
+    now = int(time.time())
+    header = {"alg": "HS256", "typ": "JWT", "kid": kid}
+    payload = {"sub": str(user_id), "iat": now, "exp": now + ttl}
+    signing_input = ".".join(
+        _b64encode(json.dumps(part, separators=(",", ":")).encode("utf-8")) for part in (header, payload)
+    )
+    return f"{signing_input}.{_b64encode(_sign(key, signing_input))}"
+
+def verify_token(token: str) -> Dict:
+    """署名と有効期限を検証してクレームを返す"""
+    try:
+        header_b64, payload_b64, signature_b64 = token.split(".")
+        header = json.loads(_b64decode(header_b64))
+        key = _keys_by_id.get(header.get("kid"))
+        if header.get("alg") != "HS256" or key is None:
+            raise InvalidTokenError("未知の鍵またはアルゴリズムです")
+        expected = _sign(key, f"{header_b64}.{payload_b64}")
+        if not hmac.compare_digest(expected, _b64decode(signature_b64)):
+            raise InvalidTokenError("署名が一致しません")
+        claims = json.loads(_b64decode(payload_b64))
+    except InvalidTokenError:
+        raise
+    except (ValueError, TypeError, AttributeError) as e:
+        raise InvalidTokenError(f"トークンの形式が不正です: {e}")
+    if not isinstance(claims, dict) or "sub" not in claims:
+        raise InvalidTokenError("トークンの形式が不正です")
+    if int(claims.get("exp", 0)) + CLOCK_SKEW < time.time():
+        raise InvalidTokenError("トークンの有効期限が切れています")
+    return claims
+
+def token_response(user_id: int) -> Dict:
+    """認証成功のレスポンスに含めるトークン情報"""
+    return {"token": issue_token(user_id), "token_type": "Bearer", "expires_in": AUTH_TOKEN_TTL}
+
+
+def _bearer(authorization: Optional[str]) -> Optional[str]:
+    if not authorization:
+        return None
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        raise HTTPException(status_code=401, detail="Authorization ヘッダーの形式が不正です",
+                            headers={"WWW-Authenticate": "Bearer"})
+    return token.strip()
+
+def user_claims(user_id: int, authorization: Optional[str] = Header(None)) -> Optional[Dict]:
+    """パスの user_id に対するトークンを検証する依存関数
+
+    トークンが有効で本人のものならクレームを返す（この場合ユーザーの存在確認は不要）。
+    トークンがなく AUTH_TOKEN_REQUIRED でもなければ None を返すので、呼び出し側で従来の確認をする。
+    """
+    token = _bearer(authorization)
+    if token is None:
+        if AUTH_TOKEN_REQUIRED:
+            raise HTTPException(status_code=401, detail="ログインが必要です", headers={"WWW-Authenticate": "Bearer"})
+        return None
+    try:
+        claims = verify_token(token)
+    except InvalidTokenError as e:
+        raise HTTPException(status_code=401, detail=str(e), headers={"WWW-Authenticate": "Bearer"})
+    if claims["sub"] != str(user_id):
+        raise HTTPException(status_code=403, detail="他のユーザーの情報にはアクセスできません")
+    return claims
@@ -0,0 +1,146 @@
+# bench_logging.py
+"""
+リクエストごとのログ出力のベンチマーク（DB不要、合成データ）
+
+イベント登録・ポイント取引・一覧取得で出していた print（フォーム・event_data の dict・ORM の repr を
+同期で stdout に書く）と、logging_config の非同期ロガーで同じ情報を出した場合の
+「1リクエストあたりの処理 + ログ」のスループットを、スレッドプールで並列に流して比べる。
+
+    print          旧: 毎リクエスト print（PYTHONUNBUFFERED=1 と同じく1行ごとに書き込む）
+    log-info       新: 同じ内容を INFO でキューに入れる（書き込みはリスナースレッド）
+    log-debug-off  新: ホットパスのログは DEBUG（本番の LOG_LEVEL=INFO では呼び出しだけ）
+    log-sampled    新: LOG_LEVEL=DEBUG で 1% だけ出す（調査時の設定）
+
+--write-latency-us で1回の書き込みに待ち時間を足すと、ログ基盤へのパイプが詰まっているときを再現できる
+（print はリクエストのスレッドが待たされ、非同期ロガーはリスナーだけが待つ）。
+
+使い方:
+    python bench_logging.py --requests 20000 --threads 8 --output /tmp/bench.log
+    python bench_logging.py --write-latency-us 50
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, time as dt_time
+from typing import Callable, Dict
+
+import orjson
+
+import logging_config
+
+
+class FakeEvent:
+    """ORM のインスタンスの代わり（print で repr が作られる）"""
+
+    def __init__(self, i: int):
+        self.event_id = i
+        self.event_name = f"イベント {i}"
+        self.start_date = date(2025, 4, 1)
+        self.description = "イベントの説明です。" * 20
+
+    def __repr__(self):
+        return f"<Event(event_id={self.event_id}, event_name={self.event_name!r}, description={self.description!r})>"
+
+
+class SlowSink:
+    """書き込みごとに待つ出力先（stdout の先のパイプが詰まっている状態）"""
+
+    def __init__(self, f, latency: float):
+        self.f = f
+        self.latency = latency
+
+    def write(self, text: str) -> int:
+        time.sleep(self.latency)
+        return self.f.write(text)
+
+    def flush(self):
+        self.f.flush()
+
+
+def make_payload(i: int) -> Dict:
+    return {
+        "event_name": f"イベント {i}", "area": "福岡市中央区", "start_date": "2025-04-01",
+        "end_date": "2025-04-03", "start_at": dt_time(10, 0), "end_at": dt_time(17, 0),
+        "description": "イベントの説明です。" * 20, "information": "ポイント2倍", "store_id": i % 50,
+        "email": f"user{i}@example.com",
+    }
+
+ROWS = [FakeEvent(i) for i in range(20)]
+
+def handle_request(i: int) -> bytes:
+    """リクエストの本体の代わり（一覧の直列化）"""
+    return orjson.dumps([{"id": e.event_id, "title": e.event_name, "date": e.start_date} for e in ROWS])
+
+
+def request_with_print(i: int):
+    payload = make_payload(i)
+    print("Received values:", payload)
+    print("event_data:", payload)
+    body = handle_request(i)
+    print(f"Query result: {ROWS}")
+    return body
+
+def make_request_with_logger(level: int) -> Callable[[int], bytes]:
+    logger = logging.getLogger("bench")
+
+    def request(i: int):
+        payload = make_payload(i)
+        logger.log(level, "Received values: %s", payload)
+        logger.log(level, "event_data: %s", payload)
+        body = handle_request(i)
+        logger.log(level, "Query result: %s", ROWS)
+        return body
+    return request
+
+
+def run(request: Callable[[int], bytes], requests: int, threads: int) -> float:
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        for _ in executor.map(request, range(requests), chunksize=64):
+            pass
+    return requests / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="print と非同期ロガーのスループット比較")
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--output", default=None, help="ログの書き込み先（既定は一時ファイル）")
+    parser.add_argument("--write-latency-us", type=float, default=0, help="1回の書き込みに足す待ち時間（マイクロ秒）")
+    args = parser.parse_args()
+
+    output_path = args.output or os.path.join(tempfile.gettempdir(), "bench_logging.log")
+    # コンテナの stdout（PYTHONUNBUFFERED=1）と同じく、1行ごとに書き込む
+    output = open(output_path, "w", encoding="utf-8", buffering=1)
+    sink = SlowSink(output, args.write_latency_us / 1e6) if args.write_latency_us else output
+
+    real_stdout = sys.stdout
+    sys.stdout = sink
+    try:
+        old = run(request_with_print, args.requests, args.threads)
+    finally:
+        sys.stdout = real_stdout
+
+    handler = logging_config.setup_logging(level="INFO", stream=sink)
+    sampler = next(f for f in handler.filters if isinstance(f, logging_config.SamplingFilter))
+    results = {"print": old}
+    results["log-info"] = run(make_request_with_logger(logging.INFO), args.requests, args.threads)
+    handler.stop()  # キューを書き切ってから次を測る
+    results["log-debug-off"] = run(make_request_with_logger(logging.DEBUG), args.requests, args.threads)
+    logging.getLogger().setLevel(logging.DEBUG)
+    sampler.every = 100
+    results["log-sampled"] = run(make_request_with_logger(logging.DEBUG), args.requests, args.threads)
+    handler.stop()
+    output.close()
+
+    for name, throughput in results.items():
+        print(f"{name:14s} {throughput:10,.0f} req/s  (print の {throughput / old:5.2f} 倍)")
+    print(f"dropped={handler.dropped}  output={output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+# bench_serialization.py
+"""
+一覧系レスポンスの直列化のマイクロベンチマーク（DB不要、合成データ）
+
+エンドポイントごとに、旧方式と新方式で「行 → レスポンスのバイト列」にかかる時間を比べる。
+- 旧: ORM 風オブジェクトから dict を作り strftime、jsonable_encoder + 標準 json（レコメンドは Pydantic 検証も）
+- 新: SQL から返るタプル（日付は DATE_FORMAT 済みの文字列）から dict を作り、ORJSONResponse で直接直列化
+
+使い方:
+    python bench_serialization.py --rows 1000 --repeat 200
+"""
+import argparse
+import random
+import time
+from datetime import date, timedelta
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+from recommendation import EventRecommendation, RecommendationResponse
+
+TAG_NAMES = ["子ども向け", "グルメ", "音楽", "スポーツ", "地域", "季節", "ワークショップ", "無料"]
+
+
+def make_rows(n: int, seed: int = 42) -> List[SimpleNamespace]:
+    rng = random.Random(seed)
+    start = date(2025, 4, 1)
+    return [
+        SimpleNamespace(
+            event_id=i,
+            event_name=f"イベント {i}",
+            start_date=start + timedelta(days=rng.randint(0, 365)),
+            area=rng.choice(["福岡市中央区", "福岡市博多区", "北九州市", "久留米市"]),
+            description="イベントの説明です。" * rng.randint(5, 40),
+            event_image_url=f"https://example.blob.core.windows.net/images/{i}.jpg",
+            tags=rng.sample(TAG_NAMES, rng.randint(1, 3)),
+        )
+        for i in range(n)
+    ]
+
+
+# ───── 旧方式 ─────
+def old_upcoming(rows):
+    events = [{
+        "id": e.event_id,
+        "title": e.event_name,
+        "date": e.start_date.strftime("%Y-%m-%d"),
+        "area": e.area,
+        "imageUrl": e.event_image_url,
+        "description": e.description,
+        "tags": list(e.tags),
+    } for e in rows]
+    return JSONResponse(content=jsonable_encoder({"events": events})).body
+
+def old_favorites(rows):
+    favorites = [{
+        "event_id": r.event_id,
+        "event_name": r.event_name,
+        "area": r.area,
+        "date": r.start_date.strftime("%Y/%m/%d"),
+        "image_url": r.event_image_url,
+    } for r in rows]
+    return JSONResponse(content=jsonable_encoder({"favorites": favorites})).body
+
+def old_recommendations(rows):
+    response = RecommendationResponse(events=[EventRecommendation(
+        id=str(e.event_id),
+        imageUrl=e.event_image_url,
+        area=e.area,
+        title=e.event_name,
+        date=e.start_date.strftime("%Y/%m/%d"),
+        tags=["おすすめ"] + e.tags,
+        description=e.description,
+    ) for e in rows], similarUsers=list(range(20)))
+    return JSONResponse(content=jsonable_encoder(response)).body
+
+
+# ───── 新方式（SQL のタプル → dict → orjson）─────
+def as_tuples(rows, date_format: str):
+    return [
+        (e.event_id, e.event_name, e.start_date.strftime(date_format), e.area,
+         e.description, e.event_image_url, e.tags)
+        for e in rows
+    ]
+
+def new_upcoming(tuples):
+    return ORJSONResponse({"events": [{
+        "id": event_id,
+        "title": event_name,
+        "date": start_date,
+        "area": area,
+        "imageUrl": image_url,
+        "description": description,
+        "tags": tags,
+    } for event_id, event_name, start_date, area, description, image_url, tags in tuples]}).body
+
+def new_favorites(tuples):
+    return ORJSONResponse({"favorites": [{
+        "event_id": event_id,
+        "event_name": event_name,
+        "area": area,
+        "date": start_date,
+        "image_url": image_url,
+    } for event_id, event_name, start_date, area, _, image_url, _ in tuples]}).body
+
+def new_recommendations(tuples):
+    return ORJSONResponse({"events": [{
+        "id": str(event_id),
+        "imageUrl": image_url,
+        "area": area,
+        "title": event_name,
+        "date": start_date,
+        "tags": ["おすすめ"] + tags,
+        "description": description,
+        "points": None,
+    } for event_id, event_name, start_date, area, description, image_url, tags in tuples],
+        "similarUsers": list(range(20))}).body
+
+
+def timeit(func: Callable, arg, repeat: int) -> float:
+    """1回あたりのミリ秒（最速値）"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(arg)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="一覧レスポンスの直列化ベンチマーク")
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=100)
+    args = parser.parse_args(argv)
+
+    rows = make_rows(args.rows)
+    cases: Dict[str, tuple] = {
+        "/events/upcoming, /events/search": (old_upcoming, rows, new_upcoming, as_tuples(rows, "%Y-%m-%d")),
+        "/favorites/{user_id}": (old_favorites, rows, new_favorites, as_tuples(rows, "%Y/%m/%d")),
+        "/api/recommendations/{user_id}": (old_recommendations, rows, new_recommendations,
+                                           as_tuples(rows, "%Y/%m/%d")),
+    }
+
+    print(f"rows={args.rows} repeat={args.repeat}")
+    print(f"{'endpoint':36} {'old ms':>9} {'new ms':>9} {'speedup':>8} {'bytes':>9}")
+    for name, (old, old_arg, new, new_arg) in cases.items():
+        old_ms = timeit(old, old_arg, args.repeat)
+        new_ms = timeit(new, new_arg, args.repeat)
+        size = len(new(new_arg))
+        print(f"{name:36} {old_ms:9.2f} {new_ms:9.2f} {old_ms / new_ms:7.1f}x {size:9,d}")
+
+
+if __name__ == "__main__":
+    main()
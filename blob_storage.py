@@ -0,0 +1,182 @@
+# blob_storage.py
+"""
+Azure Blob Storage へのファイル保存・削除と、どのイベントからも参照されていない Blob の掃除
+
+- クライアントには接続・読み取りのタイムアウトを設定し、アップロード・削除は resilience の
+  バルクヘッドとサーキットブレーカーを通す（Blob の障害中は待たずに DependencyUnavailableError）
+
+掃除の実行例:
+    python blob_storage.py gc --older-than-hours 24 --dry-run
+"""
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, Optional, Set
+
+from azure.storage.blob import BlobServiceClient
+from azure.storage.blob import ContentSettings
+from dotenv import load_dotenv
+
+import resilience
+from logging_config import get_logger
+
+load_dotenv()
+
+logger = get_logger(__name__)
+
+# Azure Blob Storageの接続設定
+ACCOUNT_NAME = os.getenv('AZURE_STORAGE_ACCOUNT_NAME')
+ACCOUNT_KEY = os.getenv('AZURE_STORAGE_ACCOUNT_KEY')
+CONTAINER_NAME = os.getenv("AZURE_STORAGE_CONTAINER_NAME")
+CONNECTION_STRING = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+
+CONTENT_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".pdf": "application/pdf",
+    ".gif": "image/gif",
+}
+
+_container_client = None
+
+
+def _is_blob_failure(exc: BaseException) -> bool:
+    """接続できない・5xx など Blob 側の障害か（404 や権限エラーは数えない）"""
+    status = getattr(exc, "status_code", None)
+    return status is None or status >= 500
+
+blob_dependency = resilience.register(
+    "blob",
+    max_concurrent=int(os.getenv("BLOB_MAX_CONCURRENCY", "8")),
+    is_failure=_is_blob_failure,
+)
+
+
+def get_container_client():
+    """コンテナクライアントを返す（存在確認・作成はプロセスで1回だけ行う）"""
+    global _container_client
+    if _container_client is not None:
+        return _container_client
+
+    blob_service_client = BlobServiceClient.from_connection_string(
+        CONNECTION_STRING,
+        connection_timeout=resilience.BLOB_CONNECT_TIMEOUT,
+        read_timeout=resilience.BLOB_READ_TIMEOUT,
+    )
+    container_client = blob_service_client.get_container_client(CONTAINER_NAME)
+    try:
+        container_client.get_container_properties()
+    except Exception as e:
+        if 'ContainerNotFound' in str(e):
+            logger.info("コンテナ '%s' が見つかりません。作成します。", CONTAINER_NAME)
+            container_client.create_container()
+            logger.info("コンテナ '%s' を作成しました。", CONTAINER_NAME)
+        else:
+            raise e
+    _container_client = container_client
+    return container_client
+
+def blob_url(blob_name: str) -> str:
+    return f"https://{ACCOUNT_NAME}.blob.core.windows.net/{CONTAINER_NAME}/{blob_name}"
+
+def blob_name_from_url(url: str) -> Optional[str]:
+    """このコンテナの Blob URL なら Blob 名を返す"""
+    prefix = blob_url("")
+    return url[len(prefix):] if url and url.startswith(prefix) else None
+
+def upload_file(file) -> str:
+    """UploadFile を Blob に保存して URL を返す"""
+    try:
+        # ユニークなファイル名を生成
+        unique_filename = f"{uuid.uuid4()}_{file.filename}"
+
+        # ファイルタイプに応じたContent-Typeを設定
+        content_type = CONTENT_TYPES.get(os.path.splitext(file.filename.lower())[1])
+
+        # ファイルポインタを先頭に戻して内容を読み込む
+        file.file.seek(0)
+        file_content = file.file.read()
+
+        # Content-Typeを指定してBlobにアップロード
+        with blob_dependency.guard():
+            get_container_client().upload_blob(
+                unique_filename,
+                file_content,
+                overwrite=True,
+                content_settings=ContentSettings(content_type=content_type)
+            )
+
+        url = blob_url(unique_filename)
+        logger.info("ファイル '%s' をアップロードしました。URL: %s", file.filename, url)
+        return url
+    except Exception as e:
+        logger.error("Error uploading to Azure Blob Storage: %s", e)
+        raise e
+
+def delete_blobs(urls: Iterable[Optional[str]]):
+    """アップロード済みの Blob を削除する（DB登録に失敗したときの後始末）
+
+    削除に失敗したものは gc_orphan_blobs で後から回収される。
+    """
+    for url in urls:
+        name = blob_name_from_url(url)
+        if not name:
+            continue
+        try:
+            with blob_dependency.guard():
+                get_container_client().delete_blob(name)
+            logger.info("孤立した Blob を削除しました: %s", name)
+        except Exception as e:
+            logger.warning("Blob の削除に失敗しました（GCで回収します）: %s: %s", name, e)
+
+
+def get_referenced_urls(session) -> Set[str]:
+    """イベントから参照されている Blob URL を返す"""
+    from sqlalchemy import select, union
+    from db_control.mymodels_MySQL import Event
+
+    rows = session.execute(union(
+        select(Event.flyer_url).where(Event.flyer_url.is_not(None)),
+        select(Event.event_image_url).where(Event.event_image_url.is_not(None)),
+    )).all()
+    return {row[0] for row in rows}
+
+def gc_orphan_blobs(older_than: timedelta = timedelta(hours=24), dry_run: bool = False) -> List[str]:
+    """どのイベントからも参照されていない古い Blob を削除する
+
+    アップロード直後でまだ DB 登録前のものを消さないよう、older_than より新しい Blob は残す。
+    """
+    from db_control.crud import session_scope
+
+    with session_scope() as session:
+        referenced = {blob_name_from_url(url) for url in get_referenced_urls(session)}
+
+    threshold = datetime.now(timezone.utc) - older_than
+    orphans = [
+        blob.name for blob in get_container_client().list_blobs()
+        if blob.name not in referenced and blob.last_modified and blob.last_modified < threshold
+    ]
+    for name in orphans:
+        if dry_run:
+            logger.info("[dry-run] 削除対象: %s", name)
+        else:
+            with blob_dependency.guard():
+                get_container_client().delete_blob(name)
+            logger.info("孤立した Blob を削除しました: %s", name)
+    return orphans
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Blob Storage の保守コマンド")
+    sub = parser.add_subparsers(dest="command", required=True)
+    gc = sub.add_parser("gc", help="イベントから参照されていない Blob を削除する")
+    gc.add_argument("--older-than-hours", type=float, default=24)
+    gc.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "gc":
+        removed = gc_orphan_blobs(timedelta(hours=args.older_than_hours), dry_run=args.dry_run)
+        print(f"{len(removed)} 件の孤立 Blob を{'検出' if args.dry_run else '削除'}しました")
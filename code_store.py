@@ -0,0 +1,223 @@
+# code_store.py
+"""
+メール認証コードの発行・検証（Users テーブルに書かない）
+
+- コードは (用途, メールアドレス) ごとに1つ。再送すると前のコードは無効になる
+- CODE_TTL 秒で失効し、検証に成功したコードはその場で消す（1回限り）
+- 間違えられるのは CODE_MAX_ATTEMPTS 回まで。超えたらコードを消し、再送を求める
+- 保存するのはコードの HMAC だけで、比較は hmac.compare_digest（定数時間）で行う
+- 発行時にユーザーIDも一緒に保存するので、検証は主キー検索1回で済む（Users を引き直さない）
+
+保存先（CODE_STORE_BACKEND）:
+    table   VerificationCodes テーブル（既定。gunicorn の複数ワーカー間で共有される）
+    memory  ワーカーのメモリ（ワーカーが1つのときや開発用。別ワーカーに届いた検証は失敗する）
+
+期限切れ行の削除:
+    python code_store.py purge
+"""
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+import identity
+from db_control.crud import session_scope
+from db_control.mymodels_MySQL import VerificationCode
+from logging_config import get_logger
+
+logger = get_logger(__name__)
+
+CODE_STORE_BACKEND = os.getenv("CODE_STORE_BACKEND", "table")
+CODE_TTL = int(os.getenv("CODE_TTL", "300"))
+CODE_MAX_ATTEMPTS = int(os.getenv("CODE_MAX_ATTEMPTS", "5"))
+# コードの HMAC の鍵。未設定ならプロセス起動ごとの一時鍵（preload_app なのでワーカー間では共有される）
+_secret = (os.getenv("CODE_STORE_SECRET") or "").encode("utf-8") or secrets.token_bytes(32)
+
+
+class CodeVerificationError(ValueError):
+    """認証コードの検証失敗（reason: not_found / expired / mismatch / too_many_attempts）"""
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+def generate_code() -> str:
+    """6桁の認証コード（secrets で生成する）"""
+    return f"{secrets.randbelow(10 ** 6):06d}"
+
+def normalize_identifier(value: str) -> str:
+    return identity.normalize_email(value) or ""
+
+def _code_hash(purpose: str, identifier: str, code: str) -> str:
+    message = f"{purpose}\n{identifier}\n{code.strip()}".encode("utf-8")
+    return hmac.new(_secret, message, hashlib.sha256).hexdigest()
+
+def _check(entry_hash: str, attempts: int, expired: bool, purpose: str, identifier: str, code: str):
+    """検証の共通部分。一致すれば None、失敗なら CodeVerificationError を返す（送出は呼び出し側）"""
+    if expired:
+        return CodeVerificationError("expired", "認証コードの有効期限が切れています")
+    if attempts >= CODE_MAX_ATTEMPTS:
+        return CodeVerificationError("too_many_attempts", "認証コードの入力回数が上限に達しました。コードを再送してください")
+    if not hmac.compare_digest(entry_hash, _code_hash(purpose, identifier, code)):
+        if attempts + 1 >= CODE_MAX_ATTEMPTS:
+            return CodeVerificationError("too_many_attempts",
+                                         "認証コードが一致しません。入力回数が上限に達したため、コードを再送してください")
+        return CodeVerificationError("mismatch", "認証コードが一致しません")
+    return None
+
+def _not_found() -> CodeVerificationError:
+    return CodeVerificationError("not_found", "認証コードが発行されていません。コードを送信してください")
+
+
+# ───── 保存先 ─────
+class MemoryEntry(NamedTuple):
+    code_hash: str
+    user_id: Optional[int]
+    expires_at: float  # monotonic
+    attempts: int
+
+
+class MemoryCodeStore:
+    """ワーカーのメモリに持つ認証コード"""
+
+    # 期限切れのコードを掃除する間隔（秒）
+    PRUNE_INTERVAL = 60
+
+    def __init__(self):
+        self._entries: Dict[Tuple[str, str], MemoryEntry] = {}
+        self._lock = threading.Lock()
+        self._pruned = time.monotonic()
+
+    def issue(self, purpose: str, identifier: str, code: str, user_id: Optional[int]):
+        now = time.monotonic()
+        with self._lock:
+            self._entries[(purpose, identifier)] = MemoryEntry(
+                _code_hash(purpose, identifier, code), user_id, now + CODE_TTL, 0)
+            if now - self._pruned >= self.PRUNE_INTERVAL:
+                # 期限切れ直後の「有効期限切れ」を返せるよう、TTL 分余計に残してから消す
+                self._entries = {k: e for k, e in self._entries.items() if e.expires_at + CODE_TTL > now}
+                self._pruned = now
+
+    def verify(self, purpose: str, identifier: str, code: str) -> Optional[int]:
+        key = (purpose, identifier)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                raise _not_found()
+            error = _check(entry.code_hash, entry.attempts, entry.expires_at < time.monotonic(),
+                           purpose, identifier, code)
+            if error is None or error.reason != "mismatch":
+                # 成功したコード・失効したコード（期限切れ・回数超過）は消す
+                del self._entries[key]
+            else:
+                self._entries[key] = entry._replace(attempts=entry.attempts + 1)
+        if error is not None:
+            raise error
+        return entry.user_id
+
+    def purge_expired(self) -> int:
+        now = time.monotonic()
+        with self._lock:
+            before = len(self._entries)
+            self._entries = {k: e for k, e in self._entries.items() if e.expires_at > now}
+            return before - len(self._entries)
+
+
+class TableCodeStore:
+    """VerificationCodes テーブルに持つ認証コード（発行は UPSERT 1回、検証は主キー検索1回）"""
+
+    def issue(self, purpose: str, identifier: str, code: str, user_id: Optional[int]):
+        now = datetime.utcnow()
+        stmt = mysql_insert(VerificationCode).values(
+            purpose=purpose, identifier=identifier, code_hash=_code_hash(purpose, identifier, code),
+            user_id=user_id, attempts=0, created_at=now, expires_at=now + timedelta(seconds=CODE_TTL),
+        )
+        with session_scope() as session:
+            session.execute(stmt.on_duplicate_key_update(
+                code_hash=stmt.inserted.code_hash, user_id=stmt.inserted.user_id, attempts=0,
+                created_at=stmt.inserted.created_at, expires_at=stmt.inserted.expires_at,
+            ))
+
+    def verify(self, purpose: str, identifier: str, code: str) -> Optional[int]:
+        params = {"purpose": purpose, "identifier": identifier}
+        with session_scope() as session:
+            # 同じコードへの同時の検証で試行回数を数え漏らさないよう行をロックする
+            row = session.execute(text("""
+            SELECT code_hash, user_id, attempts, expires_at < UTC_TIMESTAMP() AS expired
+            FROM VerificationCodes
+            WHERE purpose = :purpose AND identifier = :identifier
+            FOR UPDATE
+            """), params).first()
+            if row is None:
+                raise _not_found()
+            error = _check(row.code_hash, row.attempts, bool(row.expired), purpose, identifier, code)
+            if error is None or error.reason != "mismatch":
+                # 成功したコード・失効したコード（期限切れ・回数超過）は消す
+                session.execute(text("""
+                DELETE FROM VerificationCodes WHERE purpose = :purpose AND identifier = :identifier
+                """), params)
+            else:
+                session.execute(text("""
+                UPDATE VerificationCodes SET attempts = attempts + 1
+                WHERE purpose = :purpose AND identifier = :identifier
+                """), params)
+        # 削除・回数の更新をコミットしてから失敗を返す
+        if error is not None:
+            raise error
+        return row.user_id
+
+    def purge_expired(self, batch_size: int = 10000) -> int:
+        """期限切れの行を少しずつ削除する"""
+        removed = 0
+        while True:
+            with session_scope() as session:
+                count = session.execute(text("""
+                DELETE FROM VerificationCodes WHERE expires_at < UTC_TIMESTAMP() LIMIT :limit
+                """), {"limit": batch_size}).rowcount
+            removed += count
+            if count < batch_size:
+                return removed
+
+
+def create_store():
+    if CODE_STORE_BACKEND == "memory":
+        return MemoryCodeStore()
+    if CODE_STORE_BACKEND != "table":
+        logger.warning("CODE_STORE_BACKEND=%s は未対応のため table を使います", CODE_STORE_BACKEND)
+    return TableCodeStore()
+
+_store = create_store()
+
+
+def issue_code(purpose: str, identifier: str, user_id: Optional[int] = None) -> str:
+    """新しいコードを発行して返す（同じ用途・宛先の前のコードは無効になる）"""
+    code = generate_code()
+    _store.issue(purpose, normalize_identifier(identifier), code, user_id)
+    return code
+
+def verify_code(purpose: str, identifier: str, code: str) -> Optional[int]:
+    """コードを検証し、発行時のユーザーIDを返す。失敗したら CodeVerificationError"""
+    return _store.verify(purpose, normalize_identifier(identifier), code)
+
+def purge_expired() -> int:
+    return _store.purge_expired()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="認証コードテーブルの保守")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("purge", help="期限切れの認証コードを削除する")
+    args = parser.parse_args()
+
+    if args.command == "purge":
+        print(f"{purge_expired()} 件の期限切れコードを削除しました")
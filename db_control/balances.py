@@ -0,0 +1,63 @@
+"""
+UserPointBalance（ユーザーのポイント残高）と台帳（PointTransaction）の整合
+
+残高行は「そのユーザーの PointTransaction.point の合計」と常に一致している前提で、
+apply_point_delta（crud.py）が残高不足の判定に使う。台帳に直接行を足したとき
+（bulk_io.py の一括インポートなど）は rebuild_point_balances で作り直す。
+
+接続を作らないモジュールなので、--database-url で別の DB を使うスクリプトからも import できる。
+"""
+from typing import Dict, Iterable, List
+
+from sqlalchemy import text
+
+from logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# IN 句に渡すユーザーIDの数の上限（大きなインポートでも1文が巨大にならないように分ける）
+CHUNK_SIZE = 1000
+
+
+def _chunks(user_ids: Iterable[int]):
+    ids = sorted(set(user_ids))
+    for start in range(0, len(ids), CHUNK_SIZE):
+        yield tuple(ids[start:start + CHUNK_SIZE])
+
+
+def rebuild_point_balances(session, user_ids: Iterable[int]) -> int:
+    """指定ユーザーの残高行を台帳の合計で作り直し、更新した行数を返す（呼び出し元のトランザクション内）
+
+    残高行がまだないユーザーは何もしない（最初の取引で apply_point_delta が台帳の合計から作る）。
+    UPDATE が残高行をロックするので、同時に来た取引はこの更新のコミットを待ってから残高を変える。
+    """
+    updated = 0
+    for chunk in _chunks(user_ids):
+        updated += session.execute(text("""
+        UPDATE UserPointBalance b
+        SET b.balance = (SELECT COALESCE(SUM(pt.point), 0) FROM PointTransaction pt WHERE pt.user_id = b.user_id),
+            b.version = b.version + 1,
+            b.updated_at = UTC_TIMESTAMP()
+        WHERE b.user_id IN :user_ids
+        """), {"user_ids": chunk}).rowcount
+    return updated
+
+
+def find_point_balance_mismatches(session, user_ids: List[int] = None) -> List[Dict]:
+    """残高行と台帳の合計が一致しないユーザーを返す（整合性チェック用）"""
+    query = """
+    SELECT b.user_id, b.balance, COALESCE(SUM(pt.point), 0) AS ledger
+    FROM UserPointBalance b
+    LEFT JOIN PointTransaction pt ON pt.user_id = b.user_id
+    {where}
+    GROUP BY b.user_id, b.balance
+    HAVING b.balance <> ledger OR b.balance < 0
+    """
+    if user_ids is None:
+        rows = session.execute(text(query.format(where="")))
+        return [{"user_id": r.user_id, "balance": int(r.balance), "ledger": int(r.ledger)} for r in rows]
+    mismatches = []
+    for chunk in _chunks(user_ids):
+        rows = session.execute(text(query.format(where="WHERE b.user_id IN :user_ids")), {"user_ids": chunk})
+        mismatches += [{"user_id": r.user_id, "balance": int(r.balance), "ledger": int(r.ledger)} for r in rows]
+    return mismatches
@@ -3,9 +3,10 @@ from sqlalchemy.orm import sessionmaker
 import os
 from dotenv import load_dotenv
 from urllib.parse import quote_plus
+import resilience
+from logging_config import get_logger
 
-ssl_test_path = r"C:\Users\daisu\SSL\DigiCertGlobalRootCA.crt.pem"
-print("✅ 手動パス検証:", os.path.isfile(ssl_test_path))
+logger = get_logger(__name__)
 
 # 環境変数の読み込み
 load_dotenv()
@@ -17,9 +18,6 @@ def get_env_variable(key: str) -> str:
         raise ValueError(f"Environment variable '{key}' is not set.")
     return value
 
-# デバッグ用ログ出力
-print("DB_PASSWORD before encoding:", os.getenv("DB_PASSWORD"))
-
 # データベース接続情報
 DB_USER = get_env_variable('DB_USER')
 DB_PASSWORD = quote_plus(get_env_variable('DB_PASSWORD'))  # パスワードをURLエンコード
@@ -30,37 +28,35 @@ DB_NAME = get_env_variable('DB_NAME')
 # SSL証明書のパス
 SSL_CERT_PATH = os.getenv('SSL_CERT_PATH', '/etc/ssl/certs/ca-certificates.crt')
 if not SSL_CERT_PATH:
-    print("Warning: SSL_CERT_PATH is not set.")
-ssl_ca = os.getenv("SSL_CERT_PATH")
-print("✅ SSL_CA path:", ssl_ca)
-print("✅ ファイル存在:", os.path.isfile(ssl_ca))
-
-# デバッグ用ログ出力
-print("Encoded DB_PASSWORD:", DB_PASSWORD)
+    logger.warning("SSL_CERT_PATH が設定されていません")
+logger.info("SSL_CA: %s（存在: %s）", SSL_CERT_PATH, os.path.isfile(SSL_CERT_PATH))
 
 # MySQLのURL構築(本番はこっち)
 DATABASE_URL = f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}?ssl_ca={SSL_CERT_PATH}"
 
 # エンジンの作成
+# DB が遅いときにリクエストが無期限に待たないよう、接続・読み書き・プール待ちに上限を設ける（resilience.py）
 engine = create_engine(
     DATABASE_URL,
-    echo=True,
+    echo=False,  # SQL の出力は LOG_SQL=1（logging_config.py）
     pool_pre_ping=True,
     pool_recycle=3600,
+    pool_timeout=resilience.DB_POOL_TIMEOUT,
     connect_args={
         "ssl": {
             "ca": SSL_CERT_PATH or "/path/to/default/certificate.pem"  # デフォルト値を設定
-        }
+        },
+        "connect_timeout": resilience.DB_CONNECT_TIMEOUT,
+        "read_timeout": resilience.DB_READ_TIMEOUT,
+        "write_timeout": resilience.DB_WRITE_TIMEOUT,
     }
 )
 
 # 接続テスト
 try:
     with engine.connect() as connection:
-        print("Secure connection successful with SQLAlchemy!")
-except Exception as e:
-    import traceback
-    print("Secure connection failed:")
-    traceback.print_exc()
+        logger.info("DB に接続しました（SSL）")
+except Exception:
+    logger.exception("DB への接続に失敗しました")
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
\ No newline at end of file
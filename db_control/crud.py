@@ -1,71 +1,152 @@
 from schemas import RegisterStep1Request
 
-# uname() error回避
+# uname() error回避（結果は platform がキャッシュする）
 import platform
-print("platform", platform.uname())
+platform.uname()
 
-
-from sqlalchemy import create_engine, insert, delete, update, select, func
+from sqlalchemy import create_engine, insert, delete, update, select, func, text
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 import sqlalchemy
-from sqlalchemy.orm import Session,sessionmaker
+from sqlalchemy.orm import Session,sessionmaker, aliased
 import json
 import pandas as pd
 from contextlib import contextmanager
 from db_control import mymodels_MySQL as models
 from db_control.connect_MySQL import engine
 from . import mymodels_MySQL
-from .mymodels_MySQL import Family, FamilyRelationship, User, UserTag, Tag, Store, Event, EventTag, TransactionType, PointTransaction, FavoriteEvent
-from typing import List
-from datetime import date
+from .mymodels_MySQL import Family, FamilyRelationship, User, UserTag, Tag, Event, EventTag, TransactionType, PointTransaction, FavoriteEvent, UserPointBalance
+from . import rollups
+import resilience
+from logging_config import get_logger
+from typing import List, Dict, NamedTuple, Optional
+from datetime import date, datetime, timedelta
+import logging
+import math
+import os
+import time
 
 
 Session = sessionmaker(bind=engine)
 
+logger = get_logger(__name__)
+
+
+def _is_db_failure(exc: BaseException) -> bool:
+    """接続断・タイムアウトなど DB 側の障害か（一意制約違反などの業務エラーは数えない）"""
+    return isinstance(exc, (sqlalchemy.exc.OperationalError, sqlalchemy.exc.InterfaceError,
+                            sqlalchemy.exc.TimeoutError))
+
+# DB の同時実行数（既定は接続プールの pool_size 5 + max_overflow 10）とサーキットブレーカー
+mysql = resilience.register(
+    "mysql",
+    max_concurrent=int(os.getenv("DB_MAX_CONCURRENCY", "15")),
+    bulkhead_wait=float(os.getenv("DB_BULKHEAD_WAIT", "1")),
+    is_failure=_is_db_failure,
+)
 
 @contextmanager
 def session_scope():
     """
     セッションを安全に管理するためのスコープを提供。
     トランザクションの開始、ロールバック、クローズを自動で処理。
+    DB の障害中はサーキットブレーカーで即座に DependencyUnavailableError にする（resilience.py）。
     """
-    session = Session()
-    try:
-        yield session  # 呼び出し元にセッションを渡す
-        session.commit()  # 正常終了時はコミット
-    except Exception as e:
-        session.rollback()  # エラー時はロールバック
-        print(f"セッションのエラー: {e}")  # デバッグ用にエラーを表示
-        raise  # エラーを再スロー
-    finally:
-        session.close()  # 最後にセッションをクローズ
+    with mysql.guard():
+        session = Session()
+        try:
+            yield session  # 呼び出し元にセッションを渡す
+            session.commit()  # 正常終了時はコミット
+        except Exception as e:
+            session.rollback()  # エラー時はロールバック
+            # 残高不足などの業務エラーは呼び出し側で扱うので DEBUG、DB の障害は ERROR
+            logger.log(logging.ERROR if _is_db_failure(e) else logging.DEBUG, "セッションのエラー: %s", e)
+            raise  # エラーを再スロー
+        finally:
+            session.close()  # 最後にセッションをクローズ
 
     """指定したモデルの最後に挿入された ID を取得"""
 
+# 一覧系の行の型（必要な列だけを SELECT し、ORM オブジェクトを作らずタプルで受け取る）
+class StoreEventRow(NamedTuple):
+    event_id: int
+    event_name: str
+    start_date: str
+    end_date: str
+    start_at: str
+    end_at: str
+    description: str
+    store_id: int
+    flyer_url: Optional[str]
+    event_image_url: Optional[str]
+
+class EventListRow(NamedTuple):
+    event_id: int
+    event_name: str
+    start_date: str
+    area: Optional[str]
+    event_image_url: Optional[str]
+    description: str
+
+class CalendarEventRow(NamedTuple):
+    event_id: int
+    event_name: str
+    start_date: str
+    area: Optional[str]
+    event_image_url: Optional[str]
+    description: str
+    end_date: str
+    start_at: str
+    end_at: str
+
+class FamilyFavoriteRow(NamedTuple):
+    event_id: int
+    event_name: str
+    start_date: str
+    area: Optional[str]
+    event_image_url: Optional[str]
+    description: str
+    member_count: int
+    member_ids: str  # GROUP_CONCAT の "1,5,8"
+
+class FavoriteEventRow(NamedTuple):
+    event_id: int
+    event_name: str
+    start_date: str
+    area: Optional[str]
+    event_image_url: Optional[str]
+
+# summary=True のときの説明文の長さ（SQL 側で切り詰めて TEXT 全体を転送しない）
+SUMMARY_LENGTH = 100
+
+def _description_column(summary: bool):
+    if not summary:
+        return Event.description
+    return sqlalchemy.case(
+        (func.char_length(Event.description) > SUMMARY_LENGTH,
+         func.concat(func.left(Event.description, SUMMARY_LENGTH), "…")),
+        else_=Event.description,
+    )
+
 def selectEvent(store_id):
-    query = select(mymodels_MySQL.Event).where(mymodels_MySQL.Event.store_id == store_id)
+    query = select(
+        Event.event_id,
+        Event.event_name,
+        func.date_format(Event.start_date, "%Y-%m-%d"),
+        func.date_format(Event.end_date, "%Y-%m-%d"),
+        func.time_format(Event.start_at, "%H:%i:%s"),
+        func.time_format(Event.end_at, "%H:%i:%s"),
+        Event.description,
+        Event.store_id,
+        Event.flyer_url,
+        Event.event_image_url,
+    ).where(Event.store_id == store_id)
     try:
         with session_scope() as session:
-            result = session.execute(query).scalars().all()
-            print(f"Query result: {result}")
-            # 結果をオブジェクトから辞書に変換し、リストに追加
-            result_dict_eventlist = [
-                {
-                    "event_id": event_info.event_id,
-                    "event_name": event_info.event_name,
-                    "start_date": event_info.start_date.strftime("%Y-%m-%d"),
-                    "end_date": event_info.end_date.strftime("%Y-%m-%d"),
-                    "start_at": str(event_info.start_at), 
-                    "end_at": str(event_info.end_at),
-                    "description": event_info.description,
-                    "store_id": event_info.store_id,
-                    "flyer_url": event_info.flyer_url,
-                    "event_image_url": event_info.event_image_url
-                }
-                for event_info in result
-            ]
-            return result_dict_eventlist
+            rows = [StoreEventRow._make(row) for row in session.execute(query).tuples()]
+            logger.debug("Query result: %d 件", len(rows))
+            return [row._asdict() for row in rows]
     except Exception as e:
-            print(f"エラー: {e}")
+            logger.error("エラー: %s", e)
             return None
     
 def insertEvent(event_data):
@@ -78,7 +159,7 @@ def insertEvent(event_data):
     Returns:
         int: 挿入されたイベントのID
     """
-    print(f"Inserting event with data: {event_data}")  # デバッグ用
+    logger.debug("Inserting event with data: %s", event_data)
     
     # event_dataがリストの場合は最初の要素を取得
     if isinstance(event_data, list) and len(event_data) > 0:
@@ -96,12 +177,32 @@ def insertEvent(event_data):
             result = session.execute(query)
             session.flush() 
             event_id = result.inserted_primary_key[0]
-            print(f"Successfully inserted event with ID: {event_id}")  # デバッグ用
+            logger.debug("Successfully inserted event with ID: %s", event_id)
             return event_id
     except sqlalchemy.exc.IntegrityError as e:
-        print(f"Transaction：一意制約違反により、挿入に失敗しました: {e}")
+        logger.warning("Transaction：一意制約違反により、挿入に失敗しました: %s", e)
         raise
 
+def insert_events_with_tags(session, events: List[dict], tag_ids_per_event: List[List[int]]) -> List[int]:
+    """複数イベントとそのタグを呼び出し元のトランザクション内で登録し、イベントIDのリストを返す
+
+    タグは検証済みの tag_id を受け取り、全イベント分を1回の複数行 INSERT で登録する。
+    """
+    new_events = [Event(**event) for event in events]
+    session.add_all(new_events)
+    note_event_days(events)
+    # MySQL は RETURNING がないため、採番は flush で行う（コミットは呼び出し元で1回）
+    session.flush()
+
+    rows = [
+        {"event_id": event.event_id, "tag_id": tag_id}
+        for event, tag_ids in zip(new_events, tag_ids_per_event)
+        for tag_id in sorted(set(tag_ids))
+    ]
+    if rows:
+        session.execute(insert(EventTag), rows)
+    return [event.event_id for event in new_events]
+
 def getTagIdByName(tag_name):
     """タグ名からタグIDを取得する"""
     try:
@@ -116,22 +217,83 @@ def getTagIdByName(tag_name):
                 result = new_tag.tag_id
             return result
     except Exception as e:
-        print(f"タグID取得エラー: {e}")
+        logger.error("タグID取得エラー: %s", e)
         raise
 
-def insertEventTag(event_id, tag_ids):
+class InvalidTagError(ValueError):
+    """存在しない tag_id が指定された"""
+
+
+@contextmanager
+def _session_or_scope(session=None):
+    """session が渡されればそのトランザクション内で、なければ新しい session_scope で実行する"""
+    if session is not None:
+        yield session
+    else:
+        with session_scope() as new_session:
+            yield new_session
+
+def _assign_tags(session, link_model, owner_column, owner_id: int, tag_ids, replace: bool) -> List[int]:
+    """中間テーブル（UserTags / EventTags）へタグをまとめて登録する
+
+    1. 検証クエリ1回で、タグの存在と登録済みかどうかを同時に確認する
+    2. replace=True なら指定外のタグを1文で削除する
+    3. 未登録分だけを複数行 INSERT ... ON DUPLICATE KEY UPDATE で追加する
+    """
     try:
-        with session_scope() as session:
-            for tag_id in tag_ids:
-                existing_tag = session.query(Tag).filter_by(tag_id=tag_id).first()
-                if not existing_tag:
-                    raise Exception(f"存在しないtag_idです: {tag_id}")
-                event_tag = EventTag(event_id=event_id, tag_id=tag_id)
-                session.add(event_tag)
+        ids = sorted({int(tag_id) for tag_id in tag_ids})
+    except (TypeError, ValueError):
+        raise InvalidTagError(f"tag_id は整数で指定してください: {tag_ids}")
+
+    found = {}
+    if ids:
+        rows = session.execute(
+            select(Tag.tag_id, link_model.tag_id.label("linked_tag_id"))
+            .outerjoin(link_model, (link_model.tag_id == Tag.tag_id) & (owner_column == owner_id))
+            .where(Tag.tag_id.in_(ids))
+        ).all()
+        found = {row.tag_id: row.linked_tag_id is not None for row in rows}
+        missing = [tag_id for tag_id in ids if tag_id not in found]
+        if missing:
+            raise InvalidTagError(f"存在しないtag_idです: {missing}")
+
+    if replace:
+        session.execute(
+            delete(link_model).where(owner_column == owner_id, link_model.tag_id.not_in(ids))
+        )
+
+    new_ids = [tag_id for tag_id in ids if not found[tag_id]]
+    if new_ids:
+        # 同時実行で先に入った行は一意制約に当たるので何もしない
+        stmt = mysql_insert(link_model).values([
+            {owner_column.key: owner_id, "tag_id": tag_id} for tag_id in new_ids
+        ])
+        session.execute(stmt.on_duplicate_key_update(tag_id=stmt.inserted.tag_id))
+    return ids
+
+def assign_user_tags(user_id: int, tag_ids, replace: bool = False, session=None) -> List[int]:
+    """ユーザーの興味タグを1トランザクションで登録する（replace=True で指定したタグだけにする）"""
+    try:
+        with _session_or_scope(session) as s:
+            ids = _assign_tags(s, UserTag, UserTag.user_id, user_id, tag_ids, replace)
+            logger.debug("UserTag 登録成功: user_id=%s, tag_ids=%s", user_id, ids)
+            return ids
     except Exception as e:
-        print(f"EventTag の挿入に失敗しました: {e}")
+        logger.error("UserTag 登録失敗: %s", e)
         raise
 
+def assign_event_tags(event_id: int, tag_ids, replace: bool = False, session=None) -> List[int]:
+    """イベントのタグを1トランザクションで登録する（replace=True で指定したタグだけにする）"""
+    try:
+        with _session_or_scope(session) as s:
+            return _assign_tags(s, EventTag, EventTag.event_id, event_id, tag_ids, replace)
+    except Exception as e:
+        logger.error("EventTag の挿入に失敗しました: %s", e)
+        raise
+
+def insertEventTag(event_id, tag_ids):
+    return assign_event_tags(event_id, tag_ids)
+
 def getuserById(user_id):
     query = select(mymodels_MySQL.User).where(mymodels_MySQL.User.user_id == user_id)
     try:
@@ -149,22 +311,105 @@ def getuserById(user_id):
                 }
             return None
     except sqlalchemy.exc.IntegrityError as e:
-        print(f"Transaction：一意制約違反により、挿入に失敗しました: {e}")
+        logger.warning("Transaction：一意制約違反により、挿入に失敗しました: %s", e)
         raise
 
+def user_exists(user_id: int) -> bool:
+    """ユーザーの存在だけを確認する（主キー検索1回。トークンのない古いクライアント用）"""
+    with session_scope() as session:
+        return session.execute(
+            select(User.user_id).where(User.user_id == user_id)
+        ).first() is not None
+
+
+class InsufficientPointsError(ValueError):
+    """残高を超えるポイント利用"""
+
+    def __init__(self, user_id: int, balance: int, requested: int):
+        super().__init__(f"ポイント残高が不足しています（残高: {balance}、利用: {requested}）")
+        self.user_id = user_id
+        self.balance = balance
+        self.requested = requested
+
+
 def getTotalPointsByUserId(user_id: int):
+    """ポイント残高を返す（残高行がまだないユーザーは台帳の合計）"""
     try:
         with session_scope() as session:
+            balance = session.execute(
+                select(UserPointBalance.balance).where(UserPointBalance.user_id == user_id)
+            ).scalar()
+            if balance is not None:
+                return balance
             total_points = session.query(func.coalesce(func.sum(PointTransaction.point), 0)) \
                 .filter(PointTransaction.user_id == user_id) \
                 .scalar()
             return total_points
     except Exception as e:
-        print(f"ポイント合計取得エラー: {e}")
+        logger.error("ポイント合計取得エラー: %s", e)
         raise
 
-def insertUserAndStoreTransaction(data):
-    with session_scope() as session:
+
+# transaction_type → transaction_type_id（マスタなのでプロセスで1回だけ読む）
+_transaction_type_ids: Dict[str, int] = {}
+
+def get_transaction_type_id(session, t_type: str) -> int:
+    if t_type not in _transaction_type_ids:
+        for row in session.execute(select(TransactionType.transaction_type_id, TransactionType.transaction_type)):
+            _transaction_type_ids[row.transaction_type] = row.transaction_type_id
+    if t_type not in _transaction_type_ids:
+        raise Exception(f"{t_type} のtransaction_typeが見つかりません")
+    return _transaction_type_ids[t_type]
+
+
+def apply_point_delta(session, user_id: int, delta: int) -> int:
+    """残高に delta を加えて新しい残高を返す（呼び出し元のトランザクション内で実行する）
+
+    残高チェックと減算を1つの条件付き UPDATE で行うので、行ロックを持つのは
+    この UPDATE からコミットまでの間だけで、同じユーザーへの同時利用は直列化される。
+    残高が足りなければ InsufficientPointsError を送出する。
+    """
+    update_balance = text("""
+    UPDATE UserPointBalance
+    SET balance = balance + :delta, version = version + 1, updated_at = UTC_TIMESTAMP()
+    WHERE user_id = :user_id AND balance + :delta >= 0
+    """)
+    params = {"user_id": user_id, "delta": delta}
+    if session.execute(update_balance, params).rowcount == 0:
+        # 残高不足か、まだ残高行がないユーザー。行をロックして確かめる
+        balance = session.execute(
+            select(UserPointBalance.balance).where(UserPointBalance.user_id == user_id).with_for_update()
+        ).scalar()
+        if balance is None:
+            # 初回は台帳の合計から残高行を作る（同時に作られても INSERT IGNORE で1行になる）
+            session.execute(text("""
+            INSERT IGNORE INTO UserPointBalance (user_id, balance, version, updated_at)
+            SELECT :user_id, COALESCE(SUM(point), 0), 0, UTC_TIMESTAMP()
+            FROM PointTransaction WHERE user_id = :user_id
+            """), params)
+            if session.execute(update_balance, params).rowcount == 1:
+                balance = None
+            else:
+                balance = session.execute(
+                    select(UserPointBalance.balance).where(UserPointBalance.user_id == user_id).with_for_update()
+                ).scalar()
+        if balance is not None:
+            raise InsufficientPointsError(user_id, int(balance), -delta)
+
+    return int(session.execute(
+        select(UserPointBalance.balance).where(UserPointBalance.user_id == user_id)
+    ).scalar())
+
+
+def insertUserAndStoreTransaction(data, session=None) -> int:
+    """ユーザー側・店舗側の取引を記録し、ユーザーの新しい残高を返す
+
+    session を渡すとそのトランザクション内で書く（コミットは呼び出し元）。
+    """
+    if data.point <= 0:
+        raise ValueError("ポイントは1以上を指定してください")
+
+    with _session_or_scope(session) as session:
         # typeに応じて対応する2つのタイプを決定
         if data.type == "earn":
             user_type = "earn"
@@ -177,32 +422,82 @@ def insertUserAndStoreTransaction(data):
             user_point = -data.point
             store_point = data.point
         else:
-            raise Exception("不正なトランザクションタイプです")
+            raise ValueError("不正なトランザクションタイプです")
 
-        # トランザクション種別ID取得
-        def get_type_id(t_type):
-            result = session.execute(
-                select(TransactionType.transaction_type_id).where(TransactionType.transaction_type == t_type)
-            ).scalar()
-            if not result:
-                raise Exception(f"{t_type} のtransaction_typeが見つかりません")
-            return result
+        user_type_id = get_transaction_type_id(session, user_type)
+        store_type_id = get_transaction_type_id(session, store_type)
+
+        # 最初に残高を更新する（残高不足ならここで中断し、台帳には何も書かない）
+        balance = apply_point_delta(session, data.user_id, user_point)
+
+        # 集計テーブルと日付がずれないよう取引時刻をここで決める
+        transaction_at = datetime.utcnow()
 
         user_transaction = PointTransaction(
             user_id=data.user_id,
             store_id=data.store_id,
             point=user_point,
-            transaction_type_id=get_type_id(user_type)
+            transaction_type_id=user_type_id,
+            transaction_at=transaction_at
         )
 
         store_transaction = PointTransaction(
             user_id=None,
             store_id=data.store_id,
             point=store_point,
-            transaction_type_id=get_type_id(store_type)
+            transaction_type_id=store_type_id,
+            transaction_at=transaction_at
         )
 
         session.add_all([user_transaction, store_transaction])
+        # 呼び出し元のトランザクションで書くときも、台帳の INSERT のエラーはここで出す
+        session.flush()
+
+        # 店舗の集計テーブルも同じトランザクションで更新する
+        rollups.record_transaction_rollups(
+            session, data.store_id, data.user_id,
+            [(user_type_id, user_point), (store_type_id, store_point)],
+            transaction_at,
+        )
+    return balance
+
+
+# イベント人気度（時間減衰つきカウンタ）の設定
+POPULARITY_HALF_LIFE_DAYS = float(os.getenv("POPULARITY_HALF_LIFE_DAYS", "7"))
+POPULARITY_DECAY_PER_SECOND = math.log(2) / (POPULARITY_HALF_LIFE_DAYS * 24 * 60 * 60)
+POPULARITY_FAVORITE_WEIGHT = 1.0
+POPULARITY_VIEW_WEIGHT = 0.1
+
+# 保存値を経過時間分だけ減衰させた現在のスコア
+POPULARITY_SCORE_SQL = "ep.score * EXP(-:decay * TIMESTAMPDIFF(SECOND, ep.updated_at, UTC_TIMESTAMP()))"
+
+def upsert_event_popularity(session, increments: Dict[int, float]):
+    """イベントごとの人気度に加算する（既存値は経過時間分を減衰させてから足す）
+
+    呼び出し元のセッション（トランザクション）内で実行する。
+    """
+    if not increments:
+        return
+    query = text("""
+    INSERT INTO EventPopularity (event_id, score, updated_at)
+    VALUES (:event_id, GREATEST(:weight, 0), UTC_TIMESTAMP())
+    ON DUPLICATE KEY UPDATE
+        score = GREATEST(score * EXP(-:decay * TIMESTAMPDIFF(SECOND, updated_at, UTC_TIMESTAMP())) + :weight, 0),
+        updated_at = UTC_TIMESTAMP()
+    """)
+    session.execute(query, [
+        {"event_id": event_id, "weight": weight, "decay": POPULARITY_DECAY_PER_SECOND}
+        for event_id, weight in increments.items()
+    ])
+
+def get_store_analytics(store_id: int, granularity: str, date_from: date, date_to: date):
+    """店舗の期間ごとのポイント集計（集計テーブルのみを読む）"""
+    try:
+        with session_scope() as session:
+            return rollups.get_store_analytics(session, store_id, granularity, date_from, date_to)
+    except Exception as e:
+        logger.error("店舗集計取得エラー: %s", e)
+        raise
 
 def get_all_tags():
     try:
@@ -210,33 +505,29 @@ def get_all_tags():
             result = session.query(mymodels_MySQL.Tag).all()
             return [{"tag_id": tag.tag_id, "tag_name": tag.tag_name} for tag in result]
     except Exception as e:
-        print(f"タグ一覧取得エラー: {e}")
+        logger.error("タグ一覧取得エラー: %s", e)
         raise
 
-def insert_favorite_event(user_id, event_id):
+def insert_favorite_event(user_id, event_id, session=None):
     """
     お気に入りイベントを登録
-    event: FavoriteEvent (Pydanticモデル)
+    session を渡すとそのトランザクション内で書く（コミットは呼び出し元）。
+    登録済みなら uq_favorite_events_user_event に当たって何もしない（同時の二重登録でも人気度は1回だけ加算）
     """
     try:
-        with session_scope() as session:
-            # 重複チェック（同じuser_id + event_idの組み合わせがあるか）
-            existing = session.query(FavoriteEvent).filter_by(
-                user_id=user_id,
-                event_id=event_id
-            ).first()
-            if existing:
-                print("すでにお気に入り登録されています")
-                return  # or raise Exception / HTTPException
-
-            new_favorite = FavoriteEvent(
-                user_id=user_id,
-                event_id=event_id
-            )
-            session.add(new_favorite)
-            print("お気に入りを登録しました")
+        with _session_or_scope(session) as session:
+            inserted = session.execute(
+                mysql_insert(FavoriteEvent).prefix_with("IGNORE").values(
+                    user_id=user_id, event_id=event_id, created_at=datetime.utcnow()
+                )
+            ).rowcount
+            if inserted != 1:
+                logger.debug("すでにお気に入り登録されています: user_id=%s, event_id=%s", user_id, event_id)
+                return
+            upsert_event_popularity(session, {event_id: POPULARITY_FAVORITE_WEIGHT})
+            logger.debug("お気に入りを登録しました: user_id=%s, event_id=%s", user_id, event_id)
     except Exception as e:
-        print(f"お気に入り登録エラー: {e}")
+        logger.error("お気に入り登録エラー: %s", e)
         raise
 
 
@@ -253,11 +544,12 @@ def delete_favorite_event(user_id: int, event_id: int):
 
             if favorite:
                 session.delete(favorite)
-                print("お気に入りを削除しました")
+                upsert_event_popularity(session, {event_id: -POPULARITY_FAVORITE_WEIGHT})
+                logger.debug("お気に入りを削除しました: user_id=%s, event_id=%s", user_id, event_id)
             else:
-                print("対象のお気に入りは存在しません")
+                logger.debug("対象のお気に入りは存在しません: user_id=%s, event_id=%s", user_id, event_id)
     except Exception as e:
-        print(f"お気に入り削除エラー: {e}")
+        logger.error("お気に入り削除エラー: %s", e)
         raise
 
 def insert_user_step1(db, data):
@@ -277,102 +569,240 @@ def insert_user_step1(db, data):
     return new_user.user_id
 
 def insertUserTag(user_id: int, tag_id: int):
-    try:
-        with session_scope() as session:
-            new_user_tag = UserTag(user_id=user_id, tag_id=tag_id)
-            session.add(new_user_tag)
-            print(f"UserTag 登録成功: user_id={user_id}, tag_id={tag_id}")
-    except Exception as e:
-        print(f"UserTag 登録失敗: {e}")
-        raise
+    return assign_user_tags(user_id, [tag_id])
 
 def get_favorite_event_ids(user_id):
     with session_scope() as session:
         result = session.query(FavoriteEvent.event_id).filter_by(user_id=user_id).distinct().all()
         return [r.event_id for r in result]
 
+def get_tag_names_for_events(session, event_ids: List[int]) -> Dict[int, List[str]]:
+    """複数イベントのタグ名を1クエリで取得する"""
+    if not event_ids:
+        return {}
+    query = text("""
+    SELECT et.event_id, t.tag_name
+    FROM EventTags et
+    JOIN Tags t ON et.tag_id = t.tag_id
+    WHERE et.event_id IN :event_ids
+    ORDER BY et.event_id, t.tag_id
+    """)
+    tags_by_event: Dict[int, List[str]] = {}
+    for event_id, tag_name in session.execute(query, {"event_ids": tuple(set(event_ids))}):
+        tags_by_event.setdefault(event_id, []).append(tag_name)
+    return tags_by_event
+
+# 一覧系は ORM オブジェクトを作らず、日付も SQL 側で文字列にしてタプルのまま受け取る
 def get_favorite_events(user_id):
     with session_scope() as session:
-        result = session.query(
-            FavoriteEvent.event_id,
-            Event.event_name,
-            Event.event_image_url,
-            Event.start_date,
-            Event.area,
-            Store.store_name
-        ).join(Event, FavoriteEvent.event_id == Event.event_id) \
-         .join(Store, Event.store_id == Store.store_id) \
-         .filter(FavoriteEvent.user_id == user_id) \
-         .distinct().all()
+        rows = session.execute(
+            select(
+                Event.event_id,
+                Event.event_name,
+                func.date_format(Event.start_date, "%Y/%m/%d"),
+                Event.area,
+                Event.event_image_url,
+            ).join(FavoriteEvent, FavoriteEvent.event_id == Event.event_id)
+             .where(FavoriteEvent.user_id == user_id)
+             .distinct()
+        ).tuples()
 
         return [
             {
                 "event_id": r.event_id,
                 "event_name": r.event_name,
                 "area": r.area,
-                "date": r.start_date.strftime("%Y/%m/%d"),
+                "date": r.start_date,
                 "image_url": r.event_image_url
             }
-            for r in result
+            for r in map(FavoriteEventRow._make, rows)
         ]
 
-def search_events(keyword: str, date: str, tags: str):
+# ───── 家族（世帯）単位の集計 ─────
+# 家族全員分を1クエリで集計する（家族の人数分クエリを発行しない）
+def get_family_point_balances(user_id: int) -> Optional[Dict]:
+    """ユーザーの家族全員のポイント残高と合計。家族未登録なら None"""
+    query = text("""
+    SELECT me.family_id, f.family_name, u.user_id, u.name, r.relationship_type,
+           COALESCE(b.balance, l.total, 0) AS balance
+    FROM Users me
+    JOIN Families f ON f.family_id = me.family_id
+    JOIN Users u ON u.family_id = me.family_id
+    LEFT JOIN FamilyRelationship r ON r.relationship_id = u.relationship_id
+    LEFT JOIN UserPointBalance b ON b.user_id = u.user_id
+    LEFT JOIN (
+        -- 残高行がまだない家族だけ台帳から合計する
+        SELECT pt.user_id, SUM(pt.point) AS total
+        FROM Users me2
+        JOIN Users fu ON fu.family_id = me2.family_id
+        LEFT JOIN UserPointBalance fb ON fb.user_id = fu.user_id
+        JOIN PointTransaction pt ON pt.user_id = fu.user_id
+        WHERE me2.user_id = :user_id AND fb.user_id IS NULL
+        GROUP BY pt.user_id
+    ) l ON l.user_id = u.user_id
+    WHERE me.user_id = :user_id
+    ORDER BY u.relationship_id, u.user_id
+    """)
     with session_scope() as session:
-        query = session.query(Event, Store.store_name).join(Store, Event.store_id == Store.store_id)
-
-        if keyword:
-            query = query.filter(Event.event_name.contains(keyword) | Event.description.contains(keyword))
-
-        if date:
-            query = query.filter(Event.start_date == date)
-
-        if tags:
-            tag_list = tags.split(',')
-            query = query.join(EventTag, Event.event_id == EventTag.event_id)\
-                         .join(Tag, EventTag.tag_id == Tag.tag_id)\
-                         .filter(Tag.tag_name.in_(tag_list))
-
-        results = query.all()
-
-        return [{
-            "id": e.Event.event_id,
-            "title": e.Event.event_name,
-            "date": e.Event.start_date.strftime("%Y-%m-%d"),
-            "area": e.Event.area,
-            "description": e.Event.description,
-            "imageUrl": e.Event.event_image_url or None,
-            "tags": [t.tag_name for t in session.query(Tag).join(EventTag).filter(EventTag.event_id == e.Event.event_id)]
-        } for e in results]
-    
+        rows = session.execute(query, {"user_id": user_id}).fetchall()
+    if not rows:
+        return None
+    members = [{
+        "user_id": r.user_id,
+        "name": r.name,
+        "relationship": r.relationship_type,
+        "balance": int(r.balance),
+    } for r in rows]
+    return {
+        "family_id": rows[0].family_id,
+        "family_name": rows[0].family_name,
+        "total_balance": sum(m["balance"] for m in members),
+        "members": members,
+    }
+
+def get_family_favorite_events(user_id: int, summary: bool = True) -> List[Dict]:
+    """家族の誰かがお気に入り登録したイベントを、登録した人数の多い順に返す（家族未登録なら空）"""
+    me = aliased(User)
+    family_id = select(me.family_id).where(me.user_id == user_id).scalar_subquery()
+    member_count = func.count(func.distinct(FavoriteEvent.user_id))
+    with session_scope() as session:
+        query = _event_list_query(summary)\
+            .add_columns(member_count, func.group_concat(func.distinct(FavoriteEvent.user_id)))\
+            .join(FavoriteEvent, FavoriteEvent.event_id == Event.event_id)\
+            .join(User, User.user_id == FavoriteEvent.user_id)\
+            .where(User.family_id == family_id)\
+            .group_by(Event.event_id)\
+            .order_by(member_count.desc(), Event.start_date.asc(), Event.event_id.asc())
+        rows = [FamilyFavoriteRow._make(row) for row in session.execute(query).tuples()]
+        events = _event_list_response(session, rows)
+    for event, r in zip(events, rows):
+        event["favoritedBy"] = [int(u) for u in r.member_ids.split(",")]
+    return events
+
+def _event_list_query(summary: bool):
+    return select(
+        Event.event_id,
+        Event.event_name,
+        func.date_format(Event.start_date, "%Y-%m-%d"),
+        Event.area,
+        Event.event_image_url,
+        _description_column(summary),
+    )
 
-def get_upcoming_events():
+def _event_list_response(session, rows: List[EventListRow]) -> List[Dict]:
+    tags_by_event = get_tag_names_for_events(session, [r.event_id for r in rows])
+    return [{
+        "id": r.event_id,
+        "title": r.event_name,
+        "date": r.start_date,
+        "area": r.area,
+        "imageUrl": r.event_image_url or None,
+        "description": r.description,
+        "tags": tags_by_event.get(r.event_id, []),
+    } for r in rows]
+
+def get_events_by_ids(event_ids: List[int], summary: bool = False) -> List[Dict]:
+    """イベント一覧の形で、指定した順に返す（存在しないIDは飛ばす）"""
+    if not event_ids:
+        return []
+    with session_scope() as session:
+        rows = {
+            row.event_id: row
+            for row in map(EventListRow._make,
+                           session.execute(_event_list_query(summary).where(Event.event_id.in_(event_ids))).tuples())
+        }
+        return _event_list_response(session, [rows[e] for e in event_ids if e in rows])
+
+def get_upcoming_events(summary: bool = False):
+    """開催中・開催予定のイベント（終了日が今日以降）を開始日順に返す"""
     today = date.today()
     with session_scope() as session:
-        events = session.query(Event, Store.store_name)\
-            .join(Store, Event.store_id == Store.store_id)\
-            .filter(Event.start_date >= today)\
-            .order_by(Event.start_date.asc())\
-            .all()
-
-        event_list = []
-        for e in events:
-            tags = session.query(Tag.tag_name)\
-                .join(EventTag)\
-                .filter(EventTag.event_id == e.Event.event_id)\
-                .all()
-            tag_names = [t.tag_name for t in tags]
-
-            event_list.append({
-                "id": e.Event.event_id,
-                "title": e.Event.event_name,
-                "date": e.Event.start_date.strftime("%Y-%m-%d"),
-                "area": e.Event.area,
-                "imageUrl": e.Event.event_image_url,
-                "description": e.Event.description,
-                "tags": tag_names,
-            })
+        query = _event_list_query(summary)\
+            .where(Event.end_date >= today)\
+            .order_by(Event.start_date.asc(), Event.event_id.asc())
+        rows = [EventListRow._make(row) for row in session.execute(query).tuples()]
+        return _event_list_response(session, rows)
+
+
+# ───── 期間の重なり・開催中の検索 ─────
+# 「start_date <= :to AND end_date >= :from」だけでは (start_date, end_date) 索引の範囲が
+# :to 以前の全行になるので、イベントの最長日数から start_date の下限も決めて結果の近くだけを読む。
+# 最長日数は MAX_EVENT_DAYS_TTL ごとに読み直し、同じプロセスでの登録時は note_event_days で広げる。
+MAX_EVENT_DAYS_TTL = int(os.getenv("MAX_EVENT_DAYS_TTL", "60"))
+_max_event_days: Optional[int] = None
+_max_event_days_loaded = 0.0
+
+def get_max_event_days(session) -> int:
+    """登録済みイベントの最長の開催日数 - 1（start_date と end_date の差）"""
+    global _max_event_days, _max_event_days_loaded
+    if _max_event_days is None or time.monotonic() - _max_event_days_loaded >= MAX_EVENT_DAYS_TTL:
+        value = session.execute(
+            select(func.max(func.datediff(Event.end_date, Event.start_date)))
+        ).scalar()
+        _max_event_days, _max_event_days_loaded = max(int(value or 0), 0), time.monotonic()
+    return _max_event_days
+
+def note_event_days(events: List[dict]):
+    """登録したイベントの日数で最長日数を広げる（読み直しを待たずに重なり検索に出す）"""
+    global _max_event_days
+    if _max_event_days is None:
+        return
+    for event in events:
+        start_date, end_date = event.get("start_date"), event.get("end_date")
+        if isinstance(start_date, date) and isinstance(end_date, date):
+            _max_event_days = max(_max_event_days, (end_date - start_date).days)
+
+def overlap_condition(session, date_from: date, date_to: date):
+    """[date_from, date_to] と開催期間が重なるイベントの条件"""
+    earliest_start = date_from - timedelta(days=get_max_event_days(session))
+    return Event.start_date.between(earliest_start, date_to) & (Event.end_date >= date_from)
+
+def _calendar_query(summary: bool):
+    return _event_list_query(summary).add_columns(
+        func.date_format(Event.end_date, "%Y-%m-%d"),
+        func.time_format(Event.start_at, "%H:%i"),
+        func.time_format(Event.end_at, "%H:%i"),
+    )
+
+def _calendar_response(session, rows: List[CalendarEventRow]) -> List[Dict]:
+    events = _event_list_response(session, rows)
+    for event, r in zip(events, rows):
+        event["endDate"] = r.end_date
+        event["startAt"] = r.start_at
+        event["endAt"] = r.end_at
+    return events
 
-        return event_list
+def get_events_in_range(date_from: date, date_to: date, summary: bool = False) -> List[Dict]:
+    """開催期間が [date_from, date_to] と重なるイベントを開始日順に返す（カレンダー表示用）"""
+    with session_scope() as session:
+        query = _calendar_query(summary)\
+            .where(overlap_condition(session, date_from, date_to))\
+            .order_by(Event.start_date.asc(), Event.event_id.asc())
+        rows = [CalendarEventRow._make(row) for row in session.execute(query).tuples()]
+        return _calendar_response(session, rows)
+
+def get_events_active_at(at: datetime, summary: bool = False) -> List[Dict]:
+    """指定時刻に開催中のイベント（開催期間内の日で、start_at〜end_at の時間帯）
+
+    end_at が start_at より前のイベントは日付をまたぐ（22:00〜02:00 など）とみなし、
+    翌日の end_at までを前日分の開催時間として扱う。
+    """
+    day, moment = at.date(), at.time().replace(microsecond=0)
+    prev_day = day - timedelta(days=1)
+    on_day = (Event.start_date <= day) & (Event.end_date >= day)
+    on_prev_day = (Event.start_date <= prev_day) & (Event.end_date >= prev_day)
+    same_day = (Event.start_at <= Event.end_at) & on_day \
+        & (Event.start_at <= moment) & (Event.end_at > moment)
+    overnight = (Event.start_at > Event.end_at) & (
+        (on_day & (Event.start_at <= moment)) | (on_prev_day & (Event.end_at > moment))
+    )
+    with session_scope() as session:
+        query = _calendar_query(summary)\
+            .where(overlap_condition(session, prev_day, day))\
+            .where(same_day | overnight)\
+            .order_by(Event.start_date.asc(), Event.event_id.asc())
+        rows = [CalendarEventRow._make(row) for row in session.execute(query).tuples()]
+        return _calendar_response(session, rows)
 
 def get_event_detail_by_id(event_id: int):
     try:
@@ -405,5 +835,5 @@ def get_event_detail_by_id(event_id: int):
             }
 
     except Exception as e:
-        print(f"イベント詳細取得エラー: {e}")
+        logger.error("イベント詳細取得エラー: %s", e)
         raise
@@ -0,0 +1,125 @@
+"""
+スキーマの移行（Alembic）
+
+アプリの起動時にはテーブルを作らない（以前は init_db が起動のたびに create_all でテーブルを
+調べていた）。gunicorn で起動するときは gunicorn.conf.py が app を読み込む前に1回だけ upgrade を流す
+（MIGRATE_ON_START=0 で止められる。そのときはデプロイの手順で先に実行する）:
+
+    python -m db_control.migrate upgrade            # 最新まで適用
+    python -m db_control.migrate upgrade 0003       # 指定のリビジョンまで
+    python -m db_control.migrate downgrade 0003
+    python -m db_control.migrate current            # DB に適用済みのリビジョン
+    python -m db_control.migrate history
+    python -m db_control.migrate check              # 未適用があれば終了コード 1（デプロイ前の確認用）
+    python -m db_control.migrate revision -m "add foo"   # 新しい移行の雛形
+
+- 移行は db_control/migrations/versions にあり、online_ddl の「既にあれば何もしない」操作で書く。
+  create_all で作られた既存の DB にも、そのまま upgrade を流せる（stamp は不要）
+- 接続先は --database-url / MIGRATION_DATABASE_URL / アプリと同じ DB_* の環境変数 の順（env.py）
+- 起動時は require_current_schema が alembic_version を1回読み、最新でなければ起動を止める
+  （新しいテーブルがないまま動いて 500 を返し続けるより、起動に失敗した方が気づける）。
+  DB に接続できずに確かめられないときは警告だけにする（DB の障害中も起動して 503 を返せるように）
+- 複数のインスタンスが同時に起動しても、MySQL では GET_LOCK で1つずつ流す（env.py）
+"""
+import argparse
+import os
+import sys
+from typing import Optional
+
+from alembic import command
+from alembic.config import Config
+from alembic.script import ScriptDirectory
+from sqlalchemy import text
+
+from logging_config import get_logger
+
+logger = get_logger(__name__)
+
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "alembic.ini")
+
+
+def alembic_config(database_url: Optional[str] = None) -> Config:
+    config = Config(ALEMBIC_INI)
+    if database_url:
+        # ini の値として扱われるので、パスワード中の % をエスケープする
+        config.set_main_option("sqlalchemy.url", database_url.replace("%", "%%"))
+    return config
+
+
+def head_revision() -> Optional[str]:
+    return ScriptDirectory.from_config(alembic_config()).get_current_head()
+
+
+def upgrade(revision: str = "head", database_url: Optional[str] = None):
+    command.upgrade(alembic_config(database_url), revision)
+
+
+def current_revision(engine) -> Optional[str]:
+    """DB に適用済みのリビジョン（alembic_version がなければ None）"""
+    with engine.connect() as conn:
+        if not conn.dialect.has_table(conn, "alembic_version"):
+            return None
+        return conn.execute(text("SELECT version_num FROM alembic_version")).scalar()
+
+
+class SchemaOutdatedError(RuntimeError):
+    """DB に適用済みのリビジョンが最新ではない"""
+
+
+def require_current_schema():
+    """起動時の確認。DB が最新のリビジョンでなければ SchemaOutdatedError（確かめられなければ警告だけ）"""
+    try:
+        from db_control.connect_MySQL import engine
+        head = head_revision()
+        current = current_revision(engine)
+    except Exception as e:
+        logger.warning("スキーマのリビジョンを確認できませんでした: %s", e)
+        return
+    if current != head:
+        raise SchemaOutdatedError(
+            f"DB のスキーマが最新ではありません（current={current}, head={head}）。"
+            "python -m db_control.migrate upgrade を実行してください"
+        )
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="スキーマの移行")
+    parser.add_argument("--database-url", default=None, help="接続先（既定は MIGRATION_DATABASE_URL か DB_* の環境変数）")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_upgrade = sub.add_parser("upgrade", help="指定のリビジョンまで適用する")
+    p_upgrade.add_argument("revision", nargs="?", default="head")
+    p_downgrade = sub.add_parser("downgrade", help="指定のリビジョンまで戻す")
+    p_downgrade.add_argument("revision")
+    sub.add_parser("current", help="DB に適用済みのリビジョン")
+    sub.add_parser("history", help="移行の一覧")
+    sub.add_parser("check", help="未適用の移行があれば終了コード 1")
+    p_revision = sub.add_parser("revision", help="新しい移行の雛形を作る")
+    p_revision.add_argument("-m", "--message", required=True)
+    args = parser.parse_args(argv)
+
+    config = alembic_config(args.database_url)
+    if args.command == "upgrade":
+        command.upgrade(config, args.revision)
+    elif args.command == "downgrade":
+        command.downgrade(config, args.revision)
+    elif args.command == "current":
+        command.current(config, verbose=True)
+    elif args.command == "history":
+        command.history(config)
+    elif args.command == "revision":
+        command.revision(config, message=args.message)
+    elif args.command == "check":
+        from sqlalchemy import create_engine
+        url = args.database_url or os.getenv("MIGRATION_DATABASE_URL")
+        if url:
+            engine = create_engine(url)
+        else:
+            from db_control.connect_MySQL import engine
+        current, head = current_revision(engine), head_revision()
+        print(f"current={current} head={head}")
+        return 0 if current == head else 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
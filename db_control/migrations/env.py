@@ -0,0 +1,73 @@
+# db_control/migrations/env.py
+"""
+Alembic の実行環境
+
+接続先（上から順に使う）:
+    sqlalchemy.url（python -m db_control.migrate --database-url で渡す）
+    MIGRATION_DATABASE_URL（ローカルの確認用 DB など）
+    db_control.connect_MySQL の engine（アプリと同じ DB_* の環境変数と SSL 設定）
+
+移行は1つずつトランザクションで流す（MySQL の DDL は暗黙にコミットされるので、
+失敗したらその移行の途中から直す。online_ddl の操作はどれも再実行できる）。
+オフライン（--sql）は online_ddl が DB の状態を見るので使えない。
+MySQL では GET_LOCK で移行を1つずつにする（複数のインスタンスが起動時に同時に upgrade しても、
+後から来た方は先の移行が終わるのを待ち、適用済みのリビジョンから続ける）。
+"""
+import os
+
+from alembic import context
+from sqlalchemy import create_engine, text
+
+from db_control.mymodels_MySQL import Base
+from logging_config import get_logger
+
+logger = get_logger("alembic.env")
+
+config = context.config
+target_metadata = Base.metadata
+
+# ALTER がメタデータロックを待つ上限（秒）。長いトランザクションの後ろで待つ間、
+# 後から来たアプリのクエリまで止まるので、短く切り上げて再実行する
+MIGRATION_LOCK_WAIT_TIMEOUT = int(os.getenv("MIGRATION_LOCK_WAIT_TIMEOUT", "10"))
+# 他のインスタンスの移行が終わるのを待つ上限（秒）
+MIGRATION_MUTEX_TIMEOUT = int(os.getenv("MIGRATION_MUTEX_TIMEOUT", "600"))
+MIGRATION_MUTEX = "hsp_schema_migration"
+
+
+def get_engine():
+    url = config.get_main_option("sqlalchemy.url") or os.getenv("MIGRATION_DATABASE_URL")
+    if url:
+        return create_engine(url)
+    from db_control.connect_MySQL import engine
+    return engine
+
+
+def run_migrations_online():
+    engine = get_engine()
+    with engine.connect() as connection:
+        is_mysql = connection.dialect.name == "mysql"
+        if is_mysql:
+            connection.execute(text(f"SET SESSION lock_wait_timeout = {MIGRATION_LOCK_WAIT_TIMEOUT}"))
+            acquired = connection.execute(text("SELECT GET_LOCK(:name, :timeout)"),
+                                          {"name": MIGRATION_MUTEX, "timeout": MIGRATION_MUTEX_TIMEOUT}).scalar()
+            connection.commit()
+            if acquired != 1:
+                raise SystemExit("他の移行が終わらないため中止しました（GET_LOCK がタイムアウトしました）")
+        try:
+            context.configure(
+                connection=connection,
+                target_metadata=target_metadata,
+                transaction_per_migration=True,
+                compare_type=True,
+            )
+            with context.begin_transaction():
+                context.run_migrations()
+        finally:
+            if is_mysql:
+                connection.execute(text("SELECT RELEASE_LOCK(:name)"), {"name": MIGRATION_MUTEX})
+                connection.commit()
+
+
+if context.is_offline_mode():
+    raise SystemExit("オフライン（--sql）の移行には対応していません。DB に接続して実行してください")
+run_migrations_online()
@@ -0,0 +1,119 @@
+"""baseline: 起動時の create_all で作っていた元のテーブル
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-19
+
+既存の DB（create_all で作成済み）ではテーブルがあるので何もしない。空の DB ではすべて作る。
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from db_control import online_ddl
+
+# revision identifiers, used by Alembic.
+revision: str = "0001"
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    online_ddl.create_table_if_missing(
+        "Families",
+        sa.Column("family_id", sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column("family_name", sa.String(255), nullable=False),
+    )
+    online_ddl.create_table_if_missing(
+        "FamilyRelationship",
+        sa.Column("relationship_id", sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column("relationship_type", sa.String(50), nullable=False),
+    )
+    online_ddl.create_table_if_missing(
+        "Users",
+        sa.Column("user_id", sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column("name", sa.String(255), nullable=False),
+        sa.Column("name_kana", sa.String(255), nullable=True),
+        sa.Column("email", sa.String(255), unique=True, nullable=True),
+        sa.Column("family_id", sa.Integer, sa.ForeignKey("Families.family_id", ondelete="SET NULL"), nullable=True),
+        sa.Column("relationship_id", sa.Integer,
+                  sa.ForeignKey("FamilyRelationship.relationship_id", ondelete="SET NULL"), nullable=True),
+        sa.Column("birth_date", sa.Date, nullable=False),
+        sa.Column("gender", sa.Enum("M", "F", "U"), nullable=False),
+        sa.Column("postal_code", sa.String(8), nullable=True),
+        sa.Column("address1", sa.String(255), nullable=True),
+        sa.Column("address2", sa.String(255), nullable=True),
+        sa.Column("nimoca_id", sa.String(255), nullable=True),
+        sa.Column("saibugas_id", sa.String(255), nullable=True),
+        sa.Column("verification_code", sa.String(6), nullable=True),
+        sa.Column("code_expiry", sa.TIMESTAMP, nullable=True),
+        sa.Column("created_at", sa.TIMESTAMP, nullable=True),
+    )
+    online_ddl.create_table_if_missing(
+        "Tags",
+        sa.Column("tag_id", sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column("tag_name", sa.String(255), unique=True, nullable=False),
+    )
+    online_ddl.create_table_if_missing(
+        "UserTags",
+        sa.Column("user_tag_id", sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column("user_id", sa.Integer, sa.ForeignKey("Users.user_id", ondelete="CASCADE"), nullable=False),
+        sa.Column("tag_id", sa.Integer, sa.ForeignKey("Tags.tag_id", ondelete="CASCADE"), nullable=False),
+    )
+    online_ddl.create_table_if_missing(
+        "Stores",
+        sa.Column("store_id", sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column("store_name", sa.String(255), unique=True, nullable=False),
+        sa.Column("created_at", sa.TIMESTAMP, nullable=True),
+    )
+    online_ddl.create_table_if_missing(
+        "Events",
+        sa.Column("event_id", sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column("event_name", sa.String(255), nullable=False),
+        sa.Column("start_date", sa.Date, nullable=False),
+        sa.Column("end_date", sa.Date, nullable=False),
+        sa.Column("start_at", sa.Time, nullable=False),
+        sa.Column("end_at", sa.Time, nullable=False),
+        sa.Column("description", sa.Text, nullable=False),
+        sa.Column("information", sa.Text, nullable=True),
+        sa.Column("flyer_url", sa.String(500), nullable=True),
+        sa.Column("event_image_url", sa.String(500), nullable=True),
+        sa.Column("store_id", sa.Integer, sa.ForeignKey("Stores.store_id", ondelete="CASCADE"), nullable=False),
+        sa.Column("created_at", sa.TIMESTAMP, nullable=True),
+        sa.Column("updated_at", sa.TIMESTAMP, nullable=True),
+        sa.Column("area", sa.String(255), nullable=True),
+    )
+    online_ddl.create_table_if_missing(
+        "EventTags",
+        sa.Column("event_tag_id", sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column("event_id", sa.Integer, sa.ForeignKey("Events.event_id", ondelete="CASCADE"), nullable=False),
+        sa.Column("tag_id", sa.Integer, sa.ForeignKey("Tags.tag_id", ondelete="CASCADE"), nullable=False),
+    )
+    online_ddl.create_table_if_missing(
+        "Transaction_type",
+        sa.Column("transaction_type_id", sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column("transaction_type", sa.String(50), unique=True, nullable=False),
+    )
+    online_ddl.create_table_if_missing(
+        "PointTransaction",
+        sa.Column("transaction_id", sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column("user_id", sa.Integer, sa.ForeignKey("Users.user_id", ondelete="SET NULL"), nullable=True),
+        sa.Column("store_id", sa.Integer, sa.ForeignKey("Stores.store_id", ondelete="CASCADE"), nullable=True),
+        sa.Column("transaction_type_id", sa.Integer,
+                  sa.ForeignKey("Transaction_type.transaction_type_id", ondelete="CASCADE"), nullable=True),
+        sa.Column("point", sa.Integer, nullable=False),
+        sa.Column("transaction_at", sa.TIMESTAMP, nullable=True),
+    )
+    online_ddl.create_table_if_missing(
+        "FavoriteEvents",
+        sa.Column("favorite_id", sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column("user_id", sa.Integer, sa.ForeignKey("Users.user_id", ondelete="CASCADE"), nullable=False),
+        sa.Column("event_id", sa.Integer, sa.ForeignKey("Events.event_id", ondelete="CASCADE"), nullable=False),
+        sa.Column("created_at", sa.TIMESTAMP, nullable=True),
+    )
+
+
+def downgrade() -> None:
+    # 元のテーブルは消さない（データを失うため。必要なら手で DROP する）
+    pass
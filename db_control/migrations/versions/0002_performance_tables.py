@@ -0,0 +1,109 @@
+"""performance_tables: 集計・残高・冪等キー・位置情報・認証コードのテーブル
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-19
+
+どれも新しいテーブルなので、既存のテーブルには触れない（CREATE TABLE だけ）。
+UserPointBalance は空で作る。残高の行は crud がユーザーの初回の取引で PointTransaction の合計から作る。
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from db_control import online_ddl
+
+# revision identifiers, used by Alembic.
+revision: str = "0002"
+down_revision: Union[str, None] = "0001"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+TABLES = [
+    "VerificationCodes", "EventLocations", "PostalCodeLocations", "IdempotencyKeys", "UserPointBalance",
+    "StoreCustomerSeen", "StoreCustomerRollup", "StorePointDailyRollup", "EventPopularity",
+]
+
+
+def upgrade() -> None:
+    online_ddl.create_table_if_missing(
+        "EventPopularity",
+        sa.Column("event_id", sa.Integer, sa.ForeignKey("Events.event_id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("score", sa.Float, nullable=False),
+        sa.Column("updated_at", sa.TIMESTAMP, nullable=False),
+    )
+    online_ddl.create_table_if_missing(
+        "StorePointDailyRollup",
+        sa.Column("store_id", sa.Integer, sa.ForeignKey("Stores.store_id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("day", sa.Date, primary_key=True),
+        sa.Column("transaction_type_id", sa.Integer,
+                  sa.ForeignKey("Transaction_type.transaction_type_id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("points", sa.BigInteger, nullable=False),
+        sa.Column("txn_count", sa.Integer, nullable=False),
+    )
+    online_ddl.create_table_if_missing(
+        "StoreCustomerRollup",
+        sa.Column("store_id", sa.Integer, sa.ForeignKey("Stores.store_id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("period", sa.Enum("day", "week"), primary_key=True),
+        sa.Column("period_start", sa.Date, primary_key=True),
+        sa.Column("unique_customers", sa.Integer, nullable=False),
+    )
+    online_ddl.create_table_if_missing(
+        "StoreCustomerSeen",
+        sa.Column("store_id", sa.Integer, sa.ForeignKey("Stores.store_id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("period", sa.Enum("day", "week"), primary_key=True),
+        sa.Column("period_start", sa.Date, primary_key=True),
+        sa.Column("user_id", sa.Integer, sa.ForeignKey("Users.user_id", ondelete="CASCADE"), primary_key=True),
+    )
+    online_ddl.create_table_if_missing(
+        "UserPointBalance",
+        sa.Column("user_id", sa.Integer, sa.ForeignKey("Users.user_id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("balance", sa.BigInteger, nullable=False),
+        sa.Column("version", sa.Integer, nullable=False),
+        sa.Column("updated_at", sa.TIMESTAMP, nullable=False),
+    )
+    online_ddl.create_table_if_missing(
+        "IdempotencyKeys",
+        sa.Column("scope", sa.String(64), primary_key=True),
+        sa.Column("idem_key", sa.String(255), primary_key=True),
+        sa.Column("request_hash", sa.String(64), nullable=False),
+        sa.Column("status_code", sa.Integer, nullable=True),
+        sa.Column("response_body", sa.Text, nullable=True),
+        sa.Column("created_at", sa.TIMESTAMP, nullable=False),
+        sa.Column("expires_at", sa.TIMESTAMP, nullable=False),
+        sa.Index("ix_IdempotencyKeys_expires_at", "expires_at"),
+    )
+    online_ddl.create_table_if_missing(
+        "PostalCodeLocations",
+        sa.Column("postal_code", sa.String(7), primary_key=True),
+        sa.Column("latitude", sa.Float, nullable=False),
+        sa.Column("longitude", sa.Float, nullable=False),
+        sa.Column("prefecture", sa.String(16), nullable=True),
+        sa.Column("city", sa.String(64), nullable=True),
+        sa.Column("town", sa.String(128), nullable=True),
+        sa.Index("ix_PostalCodeLocations_city", "city"),
+    )
+    online_ddl.create_table_if_missing(
+        "EventLocations",
+        sa.Column("event_id", sa.Integer, sa.ForeignKey("Events.event_id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("latitude", sa.Float, nullable=False),
+        sa.Column("longitude", sa.Float, nullable=False),
+        sa.Column("source", sa.Enum("area", "manual"), nullable=False),
+        sa.Column("updated_at", sa.TIMESTAMP, nullable=False),
+    )
+    online_ddl.create_table_if_missing(
+        "VerificationCodes",
+        sa.Column("purpose", sa.String(16), primary_key=True),
+        sa.Column("identifier", sa.String(255), primary_key=True),
+        sa.Column("code_hash", sa.String(64), nullable=False),
+        sa.Column("user_id", sa.Integer, nullable=True),
+        sa.Column("attempts", sa.Integer, nullable=False),
+        sa.Column("created_at", sa.TIMESTAMP, nullable=False),
+        sa.Column("expires_at", sa.TIMESTAMP, nullable=False),
+        sa.Index("ix_VerificationCodes_expires_at", "expires_at"),
+    )
+
+
+def downgrade() -> None:
+    for table in TABLES:
+        online_ddl.drop_table_if_exists(table)
@@ -0,0 +1,50 @@
+"""performance_indexes: Events の期間の索引と、タグの中間テーブルの一意制約
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19
+
+- ix_events_start_end / ix_events_end_date: 開催中・今後のイベントの範囲検索（/events/upcoming, /events/calendar）
+- uq_user_tags_user_tag / uq_event_tags_event_tag: タグの二重登録を防ぐ（crud のタグ登録は
+  この制約に当たった行を ON DUPLICATE KEY UPDATE で読み飛ばす）。
+  既存の重複は先に消す（一番古い行を残す）
+どれも ALGORITHM=INPLACE, LOCK=NONE で追加する（online_ddl）。
+"""
+from typing import Sequence, Union
+
+from db_control import online_ddl
+from logging_config import get_logger
+
+logger = get_logger("alembic.migration")
+
+# revision identifiers, used by Alembic.
+revision: str = "0003"
+down_revision: Union[str, None] = "0002"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    online_ddl.add_index_online("Events", "ix_events_start_end", ["start_date", "end_date"])
+    online_ddl.add_index_online("Events", "ix_events_end_date", ["end_date"])
+
+    if not online_ddl.index_exists("UserTags", "uq_user_tags_user_tag"):
+        removed = online_ddl.delete_duplicates("UserTags", ["user_id", "tag_id"], "user_tag_id")
+        logger.info("UserTags の重複を削除しました: %d 件", removed)
+        online_ddl.add_index_online("UserTags", "uq_user_tags_user_tag", ["user_id", "tag_id"], unique=True)
+
+    if not online_ddl.index_exists("EventTags", "uq_event_tags_event_tag"):
+        removed = online_ddl.delete_duplicates("EventTags", ["event_id", "tag_id"], "event_tag_id")
+        logger.info("EventTags の重複を削除しました: %d 件", removed)
+        online_ddl.add_index_online("EventTags", "uq_event_tags_event_tag", ["event_id", "tag_id"], unique=True)
+
+
+def downgrade() -> None:
+    # MySQL は外部キー用に作った索引を、後から付けた (user_id, tag_id) の一意索引で置き換えていることがある。
+    # そのままでは「外部キーに必要」で消せないので、先に先頭列だけの索引を付けてから外す
+    online_ddl.add_index_online("EventTags", "ix_event_tags_event_id", ["event_id"])
+    online_ddl.drop_index_online("EventTags", "uq_event_tags_event_tag")
+    online_ddl.add_index_online("UserTags", "ix_user_tags_user_id", ["user_id"])
+    online_ddl.drop_index_online("UserTags", "uq_user_tags_user_tag")
+    online_ddl.drop_index_online("Events", "ix_events_end_date")
+    online_ddl.drop_index_online("Events", "ix_events_start_end")
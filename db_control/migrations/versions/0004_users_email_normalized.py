@@ -0,0 +1,77 @@
+"""users_email_normalized: Users.email_normalized 列と一意索引
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-19
+
+起動時の ensure_email_normalized で行っていた変更を移行にしたもの。
+列の追加 → 空の行を埋める → 一意索引の順に行う（索引は埋めてから付けないと重複で失敗する）。
+正規化は identity.normalize_email と同じ（NFKC → 前後の空白除去 → 小文字）。移行はアプリの
+コードが後で変わっても同じ結果になるよう、ここに書いておく。
+"""
+import unicodedata
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from db_control import online_ddl
+from logging_config import get_logger
+
+logger = get_logger("alembic.migration")
+
+# revision identifiers, used by Alembic.
+revision: str = "0004"
+down_revision: Union[str, None] = "0003"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 1000
+
+
+def _normalize(email):
+    if email is None:
+        return None
+    return unicodedata.normalize("NFKC", email).strip().lower() or None
+
+
+def backfill():
+    """email_normalized が空の行を埋める。正規化すると同じになるアカウントは、
+    既に使われているアカウント（なければ user_id の最も小さいアカウント）だけに設定する"""
+    bind = op.get_bind()
+    taken = dict(bind.execute(sa.text(
+        "SELECT email_normalized, user_id FROM Users WHERE email_normalized IS NOT NULL"
+    )).fetchall())
+    rows = bind.execute(sa.text(
+        "SELECT user_id, email FROM Users WHERE email IS NOT NULL AND email_normalized IS NULL ORDER BY user_id"
+    )).fetchall()
+
+    values, skipped = [], {}
+    for user_id, email in rows:
+        normalized = _normalize(email)
+        if normalized is None:
+            continue
+        if normalized in taken:
+            skipped.setdefault(normalized, [taken[normalized]]).append(user_id)
+            continue
+        taken[normalized] = user_id
+        values.append({"user_id": user_id, "email_normalized": normalized})
+
+    update = sa.text("UPDATE Users SET email_normalized = :email_normalized WHERE user_id = :user_id")
+    for start in range(0, len(values), BATCH_SIZE):
+        bind.execute(update, values[start:start + BATCH_SIZE])
+    if values:
+        logger.info("Backfilled email_normalized: %d rows", len(values))
+    for user_ids in skipped.values():
+        logger.warning("Duplicate accounts: user_id=%s（email_normalized は先頭のみ）", user_ids)
+
+
+def upgrade() -> None:
+    online_ddl.add_column_online("Users", sa.Column("email_normalized", sa.String(255), nullable=True), after="email")
+    backfill()
+    online_ddl.add_index_online("Users", "uq_users_email_normalized", ["email_normalized"], unique=True)
+
+
+def downgrade() -> None:
+    online_ddl.drop_index_online("Users", "uq_users_email_normalized")
+    online_ddl.drop_column_online("Users", "email_normalized")
@@ -0,0 +1,37 @@
+"""favorite_events_unique: FavoriteEvents の (user_id, event_id) の一意制約
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-19
+
+- uq_favorite_events_user_event: お気に入りの二重登録を防ぐ（crud の登録は INSERT IGNORE で
+  この制約に当たった行を読み飛ばし、人気度は新しく入ったときだけ加算する）。
+  既存の重複は先に消す（一番古い行を残す）
+ALGORITHM=INPLACE, LOCK=NONE で追加する（online_ddl）。
+"""
+from typing import Sequence, Union
+
+from db_control import online_ddl
+from logging_config import get_logger
+
+logger = get_logger("alembic.migration")
+
+# revision identifiers, used by Alembic.
+revision: str = "0005"
+down_revision: Union[str, None] = "0004"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    if not online_ddl.index_exists("FavoriteEvents", "uq_favorite_events_user_event"):
+        removed = online_ddl.delete_duplicates("FavoriteEvents", ["user_id", "event_id"], "favorite_id")
+        logger.info("FavoriteEvents の重複を削除しました: %d 件", removed)
+        online_ddl.add_index_online("FavoriteEvents", "uq_favorite_events_user_event",
+                                    ["user_id", "event_id"], unique=True)
+
+
+def downgrade() -> None:
+    # 外部キーが一意索引を使っていることがあるので、先に user_id だけの索引を付けてから外す（0003 と同じ）
+    online_ddl.add_index_online("FavoriteEvents", "ix_favorite_events_user_id", ["user_id"])
+    online_ddl.drop_index_online("FavoriteEvents", "uq_favorite_events_user_event")
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Date, Enum, TIMESTAMP, Text, Time
+from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, Date, Enum, TIMESTAMP, Text, Time, Float, UniqueConstraint, Index
 from sqlalchemy.orm import relationship, declarative_base
 from datetime import datetime
 import enum
@@ -51,11 +51,13 @@ class FamilyRelationship(Base):
 # Users テーブル
 class User(Base):
     __tablename__ = 'Users'
+    __table_args__ = (UniqueConstraint('email_normalized', name='uq_users_email_normalized'),)
 
     user_id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String(255), nullable=False)
     name_kana = Column(String(255), nullable=True)
     email = Column(String(255), unique=True, nullable=True)
+    email_normalized = Column(String(255), nullable=True)  # 検索用（NFKC + 前後空白除去 + 小文字）。identity.py で設定する
     family_id = Column(Integer, ForeignKey('Families.family_id', ondelete="SET NULL"), nullable=True)
     relationship_id = Column(Integer, ForeignKey('FamilyRelationship.relationship_id', ondelete="SET NULL"), nullable=True)
     birth_date = Column(Date, nullable=False)
@@ -65,8 +67,8 @@ class User(Base):
     address2 = Column(String(255), nullable=True)
     nimoca_id = Column(String(255), nullable=True)  # 追加
     saibugas_id = Column(String(255), nullable=True)  # 追加
-    verification_code = Column(String(6), nullable=True)  # 認証コード（6桁など）
-    code_expiry = Column(TIMESTAMP, nullable=True)        # 認証コードの有効期限
+    verification_code = Column(String(6), nullable=True)  # 未使用（認証コードは VerificationCodes / code_store.py）
+    code_expiry = Column(TIMESTAMP, nullable=True)        # 未使用（同上）
 
     created_at = Column(TIMESTAMP, default=datetime.utcnow, nullable=True)
 
@@ -80,6 +82,7 @@ class User(Base):
 # UserTags (ユーザーとタグの中間テーブル)
 class UserTag(Base):
     __tablename__ = 'UserTags'
+    __table_args__ = (UniqueConstraint('user_id', 'tag_id', name='uq_user_tags_user_tag'),)
 
     user_tag_id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('Users.user_id', ondelete="CASCADE"), nullable=False)
@@ -121,6 +124,11 @@ class Store(Base):
 # Events (イベント管理)
 class Event(Base):
     __tablename__ = 'Events'
+    # 期間の重なり検索（start_date の範囲 + end_date の絞り込みを索引だけで行う）と、開催中・開催予定の一覧用
+    __table_args__ = (
+        Index('ix_events_start_end', 'start_date', 'end_date'),
+        Index('ix_events_end_date', 'end_date'),
+    )
 
     event_id = Column(Integer, primary_key=True, autoincrement=True)
     event_name = Column(String(255), nullable=False)
@@ -146,6 +154,7 @@ class Event(Base):
 # EventTags (イベントとタグの中間テーブル)
 class EventTag(Base):
     __tablename__ = 'EventTags'
+    __table_args__ = (UniqueConstraint('event_id', 'tag_id', name='uq_event_tags_event_tag'),)
 
     event_tag_id = Column(Integer, primary_key=True, autoincrement=True)
     event_id = Column(Integer, ForeignKey('Events.event_id', ondelete="CASCADE"), nullable=False)
@@ -188,6 +197,7 @@ class PointTransaction(Base):
 # FavoriteEvents (ユーザーのお気に入りイベント)
 class FavoriteEvent(Base):
     __tablename__ = 'FavoriteEvents'
+    __table_args__ = (UniqueConstraint('user_id', 'event_id', name='uq_favorite_events_user_event'),)
 
     favorite_id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('Users.user_id', ondelete="CASCADE"), nullable=False)
@@ -199,3 +209,122 @@ class FavoriteEvent(Base):
 
     def __repr__(self):
         return f"<FavoriteEvent(favorite_id={self.favorite_id}, user_id={self.user_id}, event_id={self.event_id})>"
+
+# EventPopularity (イベント人気度: 時間減衰つきカウンタ)
+class EventPopularity(Base):
+    __tablename__ = 'EventPopularity'
+
+    event_id = Column(Integer, ForeignKey('Events.event_id', ondelete="CASCADE"), primary_key=True)
+    score = Column(Float, nullable=False, default=0)  # updated_at 時点の値（読むときに経過時間分を減衰させる）
+    updated_at = Column(TIMESTAMP, default=datetime.utcnow, nullable=False)
+
+    event = relationship("Event")
+
+    def __repr__(self):
+        return f"<EventPopularity(event_id={self.event_id}, score={self.score})>"
+
+# StorePointDailyRollup (店舗 × 日 × 取引種別のポイント集計)
+class StorePointDailyRollup(Base):
+    __tablename__ = 'StorePointDailyRollup'
+
+    store_id = Column(Integer, ForeignKey('Stores.store_id', ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    transaction_type_id = Column(Integer, ForeignKey('Transaction_type.transaction_type_id', ondelete="CASCADE"), primary_key=True)
+    points = Column(BigInteger, nullable=False, default=0)
+    txn_count = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<StorePointDailyRollup(store_id={self.store_id}, day={self.day}, points={self.points})>"
+
+# StoreCustomerRollup (店舗 × 期間（日/週）のユニーク顧客数)
+class StoreCustomerRollup(Base):
+    __tablename__ = 'StoreCustomerRollup'
+
+    store_id = Column(Integer, ForeignKey('Stores.store_id', ondelete="CASCADE"), primary_key=True)
+    period = Column(Enum('day', 'week'), primary_key=True)
+    period_start = Column(Date, primary_key=True)
+    unique_customers = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<StoreCustomerRollup(store_id={self.store_id}, period={self.period}, period_start={self.period_start})>"
+
+# StoreCustomerSeen (ユニーク顧客数の重複判定用: 店舗 × 期間 × ユーザー)
+class StoreCustomerSeen(Base):
+    __tablename__ = 'StoreCustomerSeen'
+
+    store_id = Column(Integer, ForeignKey('Stores.store_id', ondelete="CASCADE"), primary_key=True)
+    period = Column(Enum('day', 'week'), primary_key=True)
+    period_start = Column(Date, primary_key=True)
+    user_id = Column(Integer, ForeignKey('Users.user_id', ondelete="CASCADE"), primary_key=True)
+
+    def __repr__(self):
+        return f"<StoreCustomerSeen(store_id={self.store_id}, period_start={self.period_start}, user_id={self.user_id})>"
+
+# UserPointBalance (ユーザーのポイント残高: PointTransaction の合計を保持する)
+class UserPointBalance(Base):
+    __tablename__ = 'UserPointBalance'
+
+    user_id = Column(Integer, ForeignKey('Users.user_id', ondelete="CASCADE"), primary_key=True)
+    balance = Column(BigInteger, nullable=False, default=0)
+    version = Column(Integer, nullable=False, default=0)  # 更新のたびに +1
+    updated_at = Column(TIMESTAMP, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f"<UserPointBalance(user_id={self.user_id}, balance={self.balance}, version={self.version})>"
+
+# IdempotencyKeys (Idempotency-Key ごとの処理結果: 再送時に同じレスポンスを返す)
+class IdempotencyKey(Base):
+    __tablename__ = 'IdempotencyKeys'
+
+    scope = Column(String(64), primary_key=True)       # エンドポイントと呼び出し元（例: points/transaction:12）
+    idem_key = Column(String(255), primary_key=True)   # クライアントが送る Idempotency-Key
+    request_hash = Column(String(64), nullable=False)  # リクエスト内容のハッシュ（同じキーで別内容を防ぐ）
+    status_code = Column(Integer, nullable=True)       # NULL は処理中
+    response_body = Column(Text, nullable=True)
+    created_at = Column(TIMESTAMP, default=datetime.utcnow, nullable=False)
+    expires_at = Column(TIMESTAMP, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<IdempotencyKey(scope={self.scope}, idem_key={self.idem_key}, status_code={self.status_code})>"
+
+# PostalCodeLocations (郵便番号 → 緯度経度。ローカルのデータセットから geo.py で読み込む)
+class PostalCodeLocation(Base):
+    __tablename__ = 'PostalCodeLocations'
+
+    postal_code = Column(String(7), primary_key=True)  # ハイフンなし7桁
+    latitude = Column(Float, nullable=False)
+    longitude = Column(Float, nullable=False)
+    prefecture = Column(String(16), nullable=True)
+    city = Column(String(64), nullable=True, index=True)
+    town = Column(String(128), nullable=True)
+
+    def __repr__(self):
+        return f"<PostalCodeLocation(postal_code={self.postal_code}, latitude={self.latitude}, longitude={self.longitude})>"
+
+# EventLocations (イベントの位置)
+class EventLocation(Base):
+    __tablename__ = 'EventLocations'
+
+    event_id = Column(Integer, ForeignKey('Events.event_id', ondelete="CASCADE"), primary_key=True)
+    latitude = Column(Float, nullable=False)
+    longitude = Column(Float, nullable=False)
+    source = Column(Enum('area', 'manual'), nullable=False, default='area')  # area: エリア名から推定、manual: 手入力
+    updated_at = Column(TIMESTAMP, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f"<EventLocation(event_id={self.event_id}, latitude={self.latitude}, longitude={self.longitude})>"
+
+# VerificationCodes (メール認証コード。Users に書かずに code_store.py で発行・検証する)
+class VerificationCode(Base):
+    __tablename__ = 'VerificationCodes'
+
+    purpose = Column(String(16), primary_key=True)       # login / signup
+    identifier = Column(String(255), primary_key=True)   # 正規化したメールアドレス（identity.normalize_email）
+    code_hash = Column(String(64), nullable=False)       # コードの HMAC-SHA256（平文は保存しない）
+    user_id = Column(Integer, nullable=True)             # 検証成功時に返すユーザー（Users を引き直さない）
+    attempts = Column(Integer, nullable=False, default=0)
+    created_at = Column(TIMESTAMP, default=datetime.utcnow, nullable=False)
+    expires_at = Column(TIMESTAMP, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<VerificationCode(purpose={self.purpose}, identifier={self.identifier}, attempts={self.attempts})>"
@@ -0,0 +1,107 @@
+# db_control/online_ddl.py
+"""
+移行スクリプト（db_control/migrations/versions）から使うスキーマ変更の部品
+
+- どれも「既にあれば何もしない」。起動時の create_all で作られたテーブルがある既存の DB にも、
+  空の DB にも同じ移行を流せる
+- MySQL では索引・列の追加を ALGORITHM=INPLACE, LOCK=NONE で行う（コピーせず、実行中も読み書きを止めない）。
+  オンラインで実行できない変更なら MySQL がエラーにするので、気づかずにテーブルをロックすることはない
+- メタデータロックを待つ時間は env.py で lock_wait_timeout に制限している（長いトランザクションの後ろで
+  ALTER が待ち、その後ろにアプリのクエリが並んで止まるのを防ぐ）
+- MySQL 以外（ローカル確認用の SQLite など）では Alembic の通常の操作にする
+"""
+from typing import Sequence
+
+import sqlalchemy as sa
+from alembic import op
+
+
+def _bind():
+    return op.get_bind()
+
+def _is_mysql() -> bool:
+    return _bind().dialect.name == "mysql"
+
+def table_exists(table: str) -> bool:
+    return sa.inspect(_bind()).has_table(table)
+
+def column_exists(table: str, column: str) -> bool:
+    return any(c["name"] == column for c in sa.inspect(_bind()).get_columns(table))
+
+def index_exists(table: str, name: str) -> bool:
+    inspector = sa.inspect(_bind())
+    names = {index["name"] for index in inspector.get_indexes(table)}
+    names |= {constraint["name"] for constraint in inspector.get_unique_constraints(table)}
+    return name in names
+
+
+def create_table_if_missing(table: str, *columns, **kwargs) -> bool:
+    """テーブルがなければ作る（作ったら True）"""
+    if table_exists(table):
+        return False
+    op.create_table(table, *columns, **kwargs)
+    return True
+
+def drop_table_if_exists(table: str):
+    if table_exists(table):
+        op.drop_table(table)
+
+
+def add_index_online(table: str, name: str, columns: Sequence[str], unique: bool = False):
+    """索引を読み書きを止めずに追加する（同じ名前の索引があれば何もしない）"""
+    if index_exists(table, name):
+        return
+    if _is_mysql():
+        column_list = ", ".join(f"`{column}`" for column in columns)
+        op.execute(f"ALTER TABLE `{table}` ADD {'UNIQUE ' if unique else ''}INDEX `{name}` ({column_list}), "
+                   f"ALGORITHM=INPLACE, LOCK=NONE")
+    else:
+        op.create_index(name, table, list(columns), unique=unique)
+
+def drop_index_online(table: str, name: str):
+    if not index_exists(table, name):
+        return
+    if _is_mysql():
+        op.execute(f"ALTER TABLE `{table}` DROP INDEX `{name}`, ALGORITHM=INPLACE, LOCK=NONE")
+    else:
+        op.drop_index(name, table_name=table)
+
+
+def add_column_online(table: str, column: sa.Column, after: str = None):
+    """NULL 可の列を読み書きを止めずに追加する（既にあれば何もしない）"""
+    if column_exists(table, column.name):
+        return
+    if _is_mysql():
+        column_type = column.type.compile(dialect=_bind().dialect)
+        position = f" AFTER `{after}`" if after else ""
+        op.execute(f"ALTER TABLE `{table}` ADD COLUMN `{column.name}` {column_type} NULL{position}, "
+                   f"ALGORITHM=INPLACE, LOCK=NONE")
+    else:
+        op.add_column(table, column)
+
+def drop_column_online(table: str, column: str):
+    if not column_exists(table, column):
+        return
+    if _is_mysql():
+        op.execute(f"ALTER TABLE `{table}` DROP COLUMN `{column}`, ALGORITHM=INPLACE, LOCK=NONE")
+    else:
+        with op.batch_alter_table(table) as batch:
+            batch.drop_column(column)
+
+
+def delete_duplicates(table: str, key_columns: Sequence[str], id_column: str) -> int:
+    """key_columns が同じ行のうち、id_column が最小の行だけを残して消す（一意索引を付ける前の掃除）"""
+    keys = ", ".join(key_columns)
+    duplicates = _bind().execute(sa.text(f"""
+    SELECT {keys}, MIN({id_column}) AS keep_id FROM {table}
+    GROUP BY {keys} HAVING COUNT(*) > 1
+    """)).fetchall()
+    removed = 0
+    for row in duplicates:
+        values = dict(zip(key_columns, row[:len(key_columns)]))
+        condition = " AND ".join(f"{column} = :{column}" for column in key_columns)
+        removed += _bind().execute(
+            sa.text(f"DELETE FROM {table} WHERE {condition} AND {id_column} <> :keep_id"),
+            {**values, "keep_id": row[-1]},
+        ).rowcount
+    return removed
@@ -0,0 +1,192 @@
+"""
+店舗ごとのポイント台帳の集計テーブル
+
+PointTransaction を書き込むたびに同じトランザクション内で
+- StorePointDailyRollup（店舗 × 日 × 取引種別のポイント合計・件数）
+- StoreCustomerSeen / StoreCustomerRollup（店舗 × 日/週 のユニーク顧客数）
+を更新する。ダッシュボードは集計テーブルだけを読むので、台帳の件数に関係なく
+期間の日数分の行を読むだけで済む。
+
+既存データの集計（初回や不整合時）:
+    python -m db_control.rollups backfill --from 2024-04-01
+"""
+import os
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from logging_config import get_logger
+from .mymodels_MySQL import StorePointDailyRollup, StoreCustomerRollup, StoreCustomerSeen
+
+logger = get_logger(__name__)
+
+# 日の区切りのタイムゾーン（transaction_at は UTC で保存されている。既定は日本時間）
+UTC_OFFSET_HOURS = int(os.getenv("ROLLUP_UTC_OFFSET_HOURS", "9"))
+
+
+def local_day(at: datetime) -> date:
+    return (at + timedelta(hours=UTC_OFFSET_HOURS)).date()
+
+def today() -> date:
+    """集計の日の区切り（既定は日本時間）での今日"""
+    return local_day(datetime.utcnow())
+
+def week_start(day: date) -> date:
+    """週の開始日（月曜）"""
+    return day - timedelta(days=day.weekday())
+
+
+def record_transaction_rollups(session, store_id: int, user_id: Optional[int],
+                               rows: Iterable[Tuple[int, int]], at: datetime):
+    """取引を集計テーブルに反映する（呼び出し元のトランザクション内で実行する）
+
+    rows: (transaction_type_id, point) のリスト
+    user_id: 顧客側の取引のユーザー（ユニーク顧客数に数える）
+    """
+    day = local_day(at)
+    totals: Dict[int, Tuple[int, int]] = {}
+    for type_id, point in rows:
+        points, count = totals.get(type_id, (0, 0))
+        totals[type_id] = (points + point, count + 1)
+
+    stmt = mysql_insert(StorePointDailyRollup).values([
+        {"store_id": store_id, "day": day, "transaction_type_id": type_id, "points": points, "txn_count": count}
+        for type_id, (points, count) in totals.items()
+    ])
+    session.execute(stmt.on_duplicate_key_update(
+        points=StorePointDailyRollup.points + stmt.inserted.points,
+        txn_count=StorePointDailyRollup.txn_count + stmt.inserted.txn_count,
+    ))
+
+    if user_id is None:
+        return
+    for period, start in (("day", day), ("week", week_start(day))):
+        # その期間に初めて来た顧客のときだけユニーク顧客数を増やす
+        seen = session.execute(
+            mysql_insert(StoreCustomerSeen).prefix_with("IGNORE").values(
+                store_id=store_id, period=period, period_start=start, user_id=user_id
+            )
+        )
+        if seen.rowcount == 1:
+            counter = mysql_insert(StoreCustomerRollup).values(
+                store_id=store_id, period=period, period_start=start, unique_customers=1
+            )
+            session.execute(counter.on_duplicate_key_update(
+                unique_customers=StoreCustomerRollup.unique_customers + 1
+            ))
+
+
+def backfill(session, date_from: Optional[date] = None):
+    """PointTransaction から集計テーブルを作り直す（date_from 以降のみ。未指定なら全期間）
+
+    稼働中の書き込みと競合しないよう、取引の少ない時間帯に実行すること。
+    """
+    # 週の途中から作り直すと週のユニーク顧客数が欠けるので、週の頭にそろえる
+    date_from = week_start(date_from) if date_from else date(1970, 1, 5)
+    params = {"from_day": date_from, "offset": UTC_OFFSET_HOURS,
+              "from_at": datetime.combine(date_from, datetime.min.time()) - timedelta(hours=UTC_OFFSET_HOURS)}
+    local_at = "(transaction_at + INTERVAL :offset HOUR)"
+
+    for table, column in (("StorePointDailyRollup", "day"),
+                          ("StoreCustomerRollup", "period_start"),
+                          ("StoreCustomerSeen", "period_start")):
+        session.execute(text(f"DELETE FROM {table} WHERE {column} >= :from_day"), params)
+
+    session.execute(text(f"""
+    INSERT INTO StorePointDailyRollup (store_id, day, transaction_type_id, points, txn_count)
+    SELECT store_id, DATE({local_at}) AS d, transaction_type_id, SUM(point), COUNT(*)
+    FROM PointTransaction
+    WHERE transaction_at >= :from_at AND store_id IS NOT NULL AND transaction_type_id IS NOT NULL
+    GROUP BY store_id, d, transaction_type_id
+    """), params)
+
+    for period, start_expr in (("day", f"DATE({local_at})"),
+                               ("week", f"DATE(DATE_SUB({local_at}, INTERVAL WEEKDAY({local_at}) DAY))")):
+        session.execute(text(f"""
+        INSERT IGNORE INTO StoreCustomerSeen (store_id, period, period_start, user_id)
+        SELECT DISTINCT store_id, '{period}', {start_expr}, user_id
+        FROM PointTransaction
+        WHERE transaction_at >= :from_at AND store_id IS NOT NULL AND user_id IS NOT NULL
+        """), params)
+
+    session.execute(text("""
+    INSERT INTO StoreCustomerRollup (store_id, period, period_start, unique_customers)
+    SELECT store_id, period, period_start, COUNT(*)
+    FROM StoreCustomerSeen
+    WHERE period_start >= :from_day
+    GROUP BY store_id, period, period_start
+    """), params)
+    logger.info("集計テーブルを再作成しました（%s 以降）", date_from)
+
+
+def get_store_analytics(session, store_id: int, granularity: str,
+                        date_from: date, date_to: date) -> List[Dict]:
+    """店舗の期間ごとの付与/回収ポイント・取引数・ユニーク顧客数を返す"""
+    if granularity not in ("day", "week"):
+        raise ValueError("granularity は day か week を指定してください")
+    if granularity == "week":
+        date_from = week_start(date_from)
+        bucket = "DATE_SUB(r.day, INTERVAL WEEKDAY(r.day) DAY)"
+    else:
+        bucket = "r.day"
+    params = {"store_id": store_id, "date_from": date_from, "date_to": date_to, "period": granularity}
+
+    points = session.execute(text(f"""
+    SELECT {bucket} AS period_start, t.transaction_type, SUM(r.points) AS points, SUM(r.txn_count) AS txn_count
+    FROM StorePointDailyRollup r
+    JOIN Transaction_type t ON t.transaction_type_id = r.transaction_type_id
+    WHERE r.store_id = :store_id AND r.day BETWEEN :date_from AND :date_to
+    GROUP BY period_start, t.transaction_type
+    """), params).fetchall()
+    customers = session.execute(text("""
+    SELECT period_start, unique_customers
+    FROM StoreCustomerRollup
+    WHERE store_id = :store_id AND period = :period AND period_start BETWEEN :date_from AND :date_to
+    """), params).fetchall()
+
+    buckets: Dict[date, Dict] = {}
+    def bucket_for(start):
+        return buckets.setdefault(start, {
+            "period_start": start.strftime("%Y-%m-%d"),
+            "points_granted": 0,
+            "points_collected": 0,
+            "points_earned": 0,
+            "points_used": 0,
+            "transactions": 0,
+            "unique_customers": 0,
+        })
+
+    for row in points:
+        b = bucket_for(row.period_start)
+        # 店舗側の行は付与がマイナス、回収がプラスで記録されている
+        if row.transaction_type == "grant":
+            b["points_granted"] += -int(row.points)
+            b["transactions"] += int(row.txn_count)
+        elif row.transaction_type == "collect":
+            b["points_collected"] += int(row.points)
+            b["transactions"] += int(row.txn_count)
+        elif row.transaction_type == "earn":
+            b["points_earned"] += int(row.points)
+        elif row.transaction_type == "use":
+            b["points_used"] += -int(row.points)
+    for row in customers:
+        bucket_for(row.period_start)["unique_customers"] = row.unique_customers
+
+    return [buckets[start] for start in sorted(buckets)]
+
+
+if __name__ == "__main__":
+    import argparse
+    from .crud import session_scope
+
+    parser = argparse.ArgumentParser(description="店舗集計テーブルの保守")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_backfill = sub.add_parser("backfill", help="PointTransaction から集計テーブルを作り直す")
+    p_backfill.add_argument("--from", dest="date_from", type=date.fromisoformat)
+    args = parser.parse_args()
+
+    if args.command == "backfill":
+        with session_scope() as session:
+            backfill(session, args.date_from)
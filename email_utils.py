@@ -3,6 +3,21 @@ import os
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 import random
+import resilience
+from logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# SendGrid の同時送信数とサーキットブレーカー（障害中は待たずに DependencyUnavailableError）
+sendgrid_dependency = resilience.register("sendgrid", max_concurrent=int(os.getenv("SENDGRID_MAX_CONCURRENCY", "8")),
+                                          failure_threshold=3, reset_timeout=60,
+                                          is_failure=lambda e: getattr(e, "status_code", 500) >= 500)
+
+def send_message(message: Mail, api_key: str = None):
+    """タイムアウト付きで1通送る（4xx は宛先などの誤りなので障害には数えない）"""
+    sg = SendGridAPIClient(api_key or os.getenv("SENDGRID_API_KEY"))
+    sg.client.timeout = resilience.SENDGRID_TIMEOUT
+    return sendgrid_dependency.call(sg.send, message)
 
 def generate_verification_code():
     return str(random.randint(100000, 999999))
@@ -20,9 +35,8 @@ def send_verification_email(to_email: str, code: str):
     )
 
     try:
-        sg = SendGridAPIClient(os.getenv("SENDGRID_API_KEY"))
-        response = sg.send(message)
-        print("✅ メール送信成功:", response.status_code)
+        response = send_message(message)
+        logger.info("メール送信成功: %s", response.status_code)
     except Exception as e:
-        print("❌ メール送信失敗:", e)
+        logger.error("メール送信失敗: %s", e)
         raise
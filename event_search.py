@@ -0,0 +1,229 @@
+# event_search.py
+"""
+イベントのファセット検索（メモリ上のビットセット）
+
+各イベントにビット位置を割り当て、タグ・開催日・エリアごとに「該当するイベントのビットセット」
+（Python の int）を持っておく。絞り込みはビット演算、件数は popcount なので、
+DB に問い合わせずにマイクロ秒単位で結果とファセット件数を出せる。
+
+- 開催日は開催期間の各日に立てる（複数日のイベントは2日目以降の日付でも見つかる）
+- タグは AND（すべて含む）/ OR（いずれかを含む）を選べる
+- ファセット件数は「その項目以外の条件」で絞った件数（OR のタグは他のタグを選んでいても件数が出る）
+- キーワードは絞り込み後の候補だけを部分一致で調べる
+- イベント登録時は add_events で同じワーカーの索引に追加し、他ワーカーは INDEX_TTL ごとに作り直す
+- 公開した索引は変更しない。追加は複製に対して行ってから差し替えるので、検索はロックなしで読める
+"""
+import os
+import threading
+import time
+from datetime import date, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import text
+
+from db_control.crud import session_scope
+from logging_config import get_logger
+
+logger = get_logger(__name__)
+
+INDEX_TTL = int(os.getenv("EVENT_SEARCH_INDEX_TTL", "60"))
+# ファセットで返す開催日の件数の上限（近い順）
+MAX_DATE_FACETS = 60
+# 開催日のビットを立てる日数の上限（常設に近い長期イベントで索引が膨らまないように）
+MAX_INDEXED_DAYS = 366
+
+popcount = int.bit_count if hasattr(int, "bit_count") else (lambda bits: bin(bits).count("1"))
+
+
+class FacetIndex:
+    def __init__(self):
+        self.event_ids: List[int] = []
+        self.start_ordinals: List[int] = []
+        self.texts: List[str] = []
+        self.positions: Dict[int, int] = {}
+        self.tag_bits: Dict[str, int] = {}
+        self.date_bits: Dict[str, int] = {}  # "YYYY-MM-DD" → その日に開催中のイベントのビットセット
+        self.area_bits: Dict[str, int] = {}
+        self.all_bits = 0
+        # 追加順が開催日順のままなら、結果を並べ替えなくてよい
+        self.in_order = True
+
+    def add(self, event_id: int, start_date: date, end_date: date, area: Optional[str],
+            search_text: str, tags: Iterable[str]):
+        if event_id in self.positions:
+            return
+        bit = 1 << len(self.event_ids)
+        key = (start_date.toordinal(), event_id)
+        if self.event_ids and key < (self.start_ordinals[-1], self.event_ids[-1]):
+            self.in_order = False
+        self.positions[event_id] = len(self.event_ids)
+        self.event_ids.append(event_id)
+        self.start_ordinals.append(start_date.toordinal())
+        self.texts.append(search_text.lower())
+        self.all_bits |= bit
+        for tag in set(tags):
+            self.tag_bits[tag] = self.tag_bits.get(tag, 0) | bit
+        for offset in range(max(min((end_date - start_date).days, MAX_INDEXED_DAYS - 1), 0) + 1):
+            day = (start_date + timedelta(days=offset)).isoformat()
+            self.date_bits[day] = self.date_bits.get(day, 0) | bit
+        if area:
+            self.area_bits[area] = self.area_bits.get(area, 0) | bit
+
+    def copy(self) -> "FacetIndex":
+        """追加用の複製（ビットセットは int なので、辞書とリストを複製すれば元の索引は変わらない）"""
+        index = FacetIndex()
+        index.event_ids = list(self.event_ids)
+        index.start_ordinals = list(self.start_ordinals)
+        index.texts = list(self.texts)
+        index.positions = dict(self.positions)
+        index.tag_bits = dict(self.tag_bits)
+        index.date_bits = dict(self.date_bits)
+        index.area_bits = dict(self.area_bits)
+        index.all_bits = self.all_bits
+        index.in_order = self.in_order
+        return index
+
+    @staticmethod
+    def _positions(bits: int) -> List[int]:
+        """立っているビットの位置（昇順）"""
+        if not bits:
+            return []
+        raw = np.frombuffer(bits.to_bytes((bits.bit_length() + 7) // 8, "little"), dtype=np.uint8)
+        return np.flatnonzero(np.unpackbits(raw, bitorder="little")).tolist()
+
+    def _keyword_bits(self, keyword: str, candidates: int) -> int:
+        keyword = keyword.lower()
+        bits = 0
+        for position in self._positions(candidates):
+            if keyword in self.texts[position]:
+                bits |= 1 << position
+        return bits
+
+    def _tag_mask(self, tags: List[str], mode: str) -> int:
+        if not tags:
+            return self.all_bits
+        masks = [self.tag_bits.get(tag, 0) for tag in tags]
+        result = masks[0]
+        for mask in masks[1:]:
+            result = result & mask if mode == "and" else result | mask
+        return result
+
+    def search(self, keyword: str = "", on_date: Optional[date] = None, tags: Optional[List[str]] = None,
+               tag_mode: str = "or", area: Optional[str] = None) -> Tuple[List[int], Dict]:
+        """条件に合うイベントID（開催日順）とファセット件数を返す"""
+        tags = tags or []
+        masks = {
+            "date": self.date_bits.get(on_date.isoformat(), 0) if on_date else self.all_bits,
+            "area": self.area_bits.get(area, 0) if area else self.all_bits,
+            "tags": self._tag_mask(tags, tag_mode),
+        }
+        structured = masks["date"] & masks["area"] & masks["tags"]
+        if keyword:
+            # キーワードはファセット計算にも使うので、キーワード以外の条件のどれかを満たす候補を調べる
+            candidates = (masks["date"] & masks["area"]) | (masks["date"] & masks["tags"]) | (masks["area"] & masks["tags"])
+            masks["keyword"] = self._keyword_bits(keyword, candidates)
+        else:
+            masks["keyword"] = self.all_bits
+        result = structured & masks["keyword"]
+
+        def others(excluded: str) -> int:
+            bits = self.all_bits
+            for name, mask in masks.items():
+                if name != excluded:
+                    bits &= mask
+            return bits
+
+        # AND のタグは選択中のタグで絞った上での件数、OR のタグは選択中のタグを除いた件数
+        tag_base = result if tag_mode == "and" else others("tags")
+        date_base, area_base = others("date"), others("area")
+        dates = sorted((d, n) for d, bits in self.date_bits.items() if (n := popcount(date_base & bits)))
+        if len(dates) > MAX_DATE_FACETS:
+            today = date.today().isoformat()
+            dates = [(d, n) for d, n in dates if d >= today][:MAX_DATE_FACETS]
+        facets = {
+            "tags": {tag: n for tag, bits in self.tag_bits.items() if (n := popcount(tag_base & bits))},
+            "areas": {a: n for a, bits in self.area_bits.items() if (n := popcount(area_base & bits))},
+            "dates": dict(dates),
+        }
+
+        positions = self._positions(result)
+        if not self.in_order:
+            positions.sort(key=lambda p: (self.start_ordinals[p], self.event_ids[p]))
+        return [self.event_ids[p] for p in positions], facets
+
+
+def _load_rows(session, event_ids: Optional[Tuple[int, ...]] = None):
+    where = "WHERE e.event_id IN :event_ids" if event_ids else ""
+    params = {"event_ids": event_ids} if event_ids else {}
+    events = session.execute(text(f"""
+    SELECT e.event_id, e.start_date, e.end_date, e.area, e.event_name, e.description
+    FROM Events e {where}
+    ORDER BY e.start_date, e.event_id
+    """), params).fetchall()
+    tags: Dict[int, List[str]] = {}
+    for event_id, tag_name in session.execute(text(f"""
+    SELECT DISTINCT et.event_id, t.tag_name
+    FROM EventTags et JOIN Tags t ON t.tag_id = et.tag_id
+    {where.replace("e.event_id", "et.event_id")}
+    """), params):
+        tags.setdefault(event_id, []).append(tag_name)
+    return events, tags
+
+def build_index(session) -> FacetIndex:
+    index = FacetIndex()
+    events, tags = _load_rows(session)
+    for e in events:
+        index.add(e.event_id, e.start_date, e.end_date, e.area,
+                  f"{e.event_name}\n{e.description or ''}", tags.get(e.event_id, []))
+    return index
+
+
+_index: Optional[FacetIndex] = None
+_index_built = 0.0
+_lock = threading.Lock()
+
+def get_index() -> FacetIndex:
+    global _index, _index_built
+    index = _index
+    if index is not None and time.monotonic() - _index_built < INDEX_TTL:
+        return index
+    # 作り直し中は他のスレッドに古い索引を返す
+    if not _lock.acquire(blocking=index is None):
+        return index
+    try:
+        if _index is None or time.monotonic() - _index_built >= INDEX_TTL:
+            started = time.perf_counter()
+            with session_scope() as session:
+                _index = build_index(session)
+            _index_built = time.monotonic()
+            logger.info("検索索引を作り直しました: events=%d, %.0fms",
+                        len(_index.event_ids), (time.perf_counter() - started) * 1000)
+        return _index
+    finally:
+        _lock.release()
+
+def add_events(event_ids: List[int]):
+    """登録直後のイベントを索引に追加する（作り直しを待たずに検索に出す）
+
+    検索中のスレッドが読んでいる索引は変えず、複製に追加してから差し替える。
+    """
+    global _index
+    if _index is None or not event_ids:
+        return
+    try:
+        with session_scope() as session:
+            events, tags = _load_rows(session, tuple(event_ids))
+    except Exception as e:
+        logger.warning("検索索引への追加に失敗しました（次の作り直しで反映されます）: %s", e)
+        return
+    with _lock:
+        index = _index.copy()
+        for e in events:
+            index.add(e.event_id, e.start_date, e.end_date, e.area,
+                      f"{e.event_name}\n{e.description or ''}", tags.get(e.event_id, []))
+        _index = index
+
+def search(keyword: str = "", on_date: Optional[date] = None, tags: Optional[List[str]] = None,
+           tag_mode: str = "or", area: Optional[str] = None) -> Tuple[List[int], Dict]:
+    return get_index().search(keyword, on_date, tags, tag_mode, area)
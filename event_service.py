@@ -0,0 +1,186 @@
+# event_service.py
+"""
+イベント登録サービス
+
+- タグはメモリ上のタグ表（tag_id / タグ名 → tag_id）で検証し、DBへの問い合わせをしない
+- イベント本体とタグは1トランザクションで登録する（タグは複数行 INSERT 1回）
+- DB登録に失敗したらアップロード済みの Blob を削除する（削除漏れは blob_storage.py gc で回収）
+- CSV / JSON で複数イベントをまとめて登録できる（全件成功か全件失敗）
+- 登録時にエリア名からイベントの位置（EventLocations）を求める
+- 登録したイベントは店舗・全体のチャネルにプッシュ配信する（pubsub.py）
+"""
+import csv
+import io
+import os
+import threading
+import time
+from datetime import date, time as dt_time
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+
+import blob_storage
+import event_search
+import feature_store
+import geo
+import pubsub
+import resilience
+from db_control import crud
+from db_control.crud import session_scope, InvalidTagError
+from db_control.mymodels_MySQL import Tag, Store
+from logging_config import get_logger
+
+logger = get_logger(__name__)
+
+TAG_MAP_TTL = int(os.getenv("TAG_MAP_TTL", "300"))
+# CSV の tags 列の区切り文字
+CSV_TAG_SEPARATOR = "|"
+
+REQUIRED_FIELDS = ["event_name", "start_date", "end_date", "start_at", "end_at", "description", "store_id"]
+OPTIONAL_FIELDS = ["area", "information", "flyer_url", "event_image_url"]
+
+_tag_map: Optional[Dict[str, int]] = None
+_tag_map_loaded = 0.0
+_tag_map_lock = threading.Lock()
+
+
+class EventValidationError(ValueError):
+    """入力の検証エラー（errors は {"row": 行番号, "error": 内容} のリスト）"""
+
+    def __init__(self, errors: List[Dict]):
+        super().__init__(f"{len(errors)} 件のイベントに不備があります")
+        self.errors = errors
+
+
+def get_tag_map(force: bool = False) -> Dict[str, int]:
+    """tag_id（文字列）とタグ名のどちらからでも tag_id を引ける表を返す"""
+    global _tag_map, _tag_map_loaded
+    if not force and _tag_map is not None and time.monotonic() - _tag_map_loaded < TAG_MAP_TTL:
+        return _tag_map
+    with _tag_map_lock:
+        with session_scope() as session:
+            rows = session.execute(select(Tag.tag_id, Tag.tag_name)).all()
+        tag_map = {str(row.tag_id): row.tag_id for row in rows}
+        tag_map.update({row.tag_name: row.tag_id for row in rows})
+        _tag_map, _tag_map_loaded = tag_map, time.monotonic()
+        return tag_map
+
+def invalidate_tag_map():
+    global _tag_map
+    _tag_map = None
+
+def resolve_tag_ids(tags) -> List[int]:
+    """タグ（tag_id または タグ名）を tag_id に変換する。知らないタグがあれば表を1回だけ読み直す"""
+    keys = [str(tag).strip() for tag in tags if str(tag).strip()]
+    tag_map = get_tag_map()
+    if any(key not in tag_map for key in keys):
+        tag_map = get_tag_map(force=True)
+    unknown = [key for key in keys if key not in tag_map]
+    if unknown:
+        raise InvalidTagError(f"存在しないタグです: {unknown}")
+    return sorted({tag_map[key] for key in keys})
+
+
+def _as_date(value) -> date:
+    return value if isinstance(value, date) else date.fromisoformat(str(value).strip())
+
+def _as_time(value) -> dt_time:
+    return value if isinstance(value, dt_time) else dt_time.fromisoformat(str(value).strip())
+
+def prepare_event(raw: Dict) -> Tuple[Dict, List[int]]:
+    """1件分の入力を検証して、Events の列の dict と tag_id のリストにする"""
+    missing = [field for field in REQUIRED_FIELDS if raw.get(field) in (None, "")]
+    if missing:
+        raise ValueError(f"必須項目がありません: {missing}")
+
+    event = {
+        "event_name": str(raw["event_name"]).strip(),
+        "start_date": _as_date(raw["start_date"]),
+        "end_date": _as_date(raw["end_date"]),
+        "start_at": _as_time(raw["start_at"]),
+        "end_at": _as_time(raw["end_at"]),
+        "description": raw["description"],
+        "store_id": int(raw["store_id"]),
+    }
+    for field in OPTIONAL_FIELDS:
+        event[field] = raw.get(field) or None
+    if event["end_date"] < event["start_date"]:
+        raise ValueError("終了日が開始日より前です")
+
+    tags = raw.get("tags") or []
+    if isinstance(tags, str):
+        tags = tags.split(CSV_TAG_SEPARATOR)
+    return event, resolve_tag_ids(tags)
+
+
+def create_events(raw_events: List[Dict]) -> List[int]:
+    """複数イベントを検証し、1トランザクションで登録してイベントIDのリストを返す"""
+    events, tag_lists, errors = [], [], []
+    for row, raw in enumerate(raw_events, start=1):
+        try:
+            event, tag_ids = prepare_event(raw)
+            events.append(event)
+            tag_lists.append(tag_ids)
+        except (ValueError, TypeError) as e:
+            errors.append({"row": row, "error": str(e)})
+    if errors:
+        raise EventValidationError(errors)
+    if not events:
+        return []
+
+    with session_scope() as session:
+        store_ids = {event["store_id"] for event in events}
+        known = set(session.execute(select(Store.store_id).where(Store.store_id.in_(store_ids))).scalars())
+        unknown = [
+            {"row": row, "error": f"存在しない store_id です: {event['store_id']}"}
+            for row, event in enumerate(events, start=1) if event["store_id"] not in known
+        ]
+        if unknown:
+            raise EventValidationError(unknown)
+        event_ids = crud.insert_events_with_tags(session, events, tag_lists)
+        # 近くのイベント検索・レコメンドの距離に使う位置をエリア名から求める
+        geo.geocode_events(session, event_ids)
+
+    logger.info("イベントを登録しました: %d 件", len(event_ids))
+    feature_store.invalidate()
+    geo.invalidate()
+    event_search.add_events(event_ids)
+    # 一覧・カレンダー・タグの読み取りキャッシュは次のリクエストで取り直す
+    resilience.read_cache.expire()
+    pubsub.publish_events_created([
+        {"event_id": event_id, "store_id": event["store_id"], "event_name": event["event_name"],
+         "start_date": event["start_date"].isoformat(), "end_date": event["end_date"].isoformat(),
+         "area": event.get("area")}
+        for event_id, event in zip(event_ids, events)
+    ])
+    return event_ids
+
+def register_event(fields: Dict, tags: List[str], flyer=None, event_image=None) -> Dict:
+    """フォームからの1件登録: 検証 → ファイル保存 → DB登録（失敗したら Blob を削除）"""
+    # ファイルを上げる前に検証して、不正な入力で Blob が残らないようにする
+    prepare_event({**fields, "tags": tags})
+
+    uploaded = []
+    try:
+        flyer_url = blob_storage.upload_file(flyer) if flyer else None
+        uploaded.append(flyer_url)
+        event_image_url = blob_storage.upload_file(event_image) if event_image else None
+        uploaded.append(event_image_url)
+
+        event_id = create_events([{
+            **fields,
+            "tags": tags,
+            "flyer_url": flyer_url,
+            "event_image_url": event_image_url,
+        }])[0]
+    except Exception:
+        blob_storage.delete_blobs(uploaded)
+        raise
+
+    return {"event_id": event_id, "flyer_url": flyer_url, "event_image_url": event_image_url}
+
+
+def parse_events_csv(content: bytes) -> List[Dict]:
+    """CSV（1行目がヘッダー、列名は Events の列名 + tags）をイベント入力のリストにする"""
+    text = content.decode("utf-8-sig")
+    return [dict(row) for row in csv.DictReader(io.StringIO(text))]
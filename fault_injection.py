@@ -0,0 +1,182 @@
+# fault_injection.py
+"""
+外部依存の障害時に、他のエンドポイントが巻き込まれないかを確かめる障害注入テスト（DB・ネットワーク不要）
+
+AnyIO の既定のスレッドプール（40本）を ThreadPoolExecutor で再現し、一定のレートでリクエストを投げる。
+- 健全なリクエスト: 依存を使わない処理（数ミリ秒）
+- 依存を使うリクエスト: 疑似の依存（SendGrid・Blob の代わり）を呼ぶ。障害中はタイムアウトまで応答しない
+
+次のシナリオで、健全なリクエストのスループットと p99 を比べる（待ち時間はキューに入ってからの時間）。
+    baseline      依存は正常
+    unprotected   依存が停止し、タイムアウトまで待つ（スレッドが埋まり健全なリクエストも遅れる）
+    protected     同じ障害で resilience のバルクヘッド + サーキットブレーカーを通す
+    stale         DB が停止しても、読み取りキャッシュが古い値を返し続けるか
+
+使い方:
+    python fault_injection.py --rate 400 --duration 3 --dependent-ratio 0.2 --timeout 2
+"""
+import argparse
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import resilience
+
+# AnyIO（Starlette の run_in_threadpool）の既定のスレッド数
+THREADPOOL_SIZE = 40
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(int(round(p / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+class FakeDependency:
+    """応答時間を切り替えられる疑似の依存。障害中はタイムアウトまで待ってから失敗する"""
+
+    def __init__(self, latency: float, timeout: float):
+        self.latency = latency
+        self.timeout = timeout
+        self.down = False
+
+    def call(self):
+        if self.down:
+            time.sleep(self.timeout)
+            raise TimeoutError("疑似依存がタイムアウトしました")
+        time.sleep(self.latency)
+        return "ok"
+
+
+def run_load(rate: float, duration: float, dependent_ratio: float,
+             dependent: Callable[[], str], healthy_work: float) -> Dict:
+    """一定レートでリクエストを投げ、健全・依存ありのリクエストごとの結果を集計する"""
+    results = {"healthy": [], "dependent_ok": [], "dependent_failed": [], "rejected": []}
+    lock = threading.Lock()
+    finished_in_time = [0]
+
+    def healthy(scheduled: float):
+        time.sleep(healthy_work)
+        now = time.perf_counter()
+        with lock:
+            results["healthy"].append(now - scheduled)
+            finished_in_time[0] += now - started <= duration
+
+    def with_dependency(scheduled: float):
+        try:
+            dependent()
+            kind = "dependent_ok"
+        except resilience.DependencyUnavailableError:
+            kind = "rejected"  # app.py では即座に 503 + Retry-After
+        except Exception:
+            kind = "dependent_failed"
+        with lock:
+            results[kind].append(time.perf_counter() - scheduled)
+
+    interval = 1.0 / rate
+    every = max(int(round(1 / dependent_ratio)), 1) if dependent_ratio > 0 else 0
+    executor = ThreadPoolExecutor(THREADPOOL_SIZE)
+    started = time.perf_counter()
+    sent = 0
+    while True:
+        scheduled = started + sent * interval
+        if scheduled - started >= duration:
+            break
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        if every and sent % every == 0:
+            executor.submit(with_dependency, scheduled)
+        else:
+            executor.submit(healthy, scheduled)
+        sent += 1
+    # 期間内に終わらなかった分も待って遅延に含める（スループットは期間内に終わった分だけ数える）
+    executor.shutdown(wait=True)
+    return {
+        "healthy_throughput": finished_in_time[0] / duration,
+        "healthy_p50_ms": percentile(results["healthy"], 50) * 1000,
+        "healthy_p99_ms": percentile(results["healthy"], 99) * 1000,
+        "dependent_ok": len(results["dependent_ok"]),
+        "dependent_failed": len(results["dependent_failed"]),
+        "rejected": len(results["rejected"]),
+        "dependent_p99_ms": percentile(results["dependent_failed"] + results["rejected"]
+                                       + results["dependent_ok"], 99) * 1000,
+    }
+
+
+def run_stale_scenario(requests: int, ttl: float) -> Dict:
+    """DB が落ちた後も、読み取りキャッシュが最後に取れた値を返し続けるか"""
+    cache = resilience.StaleWhileRevalidateCache(ttl=ttl, stale_max_age=3600)
+    db = {"down": False, "loads": 0}
+
+    def load():
+        if db["down"]:
+            raise ConnectionError("疑似DBに接続できません")
+        db["loads"] += 1
+        return ["event-1", "event-2"]
+
+    cache.get("events/upcoming", load)  # 正常なうちに1回読んでおく
+    db["down"] = True
+    served, errors = 0, 0
+    for _ in range(requests):
+        time.sleep(ttl / 10)
+        try:
+            value, _ = cache.get("events/upcoming", load)
+            served += value is not None
+        except Exception:
+            errors += 1
+    time.sleep(0.05)  # 裏の取り直しスレッドの終了を待つ
+    return {"served": served, "errors": errors, **cache.metrics()}
+
+
+def print_result(name: str, result: Dict):
+    print(f"{name:12s} healthy={result['healthy_throughput']:7.1f} req/s "
+          f"p50={result['healthy_p50_ms']:7.1f}ms p99={result['healthy_p99_ms']:8.1f}ms | "
+          f"依存 ok={result['dependent_ok']} failed={result['dependent_failed']} "
+          f"503={result['rejected']} p99={result['dependent_p99_ms']:.0f}ms")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="外部依存の障害注入テスト（疑似依存）")
+    parser.add_argument("--rate", type=float, default=400, help="1秒あたりのリクエスト数")
+    parser.add_argument("--duration", type=float, default=3.0, help="シナリオごとの実行秒数")
+    parser.add_argument("--dependent-ratio", type=float, default=0.2, help="依存を使うリクエストの割合")
+    parser.add_argument("--latency", type=float, default=0.02, help="正常時の依存の応答時間（秒）")
+    parser.add_argument("--timeout", type=float, default=2.0, help="障害時に依存を待つ秒数（クライアントのタイムアウト）")
+    parser.add_argument("--healthy-work", type=float, default=0.005, help="健全なリクエストの処理時間（秒）")
+    parser.add_argument("--max-concurrent", type=int, default=8, help="依存のバルクヘッドの上限")
+    parser.add_argument("--p99-budget-ms", type=float, default=100.0, help="障害中の健全なリクエストの p99 の予算")
+    args = parser.parse_args(argv)
+
+    fake = FakeDependency(args.latency, args.timeout)
+    load = dict(rate=args.rate, duration=args.duration, dependent_ratio=args.dependent_ratio,
+                healthy_work=args.healthy_work)
+
+    baseline = run_load(dependent=fake.call, **load)
+    print_result("baseline", baseline)
+
+    fake.down = True
+    unprotected = run_load(dependent=fake.call, **load)
+    print_result("unprotected", unprotected)
+
+    dependency = resilience.Dependency("fake", max_concurrent=args.max_concurrent, bulkhead_wait=0.01,
+                                       failure_threshold=5, reset_timeout=args.duration * 2)
+    protected = run_load(dependent=lambda: dependency.call(fake.call), **load)
+    print_result("protected", protected)
+    print(f"{'':12s} ブレーカー: {dependency.metrics()}")
+
+    stale = run_stale_scenario(requests=50, ttl=0.2)
+    print(f"{'stale':12s} DB停止中の読み取り: 返せた={stale['served']} 失敗={stale['errors']} "
+          f"(stale_hits={stale['stale_hits']} refresh_failures={stale['refresh_failures']})")
+
+    ok = protected["healthy_p99_ms"] <= args.p99_budget_ms and stale["errors"] == 0
+    print("OK" if ok else "NG: 障害中に健全なリクエストが予算を超えて遅れたか、古い値を返せませんでした")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,546 @@
+# feature_store.py
+"""
+レコメンド用の特徴量スナップショット
+
+ユーザー特徴量（cosine 類似度用に行正規化済み）、ユーザー×お気に入りイベントの疎行列、
+表示用のイベント情報をまとめて1つのスナップショットとして構築し、プロセス内にキャッシュする。
+推薦リクエストごとに DB から全件を読み直さないためのもの。
+
+FEATURE_STORE_DIR を設定した場合はローダープロセス（python feature_store.py）が構築・公開し、
+ワーカーは公開済みのファイルを mmap で読むだけになる。
+"""
+import json
+import os
+import shutil
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from fastapi import HTTPException
+from scipy import sparse
+from sklearn.preprocessing import MinMaxScaler
+from sqlalchemy import text
+
+from logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# スナップショットの有効期限（秒）と、invalidate 後に再構築するまでの最短間隔（秒）
+SNAPSHOT_TTL = int(os.getenv("FEATURE_SNAPSHOT_TTL", "300"))
+MIN_REBUILD_INTERVAL = int(os.getenv("FEATURE_SNAPSHOT_MIN_REBUILD", "10"))
+
+
+def _session_scope():
+    # crud は import 時にアプリの DB に接続する。--database-url で別の DB を読む recommend_eval のために、使うときに import する
+    from db_control.crud import session_scope
+    return session_scope()
+
+
+# データ取得関数
+def get_user_data(session, as_of: Optional[datetime] = None) -> pd.DataFrame:
+    """ユーザーデータを取得し前処理する（as_of 指定時はそれ以前に登録したユーザーのみ）"""
+    query_users = text("""
+    SELECT user_id, gender, relationship_id, postal_code, birth_date
+    FROM Users
+    WHERE (:as_of IS NULL OR created_at < :as_of)
+    """)
+    result_users = session.execute(query_users, {"as_of": as_of}).fetchall()
+    if not result_users:
+        raise HTTPException(status_code=404, detail="ユーザーデータが見つかりません")
+
+    # 結果をDataFrameに変換
+    df_users = pd.DataFrame(result_users)
+
+    # 性別を数値に変換
+    df_users["gender"] = df_users["gender"].map({"M": 0, "F": 1, "U": 2})
+
+    # 年齢の計算
+    df_users["age"] = pd.to_datetime(as_of or "today").year - pd.to_datetime(df_users["birth_date"]).dt.year
+    df_users.drop(columns=["birth_date"], inplace=True)
+
+    # 年齢のMin-Maxスケーリング
+    scaler = MinMaxScaler()
+    df_users["age"] = scaler.fit_transform(df_users[["age"]])
+
+    # 続柄は ID の大小に意味がないので、数値のままではなくカテゴリとしてワンホットにする（未設定は全列 0）
+    df_users["relationship_id"] = df_users["relationship_id"].astype("Int64")
+    df_users = pd.get_dummies(df_users, columns=["relationship_id"], prefix="relationship")
+
+    # 郵便番号をワンホットエンコーディング
+    df_users = pd.get_dummies(df_users, columns=["postal_code"])
+    return df_users
+
+def get_user_tags(session, as_of: Optional[datetime] = None) -> pd.DataFrame:
+    """ユーザータグデータを取得しワンホットエンコーディングする（as_of 指定時はそれ以前に登録したユーザーのみ）"""
+    query_tags = text("""
+    SELECT DISTINCT u.user_id, t.tag_name
+    FROM UserTags u
+    JOIN Tags t ON u.tag_id = t.tag_id
+    JOIN Users us ON u.user_id = us.user_id
+    WHERE (:as_of IS NULL OR us.created_at < :as_of)
+    """)
+    result_tags = session.execute(query_tags, {"as_of": as_of}).fetchall()
+
+    # タグのワンホットエンコーディング
+    if result_tags:
+        df_tags = pd.DataFrame(result_tags)
+        df_tags_onehot = df_tags.pivot_table(
+            index="user_id", columns="tag_name", aggfunc="size", fill_value=0
+        )
+        return df_tags_onehot.add_prefix("tag_")
+    else:
+        # タグがない場合は空のDataFrameを作成
+        return pd.DataFrame()
+
+def get_transaction_data(session, as_of: Optional[datetime] = None) -> pd.DataFrame:
+    """ポイント取引データを取得しワンホットエンコーディングする（as_of 指定時はそれ以前の取引のみ）"""
+    query_transactions = text("""
+    SELECT user_id, store_id
+    FROM PointTransaction
+    WHERE user_id IS NOT NULL
+      AND (:as_of IS NULL OR transaction_at < :as_of)
+    """)
+    result_transactions = session.execute(query_transactions, {"as_of": as_of}).fetchall()
+
+    # 取引のワンホットエンコーディング
+    if result_transactions:
+        df_transactions = pd.DataFrame(result_transactions)
+        df_transactions_onehot = df_transactions.pivot_table(
+            index="user_id", columns="store_id", aggfunc="size", fill_value=0
+        )
+        return df_transactions_onehot.add_prefix("store_")
+    else:
+        # 取引がない場合は空のDataFrameを作成
+        return pd.DataFrame()
+
+def get_favorite_pairs(session, as_of: Optional[datetime] = None) -> pd.DataFrame:
+    """お気に入りの (user_id, event_id) を取得する（as_of 指定時はそれ以前の登録のみ）"""
+    query_fav = text("""
+    SELECT DISTINCT user_id, event_id
+    FROM FavoriteEvents
+    WHERE (:as_of IS NULL OR created_at < :as_of)
+    """)
+    result_fav = session.execute(query_fav, {"as_of": as_of}).fetchall()
+    return pd.DataFrame(result_fav, columns=["user_id", "event_id"])
+
+def get_favorite_events_onehot(session, as_of: Optional[datetime] = None,
+                               df_fav: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """お気に入りイベントをワンホットエンコーディングする"""
+    if df_fav is None:
+        df_fav = get_favorite_pairs(session, as_of)
+
+    if not df_fav.empty:
+        df_fav_onehot = df_fav.pivot_table(
+            index="user_id", columns="event_id", aggfunc="size", fill_value=0
+        )
+        return df_fav_onehot.add_prefix("fav_event_")
+    else:
+        return pd.DataFrame()
+
+def get_event_tag_names(session) -> Dict[int, List[str]]:
+    """全イベントのタグ名を1クエリで取得する"""
+    query = text("""
+    SELECT et.event_id, t.tag_name
+    FROM EventTags et
+    JOIN Tags t ON et.tag_id = t.tag_id
+    ORDER BY et.event_id, t.tag_id
+    """)
+    tags_by_event: Dict[int, List[str]] = {}
+    for row in session.execute(query):
+        tags_by_event.setdefault(row.event_id, []).append(row.tag_name)
+    return tags_by_event
+
+
+def build_user_features(session, as_of: Optional[datetime] = None,
+                        df_fav: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """ユーザー × 特徴量の DataFrame（df_final）を作る"""
+    df_users = get_user_data(session, as_of)
+    df_tags_onehot = get_user_tags(session, as_of)
+    df_transactions_onehot = get_transaction_data(session, as_of)
+    df_fav_events_onehot = get_favorite_events_onehot(session, as_of, df_fav)
+
+    onehot_columns = [col for col in df_users.columns if col.startswith(("postal_code", "relationship_"))]
+    df_users[onehot_columns] = df_users[onehot_columns].astype(int)
+
+    df_final = df_users.set_index("user_id")
+    if not df_tags_onehot.empty:
+        df_final = df_final.join(df_tags_onehot, how="left")
+    if not df_transactions_onehot.empty:
+        df_final = df_final.join(df_transactions_onehot, how="left")
+    if not df_fav_events_onehot.empty:
+        df_final = df_final.join(df_fav_events_onehot, how="left")
+
+    # 欠損値を0で埋める
+    return df_final.fillna(0)
+
+
+class FeatureSnapshot:
+    """ある時点の推薦用データ一式（読み取り専用として扱う）
+
+    user_ids     np.int64 (n_users,)
+    features     np.float32 (n_users, n_features) 行ごとにL2正規化済み
+    favorites    scipy.sparse.csr_matrix (n_users, n_events)
+    event_ids    np.int64 (n_events,)
+    event_start  np.int32 (n_events,) 開始日の序数
+    event_end    np.int32 (n_events,) 終了日の序数
+    tag_ids      np.int64 (n_tags,)
+    user_tags    scipy.sparse.csr_matrix (n_users, n_tags) 0/1
+    event_tags   scipy.sparse.csr_matrix (n_events, n_tags) 行ごとにL2正規化済み
+    user_location  np.float32 (n_users, 2) 郵便番号から求めた緯度・経度（不明は NaN）
+    event_location np.float32 (n_events, 2) イベントの緯度・経度（不明は NaN）
+    user_family  np.int64 (n_users,) 家族ID（家族未登録は -1）
+    events       event_id -> 表示用 dict
+    """
+    # 共有ファイルへ書き出す配列（密行列 / CSR疎行列）
+    DENSE_FIELDS = ("user_ids", "features", "event_ids", "event_start", "event_end", "tag_ids",
+                    "user_location", "event_location", "user_family")
+    SPARSE_FIELDS = ("favorites", "user_tags", "event_tags")
+
+    def __init__(self, events: Dict[int, dict], built_at: datetime, version: Optional[str] = None, **arrays):
+        for name in self.DENSE_FIELDS + self.SPARSE_FIELDS:
+            setattr(self, name, arrays[name])
+        self.events = events
+        self.built_at = built_at
+        self.version = version or built_at.strftime("%Y%m%d%H%M%S%f")
+        self.user_index = {int(u): i for i, u in enumerate(self.user_ids)}
+        self.event_index = {int(e): i for i, e in enumerate(self.event_ids)}
+        self.tag_index = {int(t): i for i, t in enumerate(self.tag_ids)}
+
+    def family_rows(self, user_id: int) -> np.ndarray:
+        """同じ家族のユーザーの行（本人を含む）。家族未登録なら本人の行だけ"""
+        row = self.user_index.get(user_id)
+        if row is None:
+            return np.empty(0, dtype=np.int64)
+        family_id = self.user_family[row]
+        if family_id < 0:
+            return np.array([row], dtype=np.int64)
+        return np.flatnonzero(self.user_family == family_id)
+
+
+def build_snapshot(session, as_of: Optional[datetime] = None) -> FeatureSnapshot:
+    """DB からスナップショットを構築する（as_of 指定時はその時点までのユーザー・取引・お気に入りで作る）"""
+    df_fav = get_favorite_pairs(session, as_of)
+    df_final = build_user_features(session, as_of, df_fav)
+
+    user_ids = df_final.index.to_numpy(dtype=np.int64)
+    features = df_final.to_numpy(dtype=np.float32)
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    features /= norms
+
+    event_rows = session.execute(text("""
+    SELECT event_id, event_name, description, start_date, end_date,
+           flyer_url, event_image_url, area
+    FROM Events
+    ORDER BY start_date ASC, event_id ASC
+    """)).fetchall()
+    tags_by_event = get_event_tag_names(session)
+
+    event_ids = np.array([r.event_id for r in event_rows], dtype=np.int64)
+    event_start = np.array([r.start_date.toordinal() for r in event_rows], dtype=np.int32)
+    event_end = np.array([r.end_date.toordinal() for r in event_rows], dtype=np.int32)
+    events = {
+        r.event_id: {
+            "id": str(r.event_id),
+            "imageUrl": r.event_image_url or r.flyer_url,
+            "area": r.area,
+            "title": r.event_name,
+            "date": r.start_date.strftime("%Y/%m/%d") if r.start_date else None,
+            "tags": tags_by_event.get(r.event_id, []),
+            "description": r.description,
+            "points": None,
+        }
+        for r in event_rows
+    }
+
+    user_index = {int(u): i for i, u in enumerate(user_ids)}
+    event_index = {int(e): i for i, e in enumerate(event_ids)}
+    favorites = _pairs_to_csr(
+        zip(df_fav["user_id"], df_fav["event_id"]), user_index, event_index,
+        (len(user_ids), len(event_ids)),
+    )
+
+    # コンテンツベース推薦用のタグ行列
+    tag_ids = np.array(
+        [r.tag_id for r in session.execute(text("SELECT tag_id FROM Tags ORDER BY tag_id"))],
+        dtype=np.int64,
+    )
+    tag_index = {int(t): i for i, t in enumerate(tag_ids)}
+    user_tag_rows = session.execute(text("SELECT DISTINCT user_id, tag_id FROM UserTags")).fetchall()
+    event_tag_rows = session.execute(text("SELECT DISTINCT event_id, tag_id FROM EventTags")).fetchall()
+    user_tags = _pairs_to_csr(user_tag_rows, user_index, tag_index, (len(user_ids), len(tag_ids)))
+    event_tags = _pairs_to_csr(event_tag_rows, event_index, tag_index, (len(event_ids), len(tag_ids)))
+    event_tag_norms = np.sqrt(np.asarray(event_tags.sum(axis=1)).ravel())
+    event_tag_norms[event_tag_norms == 0] = 1.0
+    event_tags = sparse.csr_matrix(sparse.diags(1.0 / event_tag_norms, dtype=np.float32) @ event_tags)
+
+    # レコメンドの距離の重み用の位置（郵便番号データ・イベント位置がなければ NaN のまま）
+    user_location = _locations(session.execute(text("""
+    SELECT u.user_id, p.latitude, p.longitude
+    FROM Users u
+    JOIN PostalCodeLocations p ON p.postal_code = REPLACE(u.postal_code, '-', '')
+    """)), user_index)
+    event_location = _locations(session.execute(text(
+        "SELECT event_id, latitude, longitude FROM EventLocations"
+    )), event_index)
+
+    # 世帯単位の推薦・集計用の家族ID
+    user_family = np.full(len(user_ids), -1, dtype=np.int64)
+    for user_id, family_id in session.execute(text(
+        "SELECT user_id, family_id FROM Users WHERE family_id IS NOT NULL"
+    )):
+        if user_id in user_index:
+            user_family[user_index[user_id]] = family_id
+
+    return FeatureSnapshot(
+        events, built_at=datetime.now(),
+        user_ids=user_ids, features=features, favorites=favorites,
+        event_ids=event_ids, event_start=event_start, event_end=event_end,
+        tag_ids=tag_ids, user_tags=user_tags, event_tags=event_tags,
+        user_location=user_location, event_location=event_location, user_family=user_family,
+    )
+
+def _locations(rows, index: Dict[int, int]) -> np.ndarray:
+    """(ID, 緯度, 経度) の行を index の並びの (n, 2) 配列にする"""
+    locations = np.full((len(index), 2), np.nan, dtype=np.float32)
+    for key, latitude, longitude in rows:
+        if key in index:
+            locations[index[key]] = (latitude, longitude)
+    return locations
+
+def _pairs_to_csr(pairs, row_index: Dict[int, int], col_index: Dict[int, int], shape) -> sparse.csr_matrix:
+    """(行ID, 列ID) の組から 0/1 の CSR 行列を作る（インデックスにないIDは捨てる）"""
+    kept = [(row_index[a], col_index[b]) for a, b in pairs if a in row_index and b in col_index]
+    rows = np.array([k[0] for k in kept], dtype=np.int32)
+    cols = np.array([k[1] for k in kept], dtype=np.int32)
+    return sparse.csr_matrix((np.ones(len(kept), dtype=np.float32), (rows, cols)), shape=shape)
+
+
+# ───── 共有ファイルへの公開（gunicorn の複数ワーカー向け） ─────
+# FEATURE_STORE_DIR を設定すると、ローダープロセスが構築したスナップショットを
+# バージョンごとのディレクトリに .npy で書き出し、各ワーカーは mmap で読むだけになる。
+# ページキャッシュを共有するため、ワーカー数が増えてもメモリは1コピー分で済む。
+FEATURE_STORE_DIR = os.getenv("FEATURE_STORE_DIR")
+CURRENT_FILE = "CURRENT"
+REBUILD_FILE = "REBUILD"
+# ワーカーが CURRENT を確認する間隔（秒）
+POLL_INTERVAL = float(os.getenv("FEATURE_STORE_POLL_INTERVAL", "2"))
+# 残しておく旧バージョン数（読み込み中のワーカーのため）
+KEEP_VERSIONS = 3
+
+def publish_snapshot(snapshot: FeatureSnapshot, directory: str) -> str:
+    """スナップショットを書き出し、CURRENT を差し替えて公開する"""
+    os.makedirs(directory, exist_ok=True)
+    version_dir = os.path.join(directory, f"v{snapshot.version}")
+    tmp_dir = os.path.join(directory, f".tmp-{snapshot.version}-{os.getpid()}")
+    os.makedirs(tmp_dir)
+
+    for name in snapshot.DENSE_FIELDS:
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), np.ascontiguousarray(getattr(snapshot, name)))
+    for name in snapshot.SPARSE_FIELDS:
+        matrix = getattr(snapshot, name).tocsr()
+        np.save(os.path.join(tmp_dir, f"{name}.data.npy"), matrix.data)
+        np.save(os.path.join(tmp_dir, f"{name}.indices.npy"), matrix.indices)
+        np.save(os.path.join(tmp_dir, f"{name}.indptr.npy"), matrix.indptr)
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "version": snapshot.version,
+            "built_at": snapshot.built_at.isoformat(),
+            "shapes": {name: list(getattr(snapshot, name).shape) for name in snapshot.SPARSE_FIELDS},
+            "events": {str(k): v for k, v in snapshot.events.items()},
+        }, f, ensure_ascii=False)
+
+    # ディレクトリ名の変更 → CURRENT の置き換え、の順にどちらもアトミックに行う
+    os.rename(tmp_dir, version_dir)
+    tmp_current = os.path.join(directory, f".{CURRENT_FILE}.{os.getpid()}")
+    with open(tmp_current, "w", encoding="utf-8") as f:
+        f.write(snapshot.version)
+    os.replace(tmp_current, os.path.join(directory, CURRENT_FILE))
+
+    _remove_old_versions(directory, snapshot.version)
+    return snapshot.version
+
+def _remove_old_versions(directory: str, current: str):
+    versions = sorted(
+        name for name in os.listdir(directory)
+        if name.startswith("v") and os.path.isdir(os.path.join(directory, name))
+    )
+    for name in versions[:-KEEP_VERSIONS]:
+        if name != f"v{current}":
+            # mmap 中のワーカーがいても、Linux では開いているファイルは消えない
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+def read_current_version(directory: str) -> Optional[str]:
+    try:
+        with open(os.path.join(directory, CURRENT_FILE), encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def load_published(directory: str, version: str) -> FeatureSnapshot:
+    """公開済みスナップショットを mmap で読み込む（配列はコピーされない）"""
+    version_dir = os.path.join(directory, f"v{version}")
+    with open(os.path.join(version_dir, "meta.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+
+    def load(name):
+        return np.load(os.path.join(version_dir, f"{name}.npy"), mmap_mode="r")
+
+    arrays = {name: load(name) for name in FeatureSnapshot.DENSE_FIELDS
+              if os.path.exists(os.path.join(version_dir, f"{name}.npy"))}
+    # 位置・家族の配列がない旧バージョンは、位置不明・家族未登録として扱う
+    for name, ids in (("user_location", "user_ids"), ("event_location", "event_ids")):
+        if name not in arrays:
+            arrays[name] = np.full((len(arrays[ids]), 2), np.nan, dtype=np.float32)
+    if "user_family" not in arrays:
+        arrays["user_family"] = np.full(len(arrays["user_ids"]), -1, dtype=np.int64)
+    for name in FeatureSnapshot.SPARSE_FIELDS:
+        arrays[name] = sparse.csr_matrix(
+            (load(f"{name}.data"), load(f"{name}.indices"), load(f"{name}.indptr")),
+            shape=tuple(meta["shapes"][name]),
+            copy=False,
+        )
+    events = {int(k): v for k, v in meta["events"].items()}
+    return FeatureSnapshot(events, built_at=datetime.fromisoformat(meta["built_at"]),
+                           version=meta["version"], **arrays)
+
+def request_rebuild(directory: str):
+    """ローダープロセスに再構築を依頼する（マーカーファイルを置くだけ）"""
+    try:
+        with open(os.path.join(directory, REBUILD_FILE), "w", encoding="utf-8") as f:
+            f.write(str(time.time()))
+    except OSError as e:
+        logger.warning("再構築マーカーの作成に失敗しました: %s", e)
+
+def run_loader(directory: str, interval: int = SNAPSHOT_TTL):
+    """ローダープロセスの本体: 一定間隔または再構築依頼ごとにスナップショットを公開する"""
+    logger.info("特徴量ローダーを開始します: dir=%s, interval=%ss", directory, interval)
+    marker = os.path.join(directory, REBUILD_FILE)
+    while True:
+        started = time.monotonic()
+        try:
+            if os.path.exists(marker):
+                os.remove(marker)
+            with _session_scope() as session:
+                snapshot = build_snapshot(session)
+            version = publish_snapshot(snapshot, directory)
+            logger.info("スナップショットを公開しました: version=%s, users=%d, events=%d, %.2fs",
+                        version, len(snapshot.user_ids), len(snapshot.event_ids), time.monotonic() - started)
+        except Exception as e:
+            logger.exception("スナップショットの公開に失敗しました: %s", e)
+
+        # 次の定期再構築まで待つ（再構築依頼があれば最短間隔を空けて前倒しする）
+        while time.monotonic() - started < interval:
+            time.sleep(1)
+            if os.path.exists(marker) and time.monotonic() - started >= MIN_REBUILD_INTERVAL:
+                break
+
+
+# ───── プロセス内キャッシュ ─────
+_snapshot: Optional[FeatureSnapshot] = None
+_built_monotonic = 0.0
+_checked_monotonic = 0.0
+_stale = False
+_lock = threading.Lock()
+
+def _needs_refresh() -> bool:
+    age = time.monotonic() - _built_monotonic
+    return age > SNAPSHOT_TTL or (_stale and age > MIN_REBUILD_INTERVAL)
+
+def _get_published_snapshot() -> Optional[FeatureSnapshot]:
+    """共有ディレクトリの CURRENT が変わっていれば新しいバージョンに差し替える"""
+    global _snapshot, _checked_monotonic
+    snapshot = _snapshot
+    if snapshot is not None and time.monotonic() - _checked_monotonic < POLL_INTERVAL:
+        return snapshot
+    _checked_monotonic = time.monotonic()
+
+    version = read_current_version(FEATURE_STORE_DIR)
+    if version is None or (snapshot is not None and snapshot.version == version):
+        return snapshot
+    with _lock:
+        if _snapshot is None or _snapshot.version != version:
+            # 参照の代入はアトミックなので、処理中のリクエストは旧バージョンを使い切る
+            _snapshot = load_published(FEATURE_STORE_DIR, version)
+            forget_new_user_tags(_snapshot)
+            logger.info("公開済みスナップショットに切り替えました: version=%s", version)
+        return _snapshot
+
+def get_snapshot() -> FeatureSnapshot:
+    """キャッシュ済みのスナップショットを返す（期限切れなら再構築する）"""
+    global _snapshot, _built_monotonic, _stale
+    if FEATURE_STORE_DIR:
+        published = _get_published_snapshot()
+        if published is not None:
+            return published
+        # ローダーがまだ公開していない間だけ自前で構築する
+
+    snapshot = _snapshot
+    if snapshot is not None and not _needs_refresh():
+        return snapshot
+
+    # 既にスナップショットがあれば、他スレッドが再構築中の間は古いものを返す
+    if not _lock.acquire(blocking=snapshot is None):
+        return snapshot
+    try:
+        if _snapshot is None or _needs_refresh():
+            with _session_scope() as session:
+                _snapshot = build_snapshot(session)
+            _built_monotonic = time.monotonic()
+            forget_new_user_tags(_snapshot)
+            _stale = False
+            logger.info("特徴量スナップショットを再構築しました: users=%d, events=%d", len(_snapshot.user_ids), len(_snapshot.event_ids))
+        return _snapshot
+    finally:
+        _lock.release()
+
+# スナップショット構築後に登録された新規ユーザーの興味タグ（user_id -> tag_id のリスト）
+# リクエストのスレッドが書き、スナップショットの切り替えが走査するので _new_user_tags_lock で守る
+_new_user_tags: Dict[int, List[int]] = {}
+_new_user_tags_lock = threading.Lock()
+
+def note_user_tags(user_id: int, tag_ids: List[int], replace: bool = True):
+    """新規登録直後のユーザーの興味タグを覚えておき、次の再構築を待たずに推薦に使う"""
+    with _new_user_tags_lock:
+        if replace:
+            _new_user_tags[user_id] = list(tag_ids)
+        else:
+            _new_user_tags[user_id] = sorted(set(_new_user_tags.get(user_id, [])) | set(tag_ids))
+    invalidate()
+
+def get_new_user_tags(user_id: int) -> Optional[List[int]]:
+    return _new_user_tags.get(user_id)
+
+def forget_new_user_tags(snapshot: FeatureSnapshot):
+    """スナップショットに取り込まれたユーザーの分を捨てる"""
+    with _new_user_tags_lock:
+        for user_id in [u for u in _new_user_tags if u in snapshot.user_index]:
+            del _new_user_tags[user_id]
+
+def invalidate():
+    """お気に入り等の更新時に呼ぶ（次回取得時に再構築される）"""
+    global _stale
+    _stale = True
+    if FEATURE_STORE_DIR:
+        request_rebuild(FEATURE_STORE_DIR)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="特徴量スナップショットのローダープロセス")
+    parser.add_argument("--dir", default=FEATURE_STORE_DIR, help="公開先ディレクトリ（既定: FEATURE_STORE_DIR）")
+    parser.add_argument("--interval", type=int, default=SNAPSHOT_TTL, help="定期再構築の間隔（秒）")
+    parser.add_argument("--once", action="store_true", help="1回だけ構築して終了する")
+    args = parser.parse_args()
+    if not args.dir:
+        parser.error("--dir か FEATURE_STORE_DIR を指定してください")
+
+    if args.once:
+        with _session_scope() as session:
+            print(f"version={publish_snapshot(build_snapshot(session), args.dir)}")
+    else:
+        run_loader(args.dir, args.interval)
@@ -0,0 +1,300 @@
+# geo.py
+"""
+位置情報とエリアを考慮したイベント検索
+
+- PostalCodeLocations: 郵便番号 → 緯度経度（ローカルの CSV から読み込む）
+- EventLocations: イベントの位置。エリア名（例: 福岡市中央区）に一致する市区町村の郵便番号の重心を使う
+  （source='manual' の行は手入力の位置として上書きしない）
+- 近くのイベント検索は、開催中・開催予定のイベントをメモリ上のグリッド索引に入れ、
+  検索半径にかかるセルだけを見る（全イベントを走査しない）
+
+使い方:
+    python geo.py load-postal-codes postal_codes.csv   # 列: postal_code,latitude,longitude[,prefecture,city,town]
+    python geo.py geocode-events [--all]
+"""
+import csv
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import select, text
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from db_control.crud import session_scope
+from db_control.mymodels_MySQL import PostalCodeLocation, EventLocation
+
+EARTH_RADIUS_KM = 6371.0
+# グリッドのセルの大きさ（度）。緯度方向で約 5.5km
+CELL_DEG = 0.05
+# 索引の作り直し間隔（秒）。イベント登録時は invalidate() で前倒しする
+INDEX_TTL = int(os.getenv("GEO_INDEX_TTL", "300"))
+# エリア名 → 重心 の表の再読み込み間隔（秒）
+AREA_CENTROID_TTL = 3600
+# プロセス内に持つ郵便番号の位置の件数
+POSTAL_CACHE_SIZE = 4096
+
+
+def normalize_postal_code(value: Optional[str]) -> Optional[str]:
+    """"812-0011" / "〒8120011" などを "8120011" にする（7桁にならなければ None）"""
+    if not value:
+        return None
+    digits = "".join(ch for ch in str(value) if ch.isdigit())
+    return digits if len(digits) == 7 else None
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+def haversine_km_array(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """1点から複数点への距離（km）。座標が NaN の点は NaN になる"""
+    p1, p2 = np.radians(lat), np.radians(lats)
+    a = np.sin((p2 - p1) / 2) ** 2 + np.cos(p1) * np.cos(p2) * np.sin(np.radians(lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+# ───── 郵便番号データ ─────
+def load_postal_codes(path: str, batch_size: int = 5000) -> int:
+    """郵便番号 CSV を PostalCodeLocations に取り込む（既存の郵便番号は上書き）"""
+    count = 0
+    batch: List[Dict] = []
+
+    def flush():
+        if not batch:
+            return
+        stmt = mysql_insert(PostalCodeLocation).values(batch)
+        with session_scope() as session:
+            session.execute(stmt.on_duplicate_key_update(
+                latitude=stmt.inserted.latitude, longitude=stmt.inserted.longitude,
+                prefecture=stmt.inserted.prefecture, city=stmt.inserted.city, town=stmt.inserted.town,
+            ))
+
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        for row in csv.DictReader(f):
+            postal_code = normalize_postal_code(row.get("postal_code"))
+            if postal_code is None or not row.get("latitude") or not row.get("longitude"):
+                continue
+            batch.append({
+                "postal_code": postal_code,
+                "latitude": float(row["latitude"]),
+                "longitude": float(row["longitude"]),
+                "prefecture": row.get("prefecture") or None,
+                "city": row.get("city") or None,
+                "town": row.get("town") or None,
+            })
+            if len(batch) >= batch_size:
+                flush()
+                count += len(batch)
+                batch = []
+    flush()
+    count += len(batch)
+    with _postal_cache_lock:
+        _postal_cache.clear()
+    return count
+
+# 郵便番号 → 緯度経度（見つかったものだけ持つ。未登録の郵便番号は取り込み後にすぐ引けるようにする）
+_postal_cache: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+_postal_cache_lock = threading.Lock()
+
+def get_postal_location(postal_code: str) -> Optional[Tuple[float, float]]:
+    """郵便番号の緯度経度（郵便番号データは滅多に変わらないのでプロセス内でキャッシュする）"""
+    normalized = normalize_postal_code(postal_code)
+    if normalized is None:
+        return None
+    with _postal_cache_lock:
+        location = _postal_cache.get(normalized)
+        if location is not None:
+            _postal_cache.move_to_end(normalized)
+            return location
+    with session_scope() as session:
+        row = session.execute(
+            select(PostalCodeLocation.latitude, PostalCodeLocation.longitude)
+            .where(PostalCodeLocation.postal_code == normalized)
+        ).first()
+    if row is None:
+        return None
+    location = (row.latitude, row.longitude)
+    with _postal_cache_lock:
+        _postal_cache[normalized] = location
+        while len(_postal_cache) > POSTAL_CACHE_SIZE:
+            _postal_cache.popitem(last=False)
+    return location
+
+def get_user_location(user_id: int) -> Optional[Tuple[float, float]]:
+    with session_scope() as session:
+        postal_code = session.execute(
+            text("SELECT postal_code FROM Users WHERE user_id = :user_id"), {"user_id": user_id}
+        ).scalar()
+    return get_postal_location(postal_code) if postal_code else None
+
+
+# ───── エリア名からの位置推定 ─────
+_area_centroids: Optional[Dict[str, Tuple[float, float]]] = None
+_area_centroids_loaded = 0.0
+
+def get_area_centroids(session) -> Dict[str, Tuple[float, float]]:
+    """市区町村名（と都道府県名 + 市区町村名）→ その郵便番号の重心"""
+    global _area_centroids, _area_centroids_loaded
+    if _area_centroids is not None and time.monotonic() - _area_centroids_loaded < AREA_CENTROID_TTL:
+        return _area_centroids
+    rows = session.execute(text("""
+    SELECT prefecture, city, AVG(latitude) AS latitude, AVG(longitude) AS longitude
+    FROM PostalCodeLocations
+    WHERE city IS NOT NULL
+    GROUP BY prefecture, city
+    """)).fetchall()
+    centroids = {}
+    for r in rows:
+        centroids.setdefault(r.city, (r.latitude, r.longitude))
+        if r.prefecture:
+            centroids[f"{r.prefecture}{r.city}"] = (r.latitude, r.longitude)
+    _area_centroids, _area_centroids_loaded = centroids, time.monotonic()
+    return centroids
+
+def geocode_area(area: Optional[str], centroids: Dict[str, Tuple[float, float]]) -> Optional[Tuple[float, float]]:
+    """エリア名に一致する（なければ前方一致で最も長い）市区町村の重心を返す"""
+    if not area:
+        return None
+    area = "".join(area.split())
+    if area in centroids:
+        return centroids[area]
+    matches = [name for name in centroids if area.startswith(name)]
+    return centroids[max(matches, key=len)] if matches else None
+
+def geocode_events(session, event_ids: Optional[Iterable[int]] = None, overwrite: bool = False) -> int:
+    """イベントの位置をエリア名から求めて EventLocations に書く（呼び出し元のトランザクション内）
+
+    event_ids 未指定なら位置のない全イベント。手入力（manual）の位置は上書きしない。
+    """
+    centroids = get_area_centroids(session)
+    if not centroids:
+        return 0
+    conditions = ["(el.event_id IS NULL OR el.source = 'area')" if overwrite else "el.event_id IS NULL"]
+    params = {}
+    if event_ids is not None:
+        event_ids = tuple(event_ids)
+        if not event_ids:
+            return 0
+        conditions.append("e.event_id IN :event_ids")
+        params["event_ids"] = event_ids
+    rows = session.execute(text(f"""
+    SELECT e.event_id, e.area
+    FROM Events e
+    LEFT JOIN EventLocations el ON el.event_id = e.event_id
+    WHERE {" AND ".join(conditions)}
+    """), params).fetchall()
+
+    values = []
+    for row in rows:
+        location = geocode_area(row.area, centroids)
+        if location:
+            values.append({"event_id": row.event_id, "latitude": location[0],
+                           "longitude": location[1], "source": "area"})
+    if values:
+        stmt = mysql_insert(EventLocation).values(values)
+        session.execute(stmt.on_duplicate_key_update(
+            latitude=stmt.inserted.latitude, longitude=stmt.inserted.longitude,
+        ))
+    return len(values)
+
+
+# ───── グリッド索引 ─────
+class GridIndex:
+    """(event_id, 緯度, 経度) を CELL_DEG 四方のセルに分けて持つ索引"""
+
+    def __init__(self, points: Iterable[Tuple[int, float, float]], cell_deg: float = CELL_DEG):
+        self.cell_deg = cell_deg
+        self.cells: Dict[Tuple[int, int], List[Tuple[int, float, float]]] = defaultdict(list)
+        self.size = 0
+        for event_id, lat, lon in points:
+            self.cells[self._cell(lat, lon)].append((event_id, lat, lon))
+            self.size += 1
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return int(math.floor(lat / self.cell_deg)), int(math.floor(lon / self.cell_deg))
+
+    def query(self, lat: float, lon: float, radius_km: float, limit: int) -> List[Tuple[int, float]]:
+        """半径内のイベントを近い順に (event_id, 距離km) で返す"""
+        dlat = radius_km / 111.0
+        dlon = radius_km / (111.0 * max(math.cos(math.radians(lat)), 0.01))
+        lat_lo, lon_lo = self._cell(lat - dlat, lon - dlon)
+        lat_hi, lon_hi = self._cell(lat + dlat, lon + dlon)
+        found = []
+        for i in range(lat_lo, lat_hi + 1):
+            for j in range(lon_lo, lon_hi + 1):
+                for event_id, e_lat, e_lon in self.cells.get((i, j), ()):
+                    distance = haversine_km(lat, lon, e_lat, e_lon)
+                    if distance <= radius_km:
+                        found.append((event_id, distance))
+        found.sort(key=lambda item: item[1])
+        return found[:limit]
+
+
+_index: Optional[GridIndex] = None
+_index_built = 0.0
+_index_stale = False
+_index_lock = threading.Lock()
+
+def build_index(session, today: Optional[date] = None) -> GridIndex:
+    """開催中・開催予定のイベントの位置から索引を作る"""
+    rows = session.execute(text("""
+    SELECT el.event_id, el.latitude, el.longitude
+    FROM EventLocations el
+    JOIN Events e ON e.event_id = el.event_id
+    WHERE e.end_date >= :today
+    """), {"today": today or date.today()}).fetchall()
+    return GridIndex((r.event_id, r.latitude, r.longitude) for r in rows)
+
+def _index_fresh() -> bool:
+    return _index is not None and not _index_stale and time.monotonic() - _index_built < INDEX_TTL
+
+def get_index() -> GridIndex:
+    global _index, _index_built, _index_stale
+    index = _index
+    if _index_fresh():
+        return index
+    # 作り直し中は他のスレッドに古い索引を返す
+    if not _index_lock.acquire(blocking=index is None):
+        return index
+    try:
+        # 初回の構築を待っていたスレッドは、先に作られた索引をそのまま使う
+        if _index_fresh():
+            return _index
+        with session_scope() as session:
+            _index = build_index(session)
+        _index_built, _index_stale = time.monotonic(), False
+        return _index
+    finally:
+        _index_lock.release()
+
+def invalidate():
+    """イベントの登録・位置の更新時に呼ぶ（次回検索時に索引を作り直す）"""
+    global _index_stale
+    _index_stale = True
+
+def find_nearby_events(lat: float, lon: float, radius_km: float = 5.0, limit: int = 20) -> List[Tuple[int, float]]:
+    return get_index().query(lat, lon, radius_km, limit)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="位置情報データの保守")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_load = sub.add_parser("load-postal-codes", help="郵便番号 CSV を取り込む")
+    p_load.add_argument("path")
+    p_geocode = sub.add_parser("geocode-events", help="イベントの位置をエリア名から求める")
+    p_geocode.add_argument("--all", action="store_true", help="エリア名から求めた既存の位置も計算し直す")
+    args = parser.parse_args()
+
+    if args.command == "load-postal-codes":
+        print(f"{load_postal_codes(args.path)} 件の郵便番号を取り込みました")
+    elif args.command == "geocode-events":
+        with session_scope() as session:
+            print(f"{geocode_events(session, overwrite=args.all)} 件のイベントの位置を更新しました")
@@ -0,0 +1,60 @@
+# gunicorn.conf.py
+"""
+gunicorn の設定（起動ディレクトリに置くと自動で読み込まれる）
+
+    gunicorn app:app
+
+- 設定を読み込んだ時点（preload_app で app を import する前）にスキーマの移行を1回流す
+  （python -m db_control.migrate upgrade。失敗したら起動しない）。デプロイの手順で先に流すなら
+  MIGRATE_ON_START=0 にする
+
+- 特徴量スナップショットはローダープロセスが1回だけ構築して FEATURE_STORE_DIR に公開し、
+  各ワーカーは mmap で共有して読む（feature_store.py 参照）
+- preload_app でアプリを master で1回だけ import し、pandas / scikit-learn などの
+  ライブラリのメモリを fork 後のワーカー間で共有する
+"""
+import os
+import subprocess
+import sys
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "uvicorn.workers.UvicornWorker"
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+preload_app = True
+
+# app の import（require_current_schema）より前に、スキーマを最新にしておく。
+# 別プロセスで流すので、移行の接続が master に残って fork 後のワーカーに引き継がれることはない
+if os.getenv("MIGRATE_ON_START", "1") == "1":
+    subprocess.run([sys.executable, "-m", "db_control.migrate", "upgrade"],
+                   cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+
+# ワーカーもローダーも同じディレクトリを見るように、アプリの import 前に決めておく
+os.environ.setdefault("FEATURE_STORE_DIR", os.path.join("/tmp", "hsp-feature-store"))
+
+_loader = None
+
+
+def on_starting(server):
+    """master 起動時に特徴量ローダーを別プロセスで立ち上げる"""
+    global _loader
+    _loader = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "feature_store.py")],
+        env=os.environ.copy(),
+    )
+    server.log.info(f"feature loader started (pid={_loader.pid}, dir={os.environ['FEATURE_STORE_DIR']})")
+
+
+def post_fork(server, worker):
+    """master で作った DB 接続プールをワーカーに引き継がない"""
+    from db_control.connect_MySQL import engine
+    engine.dispose(close=False)
+
+
+def on_exit(server):
+    if _loader is not None and _loader.poll() is None:
+        _loader.terminate()
+        try:
+            _loader.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            _loader.kill()
@@ -0,0 +1,210 @@
+# idempotency.py
+"""
+書き込み系エンドポイントの冪等化（Idempotency-Key ヘッダー）
+
+- 同じ Idempotency-Key の再送には、保存しておいたレスポンスをそのまま返し、crud を再実行しない
+- キーは呼び出し元（ユーザー・店舗）ごとに分ける。別の端末がたまたま同じキーを使っても衝突しない
+- 処理結果はワーカーのメモリ（LRU）と IdempotencyKeys テーブルの両方に保存する
+  （別ワーカーに再送されてもテーブルの主キー検索1回で済む）
+- 結果の行は crud の書き込みと同じトランザクションで更新する。書き込みだけがコミットされて
+  結果が残らない（再送で二重に実行される）ことはない
+- 実行前にキーを「処理中」として予約するので、同時に届いた重複リクエストは 409 になる
+- 同じキーで内容の違うリクエストは 422 にする
+- 成功（2xx）以外のレスポンスは保存せず予約を外すので、失敗したリクエストは再送で再実行される
+
+期限切れ行の削除:
+    python idempotency.py purge
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Callable, Optional, Tuple
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy import text
+
+from db_control.crud import session_scope
+from logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# 保存したレスポンスを返す期間（秒）
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", str(24 * 60 * 60)))
+# この秒数を過ぎても「処理中」のままの予約は、落ちたワーカーのものとみなして取り直せる
+# （書き込みと結果の保存は同じトランザクションなので、処理中の行は書き込みがコミットされていない）
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv("IDEMPOTENCY_LOCK_SECONDS", "60"))
+# ワーカーごとにメモリに持つ件数
+MEMORY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_MEMORY_CACHE_SIZE", "10000"))
+MAX_KEY_LENGTH = 255
+
+# (scope, key) → (期限の monotonic 時刻, request_hash, status_code, body)
+_cache: "OrderedDict[Tuple[str, str], Tuple[float, str, int, Any]]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def request_hash(payload: Any) -> str:
+    body = json.dumps(jsonable_encoder(payload), sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+
+def _cache_get(scope: str, key: str):
+    with _cache_lock:
+        entry = _cache.get((scope, key))
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del _cache[(scope, key)]
+            return None
+        _cache.move_to_end((scope, key))
+        return entry
+
+def _cache_put(scope: str, key: str, hash_: str, status_code: int, body: Any):
+    with _cache_lock:
+        _cache[(scope, key)] = (time.monotonic() + IDEMPOTENCY_TTL, hash_, status_code, body)
+        _cache.move_to_end((scope, key))
+        while len(_cache) > MEMORY_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def _replay(hash_: str, stored_hash: str, status_code: int, body: Any) -> JSONResponse:
+    if stored_hash != hash_:
+        raise HTTPException(status_code=422, detail="同じ Idempotency-Key で内容の異なるリクエストが送られました")
+    return JSONResponse(content=body, status_code=status_code, headers={"Idempotent-Replayed": "true"})
+
+
+def _reserve(scope: str, key: str, hash_: str):
+    """キーを処理中として予約する。既に行があれば (request_hash, status_code, body) を返す"""
+    params = {
+        "scope": scope,
+        "key": key,
+        "hash": hash_,
+        "expires_at": datetime.utcnow() + timedelta(seconds=IDEMPOTENCY_TTL),
+        "lock_seconds": IDEMPOTENCY_LOCK_SECONDS,
+    }
+    with session_scope() as session:
+        # 期限切れの結果と、放置された予約は取り直せるように消す
+        session.execute(text("""
+        DELETE FROM IdempotencyKeys
+        WHERE scope = :scope AND idem_key = :key
+          AND (expires_at < UTC_TIMESTAMP()
+               OR (status_code IS NULL AND created_at < UTC_TIMESTAMP() - INTERVAL :lock_seconds SECOND))
+        """), params)
+        reserved = session.execute(text("""
+        INSERT IGNORE INTO IdempotencyKeys (scope, idem_key, request_hash, status_code, response_body, created_at, expires_at)
+        VALUES (:scope, :key, :hash, NULL, NULL, UTC_TIMESTAMP(), :expires_at)
+        """), params).rowcount
+        if reserved == 1:
+            return None
+        row = session.execute(text("""
+        SELECT request_hash, status_code, response_body FROM IdempotencyKeys
+        WHERE scope = :scope AND idem_key = :key
+        """), params).first()
+    if row is None:
+        return None
+    return row.request_hash, row.status_code, json.loads(row.response_body) if row.response_body else None
+
+def _store(session, scope: str, key: str, hash_: str, status_code: int, body: Any):
+    """handler と同じトランザクションで予約行に結果を書く"""
+    stored = session.execute(text("""
+    UPDATE IdempotencyKeys SET status_code = :status_code, response_body = :body
+    WHERE scope = :scope AND idem_key = :key AND request_hash = :hash AND status_code IS NULL
+    """), {"scope": scope, "key": key, "hash": hash_, "status_code": status_code,
+           "body": json.dumps(body, ensure_ascii=False)}).rowcount
+    if stored != 1:
+        # 予約を取り直した別のリクエストが先に結果を書いた。こちらの書き込みはロールバックする
+        raise HTTPException(status_code=409, detail="同じ Idempotency-Key のリクエストを処理中です")
+
+def _release(scope: str, key: str, hash_: str):
+    try:
+        with session_scope() as session:
+            session.execute(text("""
+            DELETE FROM IdempotencyKeys
+            WHERE scope = :scope AND idem_key = :key AND request_hash = :hash AND status_code IS NULL
+            """), {"scope": scope, "key": key, "hash": hash_})
+    except Exception as e:
+        # 消せなくても IDEMPOTENCY_LOCK_SECONDS 後には取り直せる
+        logger.warning("冪等キーの予約解除に失敗しました: %s %s: %s", scope, key, e)
+
+
+def run_idempotent(scope: str, caller: Any, key: Optional[str], payload: Any,
+                   handler: Callable[[Any], Any], status_code: int = 200,
+                   after_commit: Optional[Callable[[Any], None]] = None):
+    """handler(session) を冪等に実行する（key が None なら普通に実行する）
+
+    scope: エンドポイントを表す名前。caller: キーの持ち主（user_id・store_id など）。
+    payload: 内容が同じかの判定に使うリクエスト内容。
+    handler には crud の書き込みに使うセッションを渡す（結果の保存も同じトランザクションで行う）。
+    after_commit(result) はコミット後に初回だけ呼ぶ（配信など。再送の再生時は呼ばない）。
+    初回は handler の戻り値を、再送時は保存したレスポンス（JSONResponse）を返す。
+    """
+    if key is None:
+        with session_scope() as session:
+            result = handler(session)
+        if after_commit is not None:
+            after_commit(result)
+        return result
+    key = key.strip()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key は1〜{MAX_KEY_LENGTH}文字で指定してください")
+
+    scope = f"{scope}:{caller}"
+    hash_ = request_hash(payload)
+    cached = _cache_get(scope, key)
+    if cached:
+        _, stored_hash, stored_status, body = cached
+        return _replay(hash_, stored_hash, stored_status, body)
+
+    existing = _reserve(scope, key, hash_)
+    if existing is not None:
+        stored_hash, stored_status, body = existing
+        if stored_status is None:
+            if stored_hash != hash_:
+                raise HTTPException(status_code=422, detail="同じ Idempotency-Key で内容の異なるリクエストが送られました")
+            raise HTTPException(status_code=409, detail="同じ Idempotency-Key のリクエストを処理中です")
+        _cache_put(scope, key, stored_hash, stored_status, body)
+        return _replay(hash_, stored_hash, stored_status, body)
+
+    try:
+        with session_scope() as session:
+            result = handler(session)
+            body = jsonable_encoder(result)
+            _store(session, scope, key, hash_, status_code, body)
+    except BaseException:
+        _release(scope, key, hash_)
+        raise
+
+    _cache_put(scope, key, hash_, status_code, body)
+    if after_commit is not None:
+        after_commit(result)
+    return result
+
+
+def purge_expired(batch_size: int = 10000) -> int:
+    """期限切れの行を少しずつ削除する"""
+    removed = 0
+    while True:
+        with session_scope() as session:
+            count = session.execute(text("""
+            DELETE FROM IdempotencyKeys WHERE expires_at < UTC_TIMESTAMP() LIMIT :limit
+            """), {"limit": batch_size}).rowcount
+        removed += count
+        if count < batch_size:
+            return removed
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="冪等キーテーブルの保守")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("purge", help="期限切れの冪等キーを削除する")
+    args = parser.parse_args()
+
+    if args.command == "purge":
+        print(f"{purge_expired()} 件の期限切れキーを削除しました")
@@ -0,0 +1,139 @@
+# identity.py
+"""
+メールアドレスからのユーザーの特定
+
+- メールアドレスは NFKC（全角英数字 → 半角）→ 前後の空白除去 → 小文字 に正規化して
+  Users.email_normalized（一意索引）に持つ。大文字小文字や全角の違いで別アカウントにならない
+- 検索は email_normalized の索引1回。ログインの本人確認に使うので結果はキャッシュしない
+  （ワーカーごとのキャッシュでは、別ワーカーでのメールアドレス変更後も古い user_id を返しうる）
+
+使い方:
+    python identity.py backfill     # email_normalized が空の行を埋める（移行 0004 でも実行）
+    python identity.py duplicates   # 正規化すると同じになるメールアドレスのアカウント一覧
+"""
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+
+import sqlalchemy
+from sqlalchemy import select, text, update
+
+from db_control.mymodels_MySQL import User
+
+
+class EmailAlreadyRegisteredError(ValueError):
+    """正規化すると同じになるメールアドレスが別のユーザーに登録済み"""
+
+    def __init__(self, email: str, user_id: int):
+        super().__init__(f"このメールアドレスは既に登録されています: {email}")
+        self.user_id = user_id
+
+
+def normalize_email(email: Optional[str]) -> Optional[str]:
+    if email is None:
+        return None
+    normalized = unicodedata.normalize("NFKC", email).strip().lower()
+    return normalized or None
+
+
+def resolve_user_id(email: Optional[str]) -> Optional[int]:
+    """メールアドレスのユーザーIDを返す（未登録なら None）"""
+    normalized = normalize_email(email)
+    if normalized is None:
+        return None
+    # crud は import 時にアプリの DB に接続する。正規化だけを使う bulk_io（--database-url）のために、ここで import する
+    from db_control.crud import session_scope
+    with session_scope() as session:
+        return session.execute(
+            select(User.user_id).where(User.email_normalized == normalized)
+        ).scalar()
+
+def set_user_email(session, user_id: int, email: str):
+    """ユーザーのメールアドレスを設定する（呼び出し元のトランザクション内。コミットは呼び出し元）
+
+    正規化すると同じになるアドレスが別のユーザーにあれば EmailAlreadyRegisteredError。
+    """
+    normalized = normalize_email(email)
+    if normalized is None:
+        raise ValueError("メールアドレスを入力してください")
+    owner = session.execute(
+        select(User.user_id).where(User.email_normalized == normalized, User.user_id != user_id)
+    ).scalar()
+    if owner is not None:
+        raise EmailAlreadyRegisteredError(email, owner)
+    try:
+        session.execute(
+            update(User).where(User.user_id == user_id)
+            .values(email=email.strip(), email_normalized=normalized)
+        )
+        session.flush()
+    except sqlalchemy.exc.IntegrityError:
+        # 確認とのすき間に同じアドレスが登録された
+        raise EmailAlreadyRegisteredError(email, -1)
+
+
+# ───── 既存データの保守 ─────
+def backfill_normalized_emails(session) -> Tuple[int, Dict[str, List[int]]]:
+    """email_normalized が空の行を埋め、(更新件数, 重複のため埋めなかった {正規化アドレス: user_id}) を返す
+
+    正規化すると同じになるアカウントが複数あるときは、既に使われているアカウント
+    （なければ user_id の最も小さいアカウント）だけに設定する。
+    """
+    taken = {
+        normalized: user_id for user_id, normalized in session.execute(
+            select(User.user_id, User.email_normalized).where(User.email_normalized.isnot(None))
+        )
+    }
+    rows = session.execute(
+        select(User.user_id, User.email)
+        .where(User.email.isnot(None), User.email_normalized.is_(None))
+        .order_by(User.user_id)
+    ).fetchall()
+
+    values, skipped = [], {}
+    for user_id, email in rows:
+        normalized = normalize_email(email)
+        if normalized is None:
+            continue
+        if normalized in taken:
+            skipped.setdefault(normalized, [taken[normalized]]).append(user_id)
+            continue
+        taken[normalized] = user_id
+        values.append({"user_id": user_id, "email_normalized": normalized})
+    if values:
+        session.execute(
+            text("UPDATE Users SET email_normalized = :email_normalized WHERE user_id = :user_id"),
+            values,
+        )
+    return len(values), skipped
+
+def find_duplicate_emails(session) -> Dict[str, List[int]]:
+    """正規化すると同じになるメールアドレスを持つアカウント（レコメンドのユーザーが分かれてしまうもの）"""
+    groups: Dict[str, List[int]] = {}
+    for user_id, email in session.execute(
+        select(User.user_id, User.email).where(User.email.isnot(None)).order_by(User.user_id)
+    ):
+        normalized = normalize_email(email)
+        if normalized is not None:
+            groups.setdefault(normalized, []).append(user_id)
+    return {email: user_ids for email, user_ids in groups.items() if len(user_ids) > 1}
+
+
+if __name__ == "__main__":
+    import argparse
+    from db_control.crud import session_scope
+
+    parser = argparse.ArgumentParser(description="メールアドレスの正規化の保守")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("backfill", help="email_normalized が空の行を埋める")
+    sub.add_parser("duplicates", help="正規化すると同じになるメールアドレスのアカウントを表示する")
+    args = parser.parse_args()
+
+    with session_scope() as session:
+        if args.command == "backfill":
+            updated, skipped = backfill_normalized_emails(session)
+            print(f"{updated} 件の email_normalized を設定しました")
+            for email, user_ids in skipped.items():
+                print(f"重複のため未設定: {email} user_id={user_ids}（先頭のアカウントで登録済み）")
+        elif args.command == "duplicates":
+            for email, user_ids in find_duplicate_emails(session).items():
+                print(f"{email}: user_id={user_ids}")
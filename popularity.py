@@ -0,0 +1,130 @@
+# popularity.py
+"""
+人気イベントのランキング
+
+- お気に入りの登録/解除は crud 側で同じトランザクション内に EventPopularity へ加算される
+- イベント詳細の閲覧はここでメモリに溜め、一定間隔でまとめて EventPopularity に書き込む
+- レコメンドのフォールバック用の人気フィードは、一定間隔で作り直した表示用リストを返すだけにする
+"""
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List
+
+from sqlalchemy import text
+
+from db_control import crud
+from db_control.crud import session_scope
+from logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# 閲覧数の書き込み間隔と、人気フィードの作り直し間隔（秒）
+VIEW_FLUSH_INTERVAL = int(os.getenv("POPULARITY_VIEW_FLUSH_INTERVAL", "30"))
+FEED_REFRESH_INTERVAL = int(os.getenv("POPULARITY_FEED_REFRESH_INTERVAL", "60"))
+# 事前に作っておくフィードの件数
+FEED_SIZE = 20
+
+_view_counts: Counter = Counter()
+_view_lock = threading.Lock()
+
+_feed: List[Dict] = []
+_feed_built_at = None
+_feed_lock = threading.Lock()
+
+_scheduler_started = False
+
+
+def record_view(event_id: int):
+    """イベント詳細の閲覧を記録する（DB には次のフラッシュでまとめて書く）"""
+    with _view_lock:
+        _view_counts[event_id] += 1
+
+def flush_views():
+    """溜まった閲覧数を1トランザクションで EventPopularity に反映する"""
+    global _view_counts
+    with _view_lock:
+        counts, _view_counts = _view_counts, Counter()
+    if not counts:
+        return
+    try:
+        with session_scope() as session:
+            crud.upsert_event_popularity(session, {
+                event_id: count * crud.POPULARITY_VIEW_WEIGHT for event_id, count in counts.items()
+            })
+    except Exception as e:
+        logger.warning("閲覧数の反映に失敗しました: %s", e)
+        # 取りこぼさないよう次回に回す
+        with _view_lock:
+            _view_counts.update(counts)
+
+
+def get_popular_events(session, limit: int = 6):
+    """開催中・開催予定のイベントを現在の人気度順に取得する（人気度がなければ開催日順）"""
+    query = text(f"""
+    SELECT e.event_id, e.event_name, e.description, e.start_date, e.end_date,
+           e.flyer_url, e.event_image_url, e.store_id, e.area,
+           COALESCE({crud.POPULARITY_SCORE_SQL}, 0) AS popularity
+    FROM Events e
+    LEFT JOIN EventPopularity ep ON ep.event_id = e.event_id
+    WHERE e.end_date >= CURDATE()
+    ORDER BY popularity DESC, e.start_date ASC
+    LIMIT :limit
+    """)
+    return session.execute(query, {"decay": crud.POPULARITY_DECAY_PER_SECOND, "limit": limit}).fetchall()
+
+def build_feed(limit: int = FEED_SIZE) -> List[Dict]:
+    """表示用に整形済みの人気フィードを作る"""
+    with session_scope() as session:
+        events = get_popular_events(session, limit)
+        tags_by_event = crud.get_tag_names_for_events(session, [e.event_id for e in events])
+    return [
+        {
+            "id": str(e.event_id),
+            "imageUrl": e.event_image_url or e.flyer_url,
+            "area": e.area,
+            "title": e.event_name,
+            "date": e.start_date.strftime("%Y/%m/%d") if e.start_date else None,
+            "tags": ["人気"] + tags_by_event.get(e.event_id, []),
+            "description": e.description,
+            "points": None,
+        }
+        for e in events
+    ]
+
+def refresh_feed():
+    global _feed, _feed_built_at
+    try:
+        feed = build_feed()
+    except Exception as e:
+        logger.warning("人気フィードの更新に失敗しました: %s", e)
+        return
+    with _feed_lock:
+        _feed, _feed_built_at = feed, datetime.now()
+
+def get_popular_feed(limit: int = 6) -> List[Dict]:
+    """事前に作った人気フィードを返す（まだなければその場で作る）"""
+    if _feed_built_at is None:
+        refresh_feed()
+    return _feed[:limit]
+
+
+def _run_scheduler():
+    last_refresh = time.monotonic()
+    while True:
+        time.sleep(VIEW_FLUSH_INTERVAL)
+        flush_views()
+        if time.monotonic() - last_refresh >= FEED_REFRESH_INTERVAL:
+            refresh_feed()
+            last_refresh = time.monotonic()
+
+def start_scheduler():
+    """閲覧数の書き込みと人気フィードの更新を行うバックグラウンドスレッドを起動する（ワーカーごとに1回）"""
+    global _scheduler_started
+    if _scheduler_started:
+        return
+    _scheduler_started = True
+    refresh_feed()
+    threading.Thread(target=_run_scheduler, name="popularity-scheduler", daemon=True).start()
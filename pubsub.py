@@ -0,0 +1,260 @@
+# pubsub.py
+"""
+ポイント残高・店舗の取引・新着イベントのプッシュ配信（Server-Sent Events）
+
+POS やアプリが /users/{user_id} をポーリングしなくても、取引の直後に新しい残高が届くようにする。
+
+チャネル:
+    user:{user_id}    残高の変化（balance）
+    store:{store_id}  店舗での取引（transaction。ポイント数と種別のみで、ユーザーと残高は含まない）と
+                      新しいイベント（event_created）
+    events            全店舗の新しいイベント（event_created）
+
+- 購読はワーカーのメモリ上のハブに登録し、接続ごとの asyncio.Queue に SSE のフレームを入れる
+  （同期エンドポイントのスレッドからも call_soon_threadsafe で渡す）
+- 既定はワーカー内だけで配信する。gunicorn で複数ワーカーを動かすときは PUBSUB_REDIS_URL を設定し、
+  Redis の pub/sub 経由で全ワーカーに配る（redis パッケージが必要。Redis に障害があるときはワーカー内だけに配る）
+- 遅いクライアントのキューがあふれたら古いメッセージから捨てる（残高は最新の値だけ届けば足りる）
+- 接続数などは GET /metrics/pubsub で確認できる（ワーカーごとの値）
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+import orjson
+
+from logging_config import get_logger
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = get_logger(__name__)
+
+PUBSUB_REDIS_URL = os.getenv("PUBSUB_REDIS_URL")
+PUBSUB_CHANNEL_PREFIX = os.getenv("PUBSUB_CHANNEL_PREFIX", "hsp:")
+# 1ワーカーあたりの同時接続数の上限
+PUBSUB_MAX_SUBSCRIBERS = int(os.getenv("PUBSUB_MAX_SUBSCRIBERS", "1000"))
+# 接続ごとにためておくメッセージ数の上限
+QUEUE_SIZE = 64
+# プロキシに切られないよう、メッセージがない間に送るコメント行の間隔（秒）
+HEARTBEAT_SECONDS = 15
+# 切断されたときにブラウザ（EventSource）が再接続するまでの待ち時間（ミリ秒）
+RETRY_MS = 3000
+
+
+def user_channel(user_id: int) -> str:
+    return f"user:{user_id}"
+
+def store_channel(store_id: int) -> str:
+    return f"store:{store_id}"
+
+EVENTS_CHANNEL = "events"
+
+
+def format_sse(event: str, data) -> bytes:
+    """SSE の1メッセージ（orjson の出力は改行を含まないので data は1行になる）"""
+    return b"event: " + event.encode("utf-8") + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+
+class TooManySubscribersError(RuntimeError):
+    """ワーカーの同時接続数が上限に達している"""
+
+
+class Subscription:
+    """1接続分の購読。キューの操作はすべて購読したイベントループのスレッドで行う"""
+
+    def __init__(self, hub: "Hub", channels: List[str]):
+        self.hub = hub
+        self.channels = channels
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue(QUEUE_SIZE)
+
+    def put(self, message: bytes):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.hub.dropped += 1
+        self.queue.put_nowait(message)
+
+    async def get(self, timeout: float) -> Optional[bytes]:
+        """次のメッセージ（timeout 秒来なければ None）"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class Hub:
+    """チャネル → 購読中の接続 の表（ワーカーに1つ）"""
+
+    def __init__(self, max_subscribers: int = PUBSUB_MAX_SUBSCRIBERS):
+        self.max_subscribers = max_subscribers
+        self._subscriptions: Dict[str, Set[Subscription]] = defaultdict(set)
+        self._lock = threading.Lock()
+        self.subscribers = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def is_full(self) -> bool:
+        return self.subscribers >= self.max_subscribers
+
+    def subscribe(self, channels: Iterable[str]) -> Subscription:
+        subscription = Subscription(self, list(channels))
+        with self._lock:
+            if self.is_full():
+                raise TooManySubscribersError("接続数が上限に達しています")
+            for channel in subscription.channels:
+                self._subscriptions[channel].add(subscription)
+            self.subscribers += 1
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscribers = self._subscriptions.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscriptions[channel]
+            self.subscribers -= 1
+
+    def deliver(self, channel: str, message: bytes):
+        """このワーカーの購読者にメッセージを渡す（どのスレッドから呼んでもよい）"""
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, message)
+                self.delivered += 1
+            except RuntimeError:
+                # イベントループが既に閉じている（切断処理中の接続）
+                pass
+
+    def channel_count(self) -> int:
+        with self._lock:
+            return len(self._subscriptions)
+
+
+class RedisBroker:
+    """Redis の pub/sub でワーカー間にメッセージを配る
+
+    各ワーカーは最初の購読時に受信スレッドを1つ起動し、PUBSUB_CHANNEL_PREFIX* を購読してハブに渡す。
+    """
+
+    def __init__(self, url: str, hub: Hub):
+        self.hub = hub
+        self._client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        # 受信側は pub/sub の待ち受けでタイムアウトさせない
+        self._listen_client = redis.Redis.from_url(url, socket_connect_timeout=0.5)
+        self._listener: Optional[threading.Thread] = None
+        self._listener_lock = threading.Lock()
+        self.errors = 0
+
+    def publish(self, channel: str, message: bytes) -> bool:
+        try:
+            self._client.publish(PUBSUB_CHANNEL_PREFIX + channel, message)
+            return True
+        except redis.RedisError as e:
+            self.errors += 1
+            logger.warning("pub/sub の送信に失敗しました（このワーカーの購読者だけに配ります）: %s", e)
+            return False
+
+    def ensure_listener(self):
+        # fork 後のワーカーで起動する（preload_app の master でスレッドを作らない）
+        if self._listener is not None and self._listener.is_alive():
+            return
+        with self._listener_lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self._listen, name="pubsub-listener", daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        prefix_length = len(PUBSUB_CHANNEL_PREFIX)
+        while True:
+            try:
+                pubsub = self._listen_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(PUBSUB_CHANNEL_PREFIX + "*")
+                for message in pubsub.listen():
+                    channel = message["channel"].decode("utf-8")[prefix_length:]
+                    self.hub.deliver(channel, message["data"])
+            except redis.RedisError as e:
+                self.errors += 1
+                logger.warning("pub/sub の受信が切れました（1秒後に再接続します）: %s", e)
+                time.sleep(1)
+
+
+hub = Hub()
+_broker: Optional[RedisBroker] = None
+if PUBSUB_REDIS_URL:
+    if redis is None:
+        logger.warning("PUBSUB_REDIS_URL が設定されていますが redis パッケージがないため、ワーカー内だけで配信します")
+    else:
+        _broker = RedisBroker(PUBSUB_REDIS_URL, hub)
+
+
+def publish(channel: str, event: str, data):
+    """チャネルの購読者に配る。配信の失敗で呼び出し元の処理（取引など）を失敗させない"""
+    try:
+        message = format_sse(event, data)
+        if _broker is None or not _broker.publish(channel, message):
+            hub.deliver(channel, message)
+    except Exception as e:
+        logger.warning("pub/sub の配信に失敗しました: %s %s: %s", channel, event, e)
+
+def publish_balance(user_id: int, store_id: int, balance: int, point: int, transaction_type: str):
+    """取引の確定後に、ユーザーの残高と店舗の取引を配る
+
+    店舗のチャネルは認証なしで購読できる（レジ表示用）ので、誰の取引か・残高はいくらかは載せない。
+    """
+    publish(user_channel(user_id), "balance", {"user_id": user_id, "store_id": store_id, "balance": balance,
+                                               "point": point, "type": transaction_type})
+    publish(store_channel(store_id), "transaction", {"store_id": store_id, "point": point,
+                                                     "type": transaction_type})
+
+def publish_events_created(events: List[Dict]):
+    """登録したイベントを店舗と全体のチャネルに配る（events は event_id / store_id / event_name を含む dict）"""
+    for event in events:
+        publish(store_channel(event["store_id"]), "event_created", event)
+        publish(EVENTS_CHANNEL, "event_created", event)
+
+
+async def event_stream(channels: List[str],
+                       initial: Optional[Callable[[], Awaitable[List[bytes]]]] = None) -> AsyncIterator[bytes]:
+    """StreamingResponse に渡す SSE のジェネレーター
+
+    initial は購読を始めてから呼ぶ（その間に起きた変化を取りこぼさない）。
+    切断されると Starlette がジェネレーターを止めるので、finally で購読を外す。
+    接続数の上限はエンドポイントで hub.is_full() を見て 503 にするが、競合して超えたときはここで閉じる
+    （クライアントは retry の間隔で再接続する）。
+    """
+    if _broker is not None:
+        _broker.ensure_listener()
+    try:
+        subscription = hub.subscribe(channels)
+    except TooManySubscribersError:
+        yield f"retry: {RETRY_MS}\n\n".encode("ascii")
+        return
+    try:
+        yield f"retry: {RETRY_MS}\n\n".encode("ascii")
+        if initial is not None:
+            for message in await initial():
+                yield message
+        while True:
+            message = await subscription.get(HEARTBEAT_SECONDS)
+            yield message if message is not None else b": ping\n\n"
+    finally:
+        hub.unsubscribe(subscription)
+
+def get_metrics() -> Dict:
+    return {
+        "backend": "redis" if _broker is not None else "memory",
+        "subscribers": hub.subscribers,
+        "channels": hub.channel_count(),
+        "delivered": hub.delivered,
+        "dropped": hub.dropped,
+        "broker_errors": _broker.errors if _broker is not None else 0,
+    }
@@ -0,0 +1,283 @@
+# rate_limit.py
+"""
+/auth 系エンドポイントのレート制限（トークンバケット）
+
+- ASGI ミドルウェアとして、ルーティング・DBセッション取得より前に判定する
+  （拒否するリクエストでは DB にも SendGrid にも触れない）
+- キーは IP / email / user_id のそれぞれ。どれか1つでもバケットが空なら 429 を返す
+- バケットは既定でワーカーのメモリに持つ。RATE_LIMIT_REDIS_URL を設定すると Redis で全ワーカー共有する
+  （redis パッケージが必要。Redis に障害があるときは制限せずに通し、メトリクスに数える）
+- 拒否件数などは GET /metrics/rate-limit で確認できる（ワーカーごとの値）
+"""
+import json
+import math
+import os
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import identity
+from logging_config import get_logger
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = get_logger(__name__)
+
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL")
+# リバースプロキシ（App Service 等）の後ろにいるときだけ 1 にする。X-Forwarded-For はクライアントが
+# 自由に書けるので、信頼するのはプロキシが付け足した右端の RATE_LIMIT_TRUSTED_PROXIES 個だけ
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "0") == "1"
+# クライアントとアプリの間にある信頼できるプロキシの段数（右から数えてこの位置をクライアントIPとする）
+RATE_LIMIT_TRUSTED_PROXIES = max(int(os.getenv("RATE_LIMIT_TRUSTED_PROXIES", "1")), 1)
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+# email / user_id を読むためにバッファするボディの上限。超えたら 413 で断る
+# （読み飛ばして IP だけで判定すると、空白で水増ししたボディで email の制限を外せてしまう）
+MAX_BODY_BYTES = 8 * 1024
+
+
+class Rule(NamedTuple):
+    """capacity 回までまとめて許可し、period 秒で capacity 回分まで回復するバケット"""
+    key: str          # "ip" / "email" / "user_id"
+    capacity: int
+    period: float
+
+    @property
+    def refill_per_second(self) -> float:
+        return self.capacity / self.period
+
+
+# パスごとの制限。コード送信は SendGrid の送信数、コード検証は総当たりを抑える
+RULES: Dict[str, List[Rule]] = {
+    "/auth/send-login-code": [Rule("ip", 10, 60), Rule("email", 3, 600)],
+    "/auth/send-code": [Rule("ip", 10, 60), Rule("email", 3, 600), Rule("user_id", 3, 600)],
+    "/auth/login-verify-code": [Rule("ip", 30, 60), Rule("email", 5, 600)],
+    "/auth/verify-code": [Rule("ip", 30, 60), Rule("email", 5, 600), Rule("user_id", 5, 600)],
+}
+
+
+# ───── バックエンド ─────
+class MemoryBackend:
+    """ワーカー内のメモリに持つトークンバケット"""
+
+    # 満タンに戻ったバケットを掃除する間隔（秒）
+    PRUNE_INTERVAL = 60
+
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+        self._last_prune = time.monotonic()
+
+    def take(self, bucket: str, rule: Rule) -> float:
+        """トークンを1つ取る。取れたら 0、取れなければ次に取れるまでの秒数を返す"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(bucket, (rule.capacity, now))
+            tokens = min(rule.capacity, tokens + (now - updated) * rule.refill_per_second)
+            if tokens >= 1:
+                self._buckets[bucket] = (tokens - 1, now)
+                wait = 0.0
+            else:
+                self._buckets[bucket] = (tokens, now)
+                wait = (1 - tokens) / rule.refill_per_second
+            if now - self._last_prune > self.PRUNE_INTERVAL:
+                self._prune(now)
+        return wait
+
+    def _prune(self, now: float):
+        # 最後の更新から最長の period 以上たったバケットは満タンなので消してよい
+        horizon = max(rule.period for rules in RULES.values() for rule in rules)
+        self._buckets = {k: v for k, v in self._buckets.items() if now - v[1] < horizon}
+        self._last_prune = now
+
+    def size(self) -> int:
+        return len(self._buckets)
+
+
+class RedisBackend:
+    """Redis で全ワーカー共有するトークンバケット（判定は Lua スクリプトで1往復）"""
+
+    SCRIPT = """
+    local capacity = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or capacity
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return tostring(wait)
+    """
+
+    def __init__(self, url: str):
+        self._client = redis.Redis.from_url(url, socket_timeout=0.2, socket_connect_timeout=0.2)
+        self._script = self._client.register_script(self.SCRIPT)
+
+    def take(self, bucket: str, rule: Rule) -> float:
+        return float(self._script(keys=[f"ratelimit:{bucket}"],
+                                  args=[rule.capacity, rule.refill_per_second, time.time()]))
+
+    def size(self) -> Optional[int]:
+        return None
+
+
+def create_backend():
+    if RATE_LIMIT_REDIS_URL:
+        if redis is None:
+            logger.warning("RATE_LIMIT_REDIS_URL が設定されていますが redis パッケージがないため、メモリで制限します")
+        else:
+            return RedisBackend(RATE_LIMIT_REDIS_URL)
+    return MemoryBackend()
+
+
+# ───── メトリクス ─────
+_metrics: Counter = Counter()
+_metrics_lock = threading.Lock()
+# ミドルウェアが使っているバックエンド（メトリクス表示用）
+_active_backend = None
+
+def _count(name: str):
+    with _metrics_lock:
+        _metrics[name] += 1
+
+def get_metrics(backend=None) -> Dict:
+    with _metrics_lock:
+        counters = dict(_metrics)
+    return {
+        "backend": type(backend).__name__ if backend else None,
+        "buckets": backend.size() if backend else None,
+        "checked": counters.pop("checked", 0),
+        "rejected": counters.pop("rejected", 0),
+        "backend_errors": counters.pop("backend_errors", 0),
+        "too_large": counters.pop("too_large", 0),
+        # "rejected:/auth/verify-code:email" のような内訳
+        "rejected_by_rule": counters,
+    }
+
+
+# ───── ミドルウェア ─────
+def client_ip(scope) -> str:
+    if RATE_LIMIT_TRUST_FORWARDED:
+        # 複数の X-Forwarded-For ヘッダーは1つのリストとして扱う。左側はクライアントが偽装できるので、
+        # 信頼できるプロキシが付け足した右から RATE_LIMIT_TRUSTED_PROXIES 番目を使う
+        hops = [
+            hop.strip()
+            for name, value in scope.get("headers", []) if name == b"x-forwarded-for"
+            for hop in value.decode("latin-1").split(",") if hop.strip()
+        ]
+        if len(hops) >= RATE_LIMIT_TRUSTED_PROXIES:
+            return hops[-RATE_LIMIT_TRUSTED_PROXIES]
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+def request_keys(scope, body: bytes) -> Dict[str, str]:
+    """判定に使う IP / email / user_id を取り出す（ボディが JSON でなければ IP のみ）"""
+    keys = {"ip": client_ip(scope)}
+    try:
+        data = json.loads(body) if body else {}
+    except ValueError:
+        data = {}
+    if isinstance(data, dict):
+        if isinstance(data.get("email"), str):
+            # 認証コードと同じ正規化（NFKC + 前後空白除去 + 小文字）。全角などの表記違いで同じアカウントの
+            # バケットが分かれないようにする
+            email = identity.normalize_email(data["email"])
+            if email is not None:
+                keys["email"] = email
+        if data.get("user_id") is not None:
+            keys["user_id"] = str(data["user_id"])
+    return keys
+
+
+class RateLimitMiddleware:
+    def __init__(self, app, rules: Dict[str, List[Rule]] = None, backend=None):
+        self.app = app
+        self.rules = rules or RULES
+        self.backend = backend or create_backend()
+        global _active_backend
+        _active_backend = self.backend
+
+    async def __call__(self, scope, receive, send):
+        if not RATE_LIMIT_ENABLED or scope["type"] != "http" or scope.get("method") == "OPTIONS":
+            return await self.app(scope, receive, send)
+        rules = self.rules.get(scope["path"])
+        if not rules:
+            return await self.app(scope, receive, send)
+
+        body, receive = await self._buffer_body(receive)
+        if body is None:
+            _count("too_large")
+            return await self._respond(send, 413, "リクエストが大きすぎます")
+        keys = request_keys(scope, body)
+        wait = self._check(scope["path"], rules, keys)
+        if wait > 0:
+            return await self._respond(
+                send, 429, "リクエストが多すぎます。しばらくしてから再度お試しください",
+                [(b"retry-after", str(max(1, math.ceil(wait))).encode())],
+            )
+        return await self.app(scope, receive, send)
+
+    def _check(self, path: str, rules: List[Rule], keys: Dict[str, str]) -> float:
+        _count("checked")
+        wait = 0.0
+        for rule in rules:
+            value = keys.get(rule.key)
+            if value is None:
+                continue
+            try:
+                rule_wait = self.backend.take(f"{path}:{rule.key}:{value}", rule)
+            except Exception as e:
+                # 制限の仕組みの障害でログインできなくならないよう、通す
+                _count("backend_errors")
+                logger.warning("レート制限の判定に失敗しました: %s", e)
+                continue
+            if rule_wait > 0:
+                _count(f"rejected:{path}:{rule.key}")
+                wait = max(wait, rule_wait)
+        if wait > 0:
+            _count("rejected")
+        return wait
+
+    async def _buffer_body(self, receive):
+        """ボディを先読みし、後段には同じ内容をもう一度渡す（MAX_BODY_BYTES を超えたらボディは None）"""
+        messages, body, more = [], b"", True
+        while more and len(body) <= MAX_BODY_BYTES:
+            message = await receive()
+            messages.append(message)
+            if message["type"] != "http.request":
+                break
+            body += message.get("body", b"")
+            more = message.get("more_body", False)
+
+        async def replay():
+            if messages:
+                return messages.pop(0)
+            return await receive()
+        return (body if len(body) <= MAX_BODY_BYTES else None), replay
+
+    async def _respond(self, send, status: int, detail: str, headers=()):
+        content = json.dumps({"detail": detail}, ensure_ascii=False).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(content)).encode()),
+                *headers,
+            ],
+        })
+        await send({"type": "http.response.body", "body": content})
+
+
+def get_active_metrics() -> Dict:
+    return get_metrics(_active_backend)
@@ -1,19 +1,24 @@
-from fastapi import APIRouter, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 import pandas as pd
 import numpy as np
 from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.preprocessing import MinMaxScaler
-from typing import List, Optional, Dict, Any
-from datetime import datetime
-import traceback
+from typing import List, Optional, Dict, Any, Tuple
+from datetime import date
 from sqlalchemy import text
 
 # 既存のモジュールをインポート
 from db_control import crud
-from db_control.connect_MySQL import engine
-from db_control.mymodels_MySQL import User, UserTag, Tag, PointTransaction, Event, EventTag, Store
 from db_control.crud import session_scope
+import feature_store
+import popularity
+import auth_tokens
+import geo
+from logging_config import get_logger
+from feature_store import FeatureSnapshot, get_snapshot
+
+logger = get_logger(__name__)
 
 # APIRouter の初期化
 router = APIRouter()
@@ -32,158 +37,13 @@ class EventRecommendation(BaseModel):
 class RecommendationResponse(BaseModel):
     events: List[EventRecommendation]
     similarUsers: List[int] = []
-
-# データ取得関数
-def get_user_data(session) -> pd.DataFrame:
-    """ユーザーデータを取得し前処理する"""
-    query_users = text("""
-    SELECT user_id, gender, relationship_id, postal_code, birth_date 
-    FROM Users
-    """)
-    result_users = session.execute(query_users).fetchall()
-    if not result_users:
-        raise HTTPException(status_code=404, detail="ユーザーデータが見つかりません")
-    
-    # 結果をDataFrameに変換
-    df_users = pd.DataFrame(result_users)
-    
-    # 性別を数値に変換
-    df_users["gender"] = df_users["gender"].map({"M": 0, "F": 1, "U": 2})
-    
-    # 年齢の計算
-    df_users["age"] = pd.to_datetime("today").year - pd.to_datetime(df_users["birth_date"]).dt.year
-    df_users.drop(columns=["birth_date"], inplace=True)
-    
-    # 年齢のMin-Maxスケーリング
-    scaler = MinMaxScaler()
-    df_users["age"] = scaler.fit_transform(df_users[["age"]])
-    
-    # 郵便番号をワンホットエンコーディング
-    df_users = pd.get_dummies(df_users, columns=["postal_code"])
-    return df_users
-
-def get_user_tags(session) -> pd.DataFrame:
-    """ユーザータグデータを取得しワンホットエンコーディングする"""
-    query_tags = text("""
-    SELECT u.user_id, t.tag_name  
-    FROM UserTags u 
-    JOIN Tags t ON u.tag_id = t.tag_id
-    """)
-    result_tags = session.execute(query_tags).fetchall()
-    
-    # タグのワンホットエンコーディング
-    if result_tags:
-        df_tags = pd.DataFrame(result_tags)
-        df_tags_onehot = df_tags.pivot_table(
-            index="user_id", columns="tag_name", aggfunc="size", fill_value=0
-        )
-        return df_tags_onehot.add_prefix("tag_")
-    else:
-        # タグがない場合は空のDataFrameを作成
-        return pd.DataFrame()
-
-def get_transaction_data(session) -> pd.DataFrame:
-    """ポイント取引データを取得しワンホットエンコーディングする"""
-    query_transactions = text("""
-    SELECT user_id, store_id 
-    FROM PointTransaction 
-    WHERE user_id IS NOT NULL
-    """)
-    result_transactions = session.execute(query_transactions).fetchall()
-    
-    # 取引のワンホットエンコーディング
-    if result_transactions:
-        df_transactions = pd.DataFrame(result_transactions)
-        df_transactions_onehot = df_transactions.pivot_table(
-            index="user_id", columns="store_id", aggfunc="size", fill_value=0
-        )
-        return df_transactions_onehot.add_prefix("store_")
-    else:
-        # 取引がない場合は空のDataFrameを作成
-        return pd.DataFrame()
-    
-def get_favorite_events_onehot(session) -> pd.DataFrame:
-    """お気に入りイベントをワンホットエンコーディングする"""
-    query_fav = text("""
-    SELECT user_id, event_id
-    FROM FavoriteEvents
-    """)
-    result_fav = session.execute(query_fav).fetchall()
-
-    if result_fav:
-        df_fav = pd.DataFrame(result_fav)
-        df_fav_onehot = df_fav.pivot_table(
-            index="user_id", columns="event_id", aggfunc="size", fill_value=0
-        )
-        return df_fav_onehot.add_prefix("fav_event_")
-    else:
-        return pd.DataFrame() 
-
-def get_event_tags(session, event_id: int) -> List[str]:
-    """イベントのタグを取得する"""
-    query_event_tags = text("""
-    SELECT t.tag_name
-    FROM EventTags et
-    JOIN Tags t ON et.tag_id = t.tag_id
-    WHERE et.event_id = :event_id
-    """)
-    result_tags = session.execute(query_event_tags, {"event_id": event_id}).fetchall()
-    return [tag.tag_name for tag in result_tags]
-
-def get_events_by_store_ids(session, store_ids: List[int], limit: int = 6) -> List[Dict]:
-    """指定された店舗IDに関連するイベントを取得する"""
-    if not store_ids:
-        return []
-        
-    store_ids_str = ", ".join(str(id) for id in store_ids)
-    query_events = text(f"""
-        SELECT e.event_id, e.event_name, e.description, e.start_date, e.end_date,
-        e.flyer_url, e.event_image_url, e.store_id
-        FROM Events e
-        LEFT JOIN Stores s ON e.store_id = s.store_id
-        WHERE e.store_id IN ({store_ids_str})
-        ORDER BY e.start_date ASC
-        LIMIT {limit}
-        """)
-    
-    return session.execute(query_events).fetchall()
-
-def get_popular_events(session, limit: int = 6) -> List[Dict]:
-    """人気のイベントを取得する"""
-    query = text(f"""
-    SELECT e.event_id, e.event_name, e.description, e.start_date, e.end_date,
-           e.flyer_url, e.event_image_url, e.store_id,
-           s.store_name
-    FROM Events e
-    LEFT JOIN Stores s ON e.store_id = s.store_id
-    WHERE e.start_date >= CURDATE()
-    ORDER BY e.start_date ASC
-    LIMIT {limit}
-    """)
-    
-    return session.execute(query).fetchall()
-
-def format_event_to_recommendation(session, event, prefix_tag: str = "おすすめ") -> EventRecommendation:
-    """イベント情報をレコメンデーションモデルに変換する"""
-    tags = get_event_tags(session, event.event_id)
-    event_date = event.start_date.strftime("%Y/%m/%d") if event.start_date else None
-    
-    return EventRecommendation(
-        id=str(event.event_id),
-        imageUrl=event.event_image_url or event.flyer_url,
-        area=getattr(event, "area", "福岡市内"),  # areaフィールドがない場合はデフォルト値
-        title=event.event_name,
-        date=event_date,
-        tags=[prefix_tag] + tags,
-        description=event.description,
-        points=None  # ポイント情報がない場合はNone
-    )
+    familyMembers: Optional[List[int]] = None
 
 def find_similar_users(df_final: pd.DataFrame, user_id: int, top_n: int = 5) -> List[int]:
     """類似ユーザーをコサイン類似度で計算する"""
     # 対象ユーザーがデータセットに存在するか確認
     if user_id not in df_final.index:
-        print(f"ユーザーID {user_id} はデータセットに存在しません")
+        logger.debug("ユーザーID %s はデータセットに存在しません", user_id)
         return []
     
     # コサイン類似度の計算
@@ -194,129 +54,229 @@ def find_similar_users(df_final: pd.DataFrame, user_id: int, top_n: int = 5) ->
     # 類似ユーザーの抽出 (自分自身を除く)
     return cosine_sim_df[user_id].sort_values(ascending=False).iloc[1:top_n+1].index.tolist()
 
-def find_recommended_stores(df_transactions: pd.DataFrame, similar_users: List[int], top_n: int = 5) -> List[int]:
-    """類似ユーザーが訪れた店舗を特定する"""
-    # 類似ユーザーが取引データに存在するか確認
-    existing_users = [user for user in similar_users if user in df_transactions.index]
-    if not existing_users:
-        return []
-    
-    # 類似ユーザーの店舗訪問を集計
-    recommended_stores = df_transactions.loc[existing_users].sum().sort_values(ascending=False)
-    top_stores = recommended_stores.head(top_n).index.tolist()
-    
-    # 店舗IDを整数に変換
-    return [int(store.replace("store_", "")) for store in top_stores]
+# 類似度で重み付けして投票させる近傍ユーザー数
+NEIGHBOR_COUNT = 20
 
-# メイン推薦ロジック
-def calculate_recommendations(user_id: int, top_n: int = 5) -> Dict[str, Any]:
-    """協調フィルタリングによるイベント推薦を計算する"""
-    try:
+def find_similar_user_rows(snapshot: FeatureSnapshot, row: int, n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """スナップショット上で row と cosine 類似度の高い行を n 件返す（自分自身を除く）"""
+    # 特徴量は行正規化済みなので内積がそのまま cosine 類似度になる
+    sims = snapshot.features @ snapshot.features[row]
+    sims[row] = -np.inf
+    n = min(n, len(sims) - 1)
+    if n <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    top = np.argpartition(-sims, n - 1)[:n]
+    top = top[np.argsort(-sims[top], kind="stable")]
+    return top, sims[top]
+
+def collaborative_scores(snapshot: FeatureSnapshot, row: int,
+                         n_neighbors: int) -> Tuple[np.ndarray, np.ndarray]:
+    """類似ユーザーのお気に入りを類似度で重み付けして集計したイベントごとのスコアと近傍行を返す"""
+    neighbor_rows, sims = find_similar_user_rows(snapshot, row, n_neighbors)
+    if len(neighbor_rows) == 0:
+        return np.zeros(len(snapshot.event_ids), dtype=np.float32), neighbor_rows
+    # 類似度が負の近傍は票に数えない
+    weights = np.clip(sims, 0, None).astype(np.float32)
+    return snapshot.favorites[neighbor_rows].T @ weights, neighbor_rows
+
+def content_scores(snapshot: FeatureSnapshot, tag_ids: List[int]) -> np.ndarray:
+    """ユーザーの興味タグとイベントタグの重なり（cosine）をイベントごとに返す"""
+    columns = [snapshot.tag_index[t] for t in set(tag_ids) if t in snapshot.tag_index]
+    if not columns:
+        return np.zeros(len(snapshot.event_ids), dtype=np.float32)
+    # イベント側は行正規化済みなので、ユーザー側のノルムで割れば cosine になる
+    overlap = np.asarray(snapshot.event_tags[:, columns].sum(axis=1)).ravel()
+    return (overlap / np.sqrt(len(columns))).astype(np.float32)
+
+# 協調スコアの重み alpha = お気に入り数 / (お気に入り数 + CONTENT_BLEND_K)
+# お気に入りがない新規ユーザーはコンテンツベースのみになる
+CONTENT_BLEND_K = 3.0
+
+# 距離の重み 1 / (1 + 距離 / DISTANCE_SCALE_KM)。DISTANCE_SCALE_KM 先のイベントはスコアが半分になる
+DISTANCE_SCALE_KM = 10.0
+
+def distance_weights(snapshot: FeatureSnapshot, row: int) -> Optional[np.ndarray]:
+    """ユーザーの住所（郵便番号）からイベントまでの距離の重み。ユーザーの位置が不明なら None"""
+    origin = snapshot.user_location[row]
+    if np.isnan(origin).any():
+        return None
+    distances = geo.haversine_km_array(float(origin[0]), float(origin[1]),
+                                       snapshot.event_location[:, 0], snapshot.event_location[:, 1])
+    known = ~np.isnan(distances)
+    if not known.any():
+        return None
+    weights = np.empty(len(distances), dtype=np.float32)
+    weights[known] = 1.0 / (1.0 + distances[known] / DISTANCE_SCALE_KM)
+    # 位置が不明なイベントは有利にも不利にもならないよう、位置が分かるイベントの平均にする
+    weights[~known] = weights[known].mean()
+    return weights
+
+def user_scores(snapshot: FeatureSnapshot, row: Optional[int], top_n: int,
+                tag_ids: Optional[List[int]] = None, mode: str = "hybrid",
+                use_distance: bool = True) -> Tuple[np.ndarray, np.ndarray, List[int]]:
+    """1人分のイベントごとのスコア、本人のお気に入りの列、類似ユーザーIDを返す（row が None なら興味タグだけで計算）"""
+    n_events = len(snapshot.event_ids)
+    collab = np.zeros(n_events, dtype=np.float32)
+    similar_users: List[int] = []
+    own_favorites = np.empty(0, dtype=np.int32)
+    if row is not None:
+        own_favorites = snapshot.favorites[row].indices
+        tag_ids = [int(snapshot.tag_ids[i]) for i in snapshot.user_tags[row].indices]
+        if mode != "content":
+            collab, neighbor_rows = collaborative_scores(snapshot, row, max(top_n, NEIGHBOR_COUNT))
+            similar_users = [int(u) for u in snapshot.user_ids[neighbor_rows[:top_n]]]
+
+    content = content_scores(snapshot, tag_ids or []) if mode != "collaborative" else np.zeros(n_events, dtype=np.float32)
+    if mode == "hybrid":
+        # 協調スコアを [0, 1] にそろえてから混ぜる
+        if collab.max() > 0:
+            collab = collab / collab.max()
+        alpha = len(own_favorites) / (len(own_favorites) + CONTENT_BLEND_K)
+        scores = alpha * collab + (1 - alpha) * content
+    else:
+        scores = collab if mode == "collaborative" else content
+
+    if use_distance and row is not None:
+        weights = distance_weights(snapshot, row)
+        if weights is not None:
+            scores = scores * weights
+    return scores, own_favorites, similar_users
+
+def rank_events(snapshot: FeatureSnapshot, scores: np.ndarray, excluded: np.ndarray, top_n: int,
+                today: Optional[date] = None) -> List[int]:
+    """除外（お気に入り済み・終了済み）を0にして、スコア上位のイベントIDを返す"""
+    scores = scores.copy()
+    scores[excluded] = 0
+    scores[snapshot.event_end < (today or date.today()).toordinal()] = 0
+
+    candidates = np.flatnonzero(scores > 0)
+    # スコア降順、同点は開催日が近い順
+    order = np.lexsort((snapshot.event_start[candidates], -scores[candidates]))
+    return [int(e) for e in snapshot.event_ids[candidates[order[:top_n]]]]
+
+def score_candidate_events(snapshot: FeatureSnapshot, user_id: int, top_n: int,
+                           today: Optional[date] = None, tag_ids: Optional[List[int]] = None,
+                           mode: str = "hybrid", use_distance: bool = True) -> Tuple[List[int], List[int]]:
+    """候補イベントをスコアリングし、上位のイベントIDと類似ユーザーIDを返す
+
+    mode: "hybrid"（協調 + コンテンツ）/ "collaborative" / "content"
+    tag_ids: スナップショットにまだいないユーザーの興味タグ
+    use_distance: ユーザーの住所から遠いイベントほどスコアを下げる
+    終了済みのイベントと、本人が既にお気に入り登録しているイベントは候補から除く。
+    """
+    row = snapshot.user_index.get(user_id)
+    if row is None and not tag_ids:
+        logger.debug("ユーザーID %s はデータセットに存在しません", user_id)
+        return [], []
+
+    scores, own_favorites, similar_users = user_scores(snapshot, row, top_n, tag_ids, mode, use_distance)
+    return rank_events(snapshot, scores, own_favorites, top_n, today), similar_users
+
+def score_household_events(snapshot: FeatureSnapshot, user_id: int, top_n: int,
+                           today: Optional[date] = None, mode: str = "hybrid",
+                           use_distance: bool = True) -> Tuple[List[int], List[int]]:
+    """世帯（同じ家族のユーザー）向けの上位イベントIDと家族のユーザーIDを返す
+
+    家族それぞれのスコアを最大値で [0, 1] にそろえて平均する（1人の好みに偏らないように）。
+    家族の誰かが既にお気に入り登録しているイベントは候補から除く。家族未登録なら本人だけで計算する。
+    """
+    rows = snapshot.family_rows(user_id)
+    if len(rows) == 0:
+        logger.debug("ユーザーID %s はデータセットに存在しません", user_id)
+        return [], []
+
+    total = np.zeros(len(snapshot.event_ids), dtype=np.float32)
+    favorites = []
+    for row in rows:
+        scores, own_favorites, _ = user_scores(snapshot, int(row), top_n, mode=mode, use_distance=use_distance)
+        if scores.max() > 0:
+            total += scores / scores.max()
+        favorites.append(own_favorites)
+    excluded = np.unique(np.concatenate(favorites)).astype(np.int32)
+    members = [int(u) for u in snapshot.user_ids[rows]]
+    return rank_events(snapshot, total / len(rows), excluded, top_n, today), members
+
+def get_cold_start_tags(snapshot: FeatureSnapshot, user_id: int) -> Optional[List[int]]:
+    """スナップショット構築後に登録されたユーザーの興味タグを返す"""
+    if user_id in snapshot.user_index:
+        return None
+    tag_ids = feature_store.get_new_user_tags(user_id)
+    if tag_ids is None:
+        # 別ワーカーで登録された直後などはこのプロセスに記録がないので1回だけ引く
         with session_scope() as session:
-            # 1. 各種データの取得
-            df_users = get_user_data(session)
-            df_tags_onehot = get_user_tags(session)
-            df_transactions_onehot = get_transaction_data(session)
-            df_fav_events_onehot = get_favorite_events_onehot(session)
-                        
-            # 2. データの統合
-            area_columns = [col for col in df_users.columns if col.startswith("postal_code")]
-            df_users[area_columns] = df_users[area_columns].astype(int)
-            
-            # データフレームを結合
-            df_final = df_users.set_index("user_id")
-            
-            # タグデータがあれば結合
-            if not df_tags_onehot.empty:
-                df_final = df_final.join(df_tags_onehot, how="left")
-            
-            # 取引データがあれば結合
-            if not df_transactions_onehot.empty:
-                df_final = df_final.join(df_transactions_onehot, how="left")
+            tag_ids = [row.tag_id for row in session.execute(
+                text("SELECT DISTINCT tag_id FROM UserTags WHERE user_id = :user_id"),
+                {"user_id": user_id},
+            )]
+    return tag_ids
 
-            if not df_fav_events_onehot.empty:
-                df_final = df_final.join(df_fav_events_onehot, how="left")
-            
-            # 欠損値を0で埋める
-            df_final = df_final.fillna(0)
-            
-            # 3. 類似ユーザーの特定
-            similar_users = find_similar_users(df_final, user_id, top_n)
-            if not similar_users:
-                return {"events": [], "similarUsers": []}
-            
-            # # 4. 類似ユーザーが訪れた店舗の特定
-            # store_ids = find_recommended_stores(df_transactions_onehot, similar_users)
-            # if not store_ids:
-            #     return {"events": [], "similarUsers": similar_users}
-            
-            # # 5. 店舗に関連するイベントの取得
-            # events_data = get_events_by_store_ids(session, store_ids)
-           
-            # # 6. イベント情報をフォーマット
-            # recommended_events = [
-            #     format_event_to_recommendation(session, event) 
-            #     for event in events_data
-            # ]
+def snapshot_event_to_recommendation(snapshot: FeatureSnapshot, event_id: int,
+                                     prefix_tag: str = "おすすめ") -> Dict[str, Any]:
+    """スナップショット内のイベント情報をレスポンス用の dict にする（DBアクセスなし）
 
-            # 4. 類似ユーザーがお気に入り登録しているイベントを取得
-            query = text("""
-            SELECT DISTINCT e.event_id, e.event_name, e.description, e.start_date, e.end_date,
-                            e.flyer_url, e.event_image_url, e.store_id, e.area
-            FROM FavoriteEvents f
-            JOIN Events e ON f.event_id = e.event_id
-            WHERE f.user_id IN :similar_users
-            ORDER BY e.start_date ASC
-            LIMIT 6
-            """)
+    形は EventRecommendation と同じ。件数分の Pydantic 検証を避けるため dict のまま返す。
+    """
+    event = snapshot.events[event_id]
+    return {**event, "tags": [prefix_tag] + event["tags"]}
 
-            # SQLAlchemyにリストを渡す場合はタプル形式にする必要あり
-            result_events = session.execute(query, {"similar_users": tuple(similar_users)}).fetchall()
+# メイン推薦ロジック
+def calculate_recommendations(user_id: int, top_n: int = 5,
+                              snapshot: Optional[FeatureSnapshot] = None,
+                              today: Optional[date] = None,
+                              household: bool = False) -> Dict[str, Any]:
+    """協調フィルタリングとタグのコンテンツベースを混ぜてイベント推薦を計算する
 
-            # 5. イベント情報をフォーマット
-            recommended_events = [
-                format_event_to_recommendation(session, event)
-                for event in result_events
-            ]
-            
+    snapshot を渡すとそのスナップショットで計算する（オフライン評価用）。
+    household=True なら家族全員向けに計算し、familyMembers に家族のユーザーIDを入れる。
+    """
+    try:
+        if snapshot is None:
+            snapshot = get_snapshot()
+            tag_ids = get_cold_start_tags(snapshot, user_id)
+        else:
+            tag_ids = None
+        if household and user_id in snapshot.user_index:
+            event_ids, members = score_household_events(snapshot, user_id, top_n, today)
             return {
-                "events": recommended_events,
-                "similarUsers": similar_users
+                "events": [snapshot_event_to_recommendation(snapshot, event_id, "家族におすすめ")
+                           for event_id in event_ids],
+                "similarUsers": [],
+                "familyMembers": members,
             }
-            
+        event_ids, similar_users = score_candidate_events(snapshot, user_id, top_n, today, tag_ids)
+        return {
+            "events": [snapshot_event_to_recommendation(snapshot, event_id) for event_id in event_ids],
+            "similarUsers": similar_users,
+        }
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"推薦計算エラー: {str(e)}")
-        traceback.print_exc()
+        logger.exception("推薦計算エラー: %s", e)
         raise HTTPException(status_code=500, detail=f"推薦計算中にエラーが発生しました: {str(e)}")
 
 # APIエンドポイント
-@router.get("/api/recommendations/{user_id}", response_model=RecommendationResponse)
-def get_recommendations(user_id: int, top_n: int = Query(5, ge=1, le=20)):
+@router.get("/api/recommendations/{user_id}", responses={200: {"model": RecommendationResponse}})
+def get_recommendations(user_id: int, top_n: int = Query(5, ge=1, le=20),
+                        household: bool = Query(False, description="家族全員向けのおすすめにする"),
+                        claims: Optional[dict] = Depends(auth_tokens.user_claims)):
     """ユーザーIDに基づいて協調フィルタリングによるおすすめイベントを取得"""
     try:
-        # ユーザーの存在確認
-        user = crud.getuserById(user_id)
-        if not user:
+        # 有効なトークンがあれば本人確認済みなので、ユーザーの存在確認（DB）は省く
+        if claims is None and not crud.user_exists(user_id):
             raise HTTPException(status_code=404, detail="指定されたユーザーが見つかりません")
         
         # 協調フィルタリングによるレコメンド計算
-        recommendations = calculate_recommendations(user_id, top_n)
+        recommendations = calculate_recommendations(user_id, top_n, household=household)
         
         # レコメンドがない場合は代替のレコメンドを提供
         if not recommendations["events"]:
-            with session_scope() as session:
-                # 人気のイベントをフォールバックとして表示
-                popular_events = get_popular_events(session)
-                events = [
-                    format_event_to_recommendation(session, event, prefix_tag="人気") 
-                    for event in popular_events
-                ]
-                recommendations["events"] = events
+            # 人気のイベントをフォールバックとして表示（定期更新済みのフィードを使う）
+            recommendations["events"] = popularity.get_popular_feed()
         
-        return recommendations
-    except HTTPException as http_ex:
-        raise http_ex
+        # 検証済みの dict なので response_model を通さず orjson で直接返す
+        return ORJSONResponse(recommendations)
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"レコメンデーションAPIエラー: {str(e)}")
-        traceback.print_exc()
+        logger.exception("レコメンデーションAPIエラー: %s", e)
         raise HTTPException(status_code=500, detail=f"レコメンデーション取得中にエラーが発生しました: {str(e)}")
\ No newline at end of file
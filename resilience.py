@@ -0,0 +1,339 @@
+# resilience.py
+"""
+外部依存（MySQL / Blob Storage / SendGrid）の障害時に、ワーカーを道連れにしないための仕組み
+
+- タイムアウト: 各クライアントのソケットのタイムアウトで設定する（接続・読み取りの上限。値は下の定数）
+- バルクヘッド: 依存ごとの同時実行数の上限。空きを bulkhead_wait 秒待っても取れなければ即座に失敗させ、
+  遅い依存がスレッドプール（AnyIO の既定40本）を使い切って、他のエンドポイントまで止まるのを防ぐ
+- サーキットブレーカー: 連続 failure_threshold 回失敗したら reset_timeout 秒は呼ばずに即座に失敗させ、
+  その後1回だけ試して成功すれば戻す
+- 読み取り系の stale-while-revalidate キャッシュ: 期限切れの値をすぐ返して裏で取り直す。
+  DB が落ちている間は最後に取れた値（STALE_MAX_AGE まで）を返し続ける
+
+ブレーカー・バルクヘッドで断った呼び出しは DependencyUnavailableError になり、app.py で 503 + Retry-After に変換する
+（エンドポイントが except Exception で HTTPException に変換していても、原因をたどって 503 にする）。
+状態は GET /metrics/resilience で確認できる（ワーカーごとの値）。
+障害時の挙動は python fault_injection.py でローカルの疑似依存を使って確認できる。
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Hashable, NamedTuple, Optional, Tuple
+
+from logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# ───── 依存ごとのタイムアウト（秒）─────
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+DB_READ_TIMEOUT = int(os.getenv("DB_READ_TIMEOUT", "15"))
+DB_WRITE_TIMEOUT = int(os.getenv("DB_WRITE_TIMEOUT", "15"))
+# 接続プールの空きを待つ上限（SQLAlchemy の既定は30秒）
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "5"))
+BLOB_CONNECT_TIMEOUT = int(os.getenv("BLOB_CONNECT_TIMEOUT", "5"))
+BLOB_READ_TIMEOUT = int(os.getenv("BLOB_READ_TIMEOUT", "30"))
+SENDGRID_TIMEOUT = int(os.getenv("SENDGRID_TIMEOUT", "10"))
+
+# 読み取りキャッシュ: この秒数までは新しい値として返し、STALE_MAX_AGE までは古い値を返しつつ裏で取り直す
+READ_CACHE_TTL = int(os.getenv("READ_CACHE_TTL", "30"))
+STALE_MAX_AGE = int(os.getenv("STALE_MAX_AGE", str(24 * 60 * 60)))
+READ_CACHE_SIZE = int(os.getenv("READ_CACHE_SIZE", "2048"))
+
+
+class DependencyUnavailableError(RuntimeError):
+    """ブレーカーが開いている、またはバルクヘッドに空きがない"""
+
+    def __init__(self, name: str, reason: str, retry_after: float):
+        super().__init__(f"{name} を一時的に利用できません（{reason}）")
+        self.name = name
+        self.reason = reason
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+
+def unavailable_cause(exc: BaseException) -> Optional[DependencyUnavailableError]:
+    """exc とその原因（__cause__ / __context__）をたどり、DependencyUnavailableError があれば返す
+
+    エンドポイントの except Exception が 500 の HTTPException に変換した停止を、503 に戻すために使う。
+    """
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        if isinstance(exc, DependencyUnavailableError):
+            return exc
+        seen.add(id(exc))
+        exc = exc.__cause__ or exc.__context__
+    return None
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opened_count = 0
+        self.rejected = 0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            waited = time.monotonic() - self.opened_at
+            if self.state == self.OPEN and waited >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._trial_running:
+                # 試しに1回だけ通す
+                self._trial_running = True
+                return
+            self.rejected += 1
+            raise DependencyUnavailableError(self.name, "サーキットブレーカー作動中",
+                                             max(self.reset_timeout - waited, 1))
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.opened_count += 1
+                    logger.warning("サーキットブレーカーを開きました: %s（連続失敗 %d 回）", self.name, self.failures)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+    def check(self):
+        """開いている間は DependencyUnavailableError（試行枠は使わない）"""
+        with self._lock:
+            if self.state != self.OPEN:
+                return
+            waited = time.monotonic() - self.opened_at
+            if waited >= self.reset_timeout:
+                return
+            self.rejected += 1
+        raise DependencyUnavailableError(self.name, "サーキットブレーカー作動中", self.reset_timeout - waited)
+
+    def release_trial(self):
+        """失敗にも成功にも数えない終わり方（業務エラーなど）をしたときに試行枠を返す"""
+        with self._lock:
+            self._trial_running = False
+
+
+class Bulkhead:
+    """同時実行数の上限。同じスレッドの入れ子の呼び出しは1つに数える"""
+
+    def __init__(self, name: str, max_concurrent: int, wait: float):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.wait = wait
+        self._semaphore = threading.BoundedSemaphore(max_concurrent)
+        self._local = threading.local()
+        self.in_use = 0
+        self.rejected = 0
+
+    @contextmanager
+    def slot(self):
+        depth = getattr(self._local, "depth", 0)
+        if depth == 0:
+            if not self._semaphore.acquire(timeout=self.wait):
+                self.rejected += 1
+                raise DependencyUnavailableError(self.name, "同時実行数の上限", 1)
+            self.in_use += 1
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            if depth == 0:
+                self.in_use -= 1
+                self._semaphore.release()
+
+
+def _all_exceptions(exc: BaseException) -> bool:
+    return True
+
+
+class Dependency:
+    """外部依存1つ分のバルクヘッドとブレーカー
+
+    is_failure: 依存の障害として数える例外か（一意制約違反や 4xx のような呼び出し側の誤りは数えない）
+    """
+
+    def __init__(self, name: str, max_concurrent: int, bulkhead_wait: float = 1.0,
+                 failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 is_failure: Callable[[BaseException], bool] = _all_exceptions):
+        self.name = name
+        self.bulkhead = Bulkhead(name, max_concurrent, bulkhead_wait)
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self.is_failure = is_failure
+
+    @contextmanager
+    def guard(self):
+        """with の中を1回の呼び出しとして数える（入れ子の guard は外側だけが数える）"""
+        if getattr(self.bulkhead._local, "depth", 0) > 0:
+            yield
+            return
+        self.breaker.before_call()
+        try:
+            with self.bulkhead.slot():
+                yield
+        except DependencyUnavailableError:
+            # 混んでいて実行しなかった（または別の依存が使えなかった）だけなので障害には数えない
+            self.breaker.release_trial()
+            raise
+        except Exception as e:
+            if self.is_failure(e):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            raise
+        except BaseException:
+            self.breaker.release_trial()
+            raise
+        else:
+            self.breaker.record_success()
+
+    def check(self):
+        """ブレーカーが開いていれば即座に DependencyUnavailableError（呼び出しには数えない）
+
+        入口と出口が別スレッドになりうる場所（FastAPI の yield 依存など）で、guard の代わりに使う。
+        """
+        self.breaker.check()
+
+    def call(self, func: Callable, *args, **kwargs):
+        with self.guard():
+            return func(*args, **kwargs)
+
+    def metrics(self) -> Dict:
+        return {
+            "state": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "opened": self.breaker.opened_count,
+            "rejected_by_breaker": self.breaker.rejected,
+            "in_use": self.bulkhead.in_use,
+            "max_concurrent": self.bulkhead.max_concurrent,
+            "rejected_by_bulkhead": self.bulkhead.rejected,
+        }
+
+
+_dependencies: Dict[str, Dependency] = {}
+
+def register(name: str, **kwargs) -> Dependency:
+    """依存を登録する（同じ名前なら既存のものを返す）"""
+    if name not in _dependencies:
+        _dependencies[name] = Dependency(name, **kwargs)
+    return _dependencies[name]
+
+
+# ───── 読み取り系の stale-while-revalidate キャッシュ ─────
+class CacheEntry(NamedTuple):
+    value: Any
+    loaded_at: float  # monotonic
+
+
+class StaleWhileRevalidateCache:
+    def __init__(self, ttl: float = READ_CACHE_TTL, stale_max_age: float = STALE_MAX_AGE,
+                 max_entries: int = READ_CACHE_SIZE):
+        self.ttl = ttl
+        self.stale_max_age = stale_max_age
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, CacheEntry]" = OrderedDict()
+        self._refreshing = set()
+        # 取り直しに失敗したキー → 次に試してよい時刻（障害中の DB に毎リクエスト問い合わせない）
+        self._retry_at: Dict[Hashable, float] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refresh_failures = 0
+
+    def get(self, key: Hashable, loader: Callable[[], Any]) -> Tuple[Any, int]:
+        """(値, 経過秒数) を返す。期限切れなら古い値を返して裏で取り直す"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None:
+            age = now - entry.loaded_at
+            if age < self.ttl:
+                self.hits += 1
+                return entry.value, int(age)
+            if age < self.stale_max_age:
+                self.stale_hits += 1
+                self._refresh_in_background(key, loader)
+                return entry.value, int(age)
+
+        # 値がない（か古すぎる）ときだけ呼び出し元で取得する（失敗はそのまま返す）
+        self.misses += 1
+        value = loader()
+        self._put(key, value)
+        return value, 0
+
+    def _put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._entries[key] = CacheEntry(value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                self._retry_at.pop(evicted, None)
+
+    def _refresh_in_background(self, key: Hashable, loader: Callable[[], Any]):
+        with self._lock:
+            if key in self._refreshing or self._retry_at.get(key, 0) > time.monotonic():
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self._put(key, loader())
+                with self._lock:
+                    self._retry_at.pop(key, None)
+            except Exception as e:
+                # 取り直せなければ古い値のまま（ttl 秒後のリクエストでまた試す）
+                self.refresh_failures += 1
+                with self._lock:
+                    self._retry_at[key] = time.monotonic() + self.ttl
+                logger.warning("キャッシュの更新に失敗しました（古い値を返し続けます）: %s: %s", key, e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=refresh, name="cache-refresh", daemon=True).start()
+
+    def expire(self, predicate: Optional[Callable[[Hashable], bool]] = None):
+        """該当するキーを期限切れにする（値は DB 障害時の予備として残す）"""
+        with self._lock:
+            for key, entry in self._entries.items():
+                if predicate is None or predicate(key):
+                    self._entries[key] = entry._replace(loaded_at=min(entry.loaded_at, time.monotonic() - self.ttl))
+                    self._retry_at.pop(key, None)
+
+    def metrics(self) -> Dict:
+        return {"entries": len(self._entries), "hits": self.hits, "stale_hits": self.stale_hits,
+                "misses": self.misses, "refresh_failures": self.refresh_failures}
+
+
+# 読み取り系エンドポイントで共有するキャッシュ
+read_cache = StaleWhileRevalidateCache()
+
+def cache_headers(age: int) -> Dict[str, str]:
+    return {"Age": str(age)} if age else {}
+
+
+def get_metrics() -> Dict:
+    return {
+        "dependencies": {name: dependency.metrics() for name, dependency in _dependencies.items()},
+        "read_cache": read_cache.metrics(),
+    }